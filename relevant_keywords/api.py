@@ -1,16 +1,67 @@
-from flask import request
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Response, request
 from flask_restplus import Api, Resource
 
 from app import app
+from relevant_keywords.background_idf import BackgroundIdf
+from relevant_keywords.crawler_client import CrawlerClient
+from relevant_keywords.keyword_index import KeywordIndex
+from relevant_keywords.lda_engine import LdaEngine
+from relevant_keywords.nlp.token_filter import DEFAULT_TOKEN_FILTER
+from relevant_keywords.page_store import DEFAULT_DIRECTORY, PageStore
 from relevant_keywords.top_keyword import TopKeywords
-from util.log import get_logger
+from relevant_keywords.util.cache import ResultCache, CACHE_MODES, CACHE_USE
+from relevant_keywords.util.log import get_logger
+from relevant_keywords.util.metrics import StageTimer, render_metrics, requests_total
+from relevant_keywords.util.scheduler import ProcessPool, SchedulerBusy, WorkloadQueue, WorkloadScheduler
+from relevant_keywords.util.timeout import Deadline
 
 logger = get_logger('TopKeywordsAPI')
 
 api = Api(app, doc='/doc/', version='1.0', title='Top Keywords')
 
-crawler_endpoint = 'http://localhost:8888/page/extract'
-top_keyword = TopKeywords(crawler_endpoint)
+crawler_endpoint = os.environ.get('CRAWLER_ENDPOINT', 'http://localhost:8888/page/extract')
+# Crawled pages shared with the offline scripts, consulted before calling the crawler
+page_store = PageStore(DEFAULT_DIRECTORY)
+# Batches of 10 urls, 4 concurrent calls, whole crawl bounded well below the gunicorn timeout
+crawler_client = CrawlerClient(crawler_endpoint, batch_size=10, concurrency=4, timeout=120, page_store=page_store)
+preprocess_workers = multiprocessing.cpu_count()
+# Built offline with `python -m relevant_keywords.background_idf`, enables the `background` metric
+background_idf_dir = os.environ.get('BACKGROUND_IDF_DIR',
+                                    os.path.join(os.path.dirname(os.path.realpath(__file__)), '../models/background_idf'))
+background_idf = BackgroundIdf.load(background_idf_dir) if os.path.exists(background_idf_dir) else None
+lda_model_dir = os.environ.get('LDA_MODEL_DIR',
+                               os.path.join(os.path.dirname(os.path.realpath(__file__)), '../models/lda'))
+lda_engine = LdaEngine(model_dir=lda_model_dir, workers=preprocess_workers)
+# Corpus index of the requests with an `index_key`, shared by all gunicorn workers
+keyword_index_path = os.environ.get('KEYWORD_INDEX_PATH',
+                                    os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                 '../cache/keyword_index.sqlite'))
+keyword_index = KeywordIndex(keyword_index_path)
+top_keyword = TopKeywords(crawler_endpoint, preprocess_workers=preprocess_workers, background_idf=background_idf,
+                          lda_engine=lda_engine, crawler_client=crawler_client, keyword_index=keyword_index)
+# Shared by all gunicorn workers
+result_cache_path = os.environ.get('RESULT_CACHE_PATH',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)), '../cache/results.sqlite'))
+result_cache = ResultCache(result_cache_path, ttl=3600, max_entries=10000)
+# Default budget of a request in seconds, below the gunicorn timeout of `run.sh`
+request_deadline = float(os.environ.get('REQUEST_DEADLINE', 200))
+# Scoring jobs per workload class: `lda` trains for up to minutes in processes of its own, so that it neither holds
+# the scoring threads nor the interpreter lock of the worker while the other metrics are scored in seconds
+WORKLOAD_CHEAP = 'cheap'
+WORKLOAD_EXPENSIVE = 'expensive'
+scheduler = WorkloadScheduler([
+    WorkloadQueue(WORKLOAD_CHEAP, ThreadPoolExecutor,
+                  int(os.environ.get('SCHEDULER_CHEAP_WORKERS', max(2, multiprocessing.cpu_count()))),
+                  int(os.environ.get('SCHEDULER_CHEAP_QUEUE', 64)), retry_after=1),
+    # A job stops at the request deadline, one still running well past it is in a process which died or hangs
+    WorkloadQueue(WORKLOAD_EXPENSIVE, ProcessPool, int(os.environ.get('SCHEDULER_EXPENSIVE_WORKERS', 1)),
+                  int(os.environ.get('SCHEDULER_EXPENSIVE_QUEUE', 2)), retry_after=30, job_timeout=request_deadline + 30)
+])
 
 ns = api.namespace('keyword', 'Top Keywords')
 
@@ -28,7 +79,9 @@ class TopKeywordsResource(Resource):
                      'user_agent': "The 'User-Agent' of crawler, default is `%s`" % user_agents[0],
                      'extractor': 'Extractor method for parsing html, supported are %s, default is `%s`'
                                   % (top_keyword.get_supported_extractors(), 'all_text'),
-                     'metric': 'Analytic metric, supported are %s, default is `%s`'
+                     'metric': 'Analytic metric, supported are %s, default is `%s`. Several metrics can be separated '
+                               'by comma (e.g. `tfidf,count,lda`), they share the same crawled and tokenized pages and '
+                               '`top_keywords` is then keyed by metric name'
                                % (top_keyword.get_supported_metric_names(), top_keyword.METRIC_TFIDF),
                      'max_df': 'Float in range [0.0, 1.0] or int, default=`0.9`. '
                                'When building the vocabulary ignore terms that have a document frequency strictly '
@@ -38,46 +91,237 @@ class TopKeywordsResource(Resource):
                                'When building the vocabulary ignore terms that have a document frequency strictly '
                                'lower than the given threshold. This value is also called cut-off in the literature. '
                                'If float, the parameter represents a proportion of documents, integer absolute counts.',
-                     'max_voc': 'Num of vocabulary to keep, default is `200`',
+                     'max_voc': 'Num of vocabulary to keep in the `idf` tf-idf mode, default is `200`',
                      'top_n': 'Top n keywords, default is `20`',
                      'min_gram': 'Min ngram, default is `1`',
-                     'max_ngram': 'Max ngram, default is `1`'})
+                     'max_ngram': 'Max ngram, default is `1`',
+                     'count_mode': 'How the `count` metric is computed, supported are %s, default is `%s`. '
+                                   '`stream` counts page by page without building the document-term matrix, '
+                                   '`approximate` keeps at most `count_capacity` counters and reports error bounds'
+                                   % (top_keyword.get_supported_count_modes(), top_keyword.COUNT_MODE_MATRIX),
+                     'count_capacity': 'Max number of counters of the `approximate` count mode, default is `10000`',
+                     'tfidf_mode': 'How the `tfidf` metric ranks terms, supported are %s, default is `%s`. '
+                                   '`idf` ranks the `max_voc` most frequent terms by idf, `weight` ranks all terms by '
+                                   'their tf-idf weight summed over pages, `hashing` does the same with bounded memory'
+                                   % (top_keyword.get_supported_tfidf_modes(), top_keyword.TFIDF_MODE_IDF),
+                     'lda_key': 'Key of the cached `lda` model, e.g. the seed keyword of the urls. The model is '
+                                'updated with new pages instead of being trained again, default is the fingerprint '
+                                'of the pages',
+                     'lda_passes': 'Max number of `lda` training passes, default is `20`',
+                     'lda_time_budget': 'Max seconds of `lda` training, at least one pass is done, default is no limit',
+                     'cache': 'Result cache mode, supported are %s, default is `%s`. `bypass` neither reads nor writes '
+                              'the cache, `refresh` recomputes and stores the result'
+                              % (', '.join('`%s`' % m for m in CACHE_MODES), CACHE_USE),
+                     'token_filter': 'Stop words and token rules, supported are %s, default is `%s`. The default '
+                                     'removes the sklearn English stop words for `tfidf` only, as the former '
+                                     'vectorizer did, `english` removes them for all metrics, `nltk` are the rules of '
+                                     'the offline scripts'
+                                     % (top_keyword.get_supported_token_filters(), DEFAULT_TOKEN_FILTER),
+                     'index_key': 'Key of the persistent corpus index of the pages, e.g. the seed keyword of the urls. '
+                                  'Only the pages which changed since the last request of the key are tokenized, '
+                                  '`count` (`matrix` mode) and `tfidf` (`idf` mode) are read from the index and the '
+                                  'added and removed pages are reported under `index`, default is no index',
+                     'timings': 'Return the seconds spent per stage (`crawl`, `queue`, `dedup`, `index`, `tokenize`, '
+                                'per metric, `total`) under `timings`, default is `0`',
+                     'dedup': 'Remove near-duplicate pages and the text blocks repeated in at least 3 pages '
+                              '(navigation, footers) before scoring, the removed pages, lines and bytes are reported '
+                              'under `dedup`, default is `0`',
+                     'deadline': 'Seconds budget of the request, default is `%s`. The crawl stops in time to leave a '
+                                 'budget to the scoring, metrics which would not fit fall back to a cheaper engine '
+                                 '(e.g. `lda` to `count`) and are listed under `degraded`, such results are not '
+                                 'cached' % request_deadline},
+             responses={503: 'The scoring queue of the metrics is full, retry after `Retry-After` seconds'})
     def get(self):
         """
         Get top keywords from urls
         """
+        start = time.time()
+        timer = StageTimer()
+        with_timings = parse_flag(request.values.get('timings'))
         result = {
             'ok': True,
             'top_keywords': {},
             'crawl_status': {}
         }
+        status = 200
+        headers = {}
         try:
-            urls = check_not_empty('urls')
-            user_agent = request.values.get('user_agent', user_agents[0])
-            extractor = request.values.get('extractor', 'all_text').lower()
-            metric = request.values.get('metric', 'tfidf').lower()
-            top_n = int(request.values.get('top_n', 20))
-            min_df = float(request.values.get('min_df', 0.3))
-            max_df = float(request.values.get('max_df', 0.9))
-            max_voc = int(request.values.get('max_voc', 200))
-            min_ngram = int(request.values.get('min_ngram', 1))
-            max_ngram = int(request.values.get('max_ngram', 1))
-
-            top_keyword.set_crawler_user_agent(user_agent)
-            result.update(
-                top_keyword.get_top_keywords(urls=urls, extractor=extractor, metric=metric, top_n=top_n, min_df=min_df,
-                                             max_df=max_df, max_voc=max_voc, min_ngram=min_ngram, max_ngram=max_ngram))
+            params, user_agent, cache_mode, deadline = parse_top_keywords_params(request.values)
+            metrics = top_keyword.check_options(params['extractor'], params['metric'], params['count_mode'],
+                                                params['tfidf_mode'], params['token_filter'], params['top_n'])
+
+            def compute():
+                url_list = [url for url in params['urls'].split(',') if url]
+                with timer.stage('crawl'):
+                    crawled = crawler_client.crawl(url_list, params['extractor'], user_agent,
+                                                   timeout=top_keyword.crawl_timeout(deadline))
+                crawled = TopKeywords.parse_crawled(url_list, crawled)
+                ranked = schedule_rank(crawled['contents'], metrics, params, timer, deadline, crawled['urls']).result()
+                ranked['crawl_status'] = crawled['crawl_status']
+                return ranked
+
+            cache_key = ResultCache.make_key(dict(params, user_agent=user_agent))
+            top_keywords, result['cache'] = result_cache.get_or_compute(cache_key, compute, cache_mode,
+                                                                        cacheable=is_complete, deadline=deadline)
+            result.update(top_keywords)
+        except SchedulerBusy as e:
+            logger.warning(e.message)
+            result['ok'] = False
+            result['message'] = e.message
+            status = 503
+            headers['Retry-After'] = str(e.retry_after)
         except Exception as e:
             logger.exception(e)
             result['ok'] = False
             result['message'] = e.message
-            return result, 500
+            status = 500
+
+        record_request(result, timer, start, with_timings, rejected=status == 503)
+        with timer.stage('serialize'):
+            return api.make_response(result, status, headers)
+
+
+@api.route('/cache/stats')
+class ResultCacheStatsResource(Resource):
+    """
+    Result cache statistics
+    """
+
+    def get(self):
+        """
+        Get hit/miss counters of the result cache shared by all workers
+        """
+        return result_cache.stats(), 200
+
+
+@api.route('/scheduler/stats')
+class SchedulerStatsResource(Resource):
+    """
+    Scoring scheduler statistics
+    """
+
+    def get(self):
+        """
+        Get the queued, running and rejected scoring jobs of this worker per workload class
+        """
+        return scheduler.stats(), 200
+
+
+@api.route('/metrics')
+class MetricsResource(Resource):
+    """
+    Prometheus metrics
+    """
+
+    def get(self):
+        """
+        Get the stage latency histograms and request counters of all workers in Prometheus text format
+        """
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def record_request(result, timer, start, with_timings, rejected=False):
+    """
+    :param rejected: the request failed with `SchedulerBusy`
+    """
+    # Serialization is observed in the histogram only, it is not over yet when the timings are returned
+    timer.record('total', time.time() - start)
+    requests_total.inc('rejected' if rejected else 'error' if not result['ok']
+                       else 'degraded' if result.get('degraded') else 'ok')
+    if with_timings:
+        result['timings'] = timer.timings
+
+
+def workload(metrics):
+    return WORKLOAD_EXPENSIVE if TopKeywords.METRIC_LDA in metrics else WORKLOAD_CHEAP
+
+
+def rank_params(params):
+    # Keyword args of `TopKeywords.rank` among the parsed params
+    return dict((name, value) for name, value in params.iteritems() if name not in ('urls', 'extractor', 'metric'))
+
+
+def schedule_rank(contents, metrics, params, timer, deadline, urls=None):
+    """
+    Score crawled contents on the scheduler queue of the workload class of the metrics, the timings of the job are
+    recorded by `timer` once it is done
+    :return: `Future` of the result of `TopKeywords.rank`
+    :raise SchedulerBusy: when the queue is full
+    """
+    job = scheduler.submit(workload(metrics), rank_job, contents, metrics, deadline, rank_params(params), time.time(),
+                           urls)
+    future = Future()
+
+    def done(job):
+        exception, traceback = job.exception_info()
+        if exception is not None:
+            future.set_exception_info(exception, traceback)
+        else:
+            ranked, timings = job.result()
+            timer.record_all(timings)
+            future.set_result(ranked)
+
+    job.add_done_callback(done)
+    return future
+
+
+def rank_job(contents, metrics, deadline, options, submitted, urls=None):
+    """
+    `TopKeywords.rank` run by the scheduler, possibly in a process forked from the worker
+    :return: `(result, timings)`
+    """
+    timer = StageTimer(histogram=None)
+    timer.record('queue', time.time() - submitted)
+    return top_keyword.rank(contents, metrics, timer=timer, deadline=deadline, urls=urls, **options), timer.timings
+
+
+def parse_flag(value):
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+def parse_top_keywords_params(values):
+    """
+    Parse the params of `/keyword/top`, shared by the flask and the async handlers
+    :param values: mapping of request param names to values
+    :return: `(params, user_agent, cache_mode, deadline)` where `params` are the keyword args of `get_top_keywords`
+        and `deadline` the `Deadline` of the request, started now
+    """
+    deadline = Deadline(float(values.get('deadline', request_deadline)))
+    urls = ','.join(url.strip() for url in check_not_empty(values, 'urls').split(',') if url.strip())
+    user_agent = values.get('user_agent', user_agents[0])
+    lda_time_budget = values.get('lda_time_budget')
+    cache_mode = values.get('cache', CACHE_USE).lower()
+    if cache_mode not in CACHE_MODES:
+        raise ValueError('Cache mode `%s` is not supported' % cache_mode)
+
+    params = dict(urls=urls,
+                  extractor=values.get('extractor', 'all_text').lower(),
+                  metric=','.join(sorted(set(m.strip() for m in values.get('metric', 'tfidf').lower().split(',')))),
+                  top_n=int(values.get('top_n', 20)),
+                  min_df=float(values.get('min_df', 0.3)),
+                  max_df=float(values.get('max_df', 0.9)),
+                  max_voc=int(values.get('max_voc', 200)),
+                  min_ngram=int(values.get('min_ngram', 1)),
+                  max_ngram=int(values.get('max_ngram', 1)),
+                  count_mode=values.get('count_mode', top_keyword.COUNT_MODE_MATRIX).lower(),
+                  count_capacity=int(values.get('count_capacity', 10000)),
+                  tfidf_mode=values.get('tfidf_mode', top_keyword.TFIDF_MODE_IDF).lower(),
+                  lda_key=values.get('lda_key'),
+                  lda_passes=int(values.get('lda_passes', 20)),
+                  lda_time_budget=float(lda_time_budget) if lda_time_budget else None,
+                  token_filter=values.get('token_filter', DEFAULT_TOKEN_FILTER).lower(),
+                  dedup=parse_flag(values.get('dedup', '0')),
+                  index_key=values.get('index_key'))
+    return params, user_agent, cache_mode, deadline
+
 
-        return result, 200
+def is_complete(result):
+    # Degraded results are not cached, the next request may have the budget for the full computation
+    return 'degraded' not in result
 
 
-def check_not_empty(param):
-    value = request.values.get(param)
+def check_not_empty(values, param):
+    value = values.get(param)
     if not value:
         raise ValueError('Param `%s` is empty' % param)
     return value
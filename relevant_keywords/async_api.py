@@ -0,0 +1,265 @@
+"""
+Tornado application serving `/keyword/top` without blocking the IOLoop: the crawler calls are awaited and the
+scoring runs in a thread pool, so one worker holds many in-flight requests while they wait on the crawler. All other
+routes fall back to the flask app.
+
+`/keyword/top/stream` takes the same params and streams newline delimited JSON events instead of one response:
+    {"event": "start", "total_urls": 40, "metrics": ["count", "tfidf"]}
+    {"event": "page", "url": "http://...", "ok": true, "error": null, "code": null}      one per url, as crawled
+    {"event": "progress", "crawled_urls": 10, "total_urls": 40, "counted_pages": 9,
+     "top_keywords": ["...", ...], "counts": [["...", 12, 0], ...]}                       after each crawled batch
+    {"event": "result", "ok": true, "top_keywords": {...}, "crawl_status": {...}, ...}   same as `/keyword/top`
+`progress` ranks the ngrams counted so far by a `SpaceSavingCounter` of `count_capacity` counters, `counts` are
+`[term, count, error]`. A cached result is sent as `start` then `result`. A client may close the connection at any
+time, the request then stops at its next event and nothing is cached.
+
+The final scoring of both routes is a job of the `scheduler` of `api`, `/keyword/top` answers `503` with a
+`Retry-After` header when the queue of its workload class is full.
+"""
+import json
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
+from tornado.web import Application, FallbackHandler, RequestHandler
+from tornado.wsgi import WSGIContainer
+
+from relevant_keywords.api import crawler_endpoint, is_complete, logger, page_store, parse_flag, \
+    parse_top_keywords_params, record_request, result_cache, schedule_rank, top_keyword
+from relevant_keywords.crawler_client import AsyncCrawlerClient
+from relevant_keywords.nlp.token_filter import get_token_filter
+from relevant_keywords.nlp.top_k import SpaceSavingCounter
+from relevant_keywords.top_keyword import TopKeywords
+from relevant_keywords.util.cache import ResultCache
+from relevant_keywords.util.metrics import StageTimer
+from relevant_keywords.util.scheduler import SchedulerBusy
+
+# Same crawl limits as the blocking client of `api`, up to 100 crawler connections over all requests of a worker
+async_crawler_client = AsyncCrawlerClient(crawler_endpoint, batch_size=10, concurrency=4, timeout=120,
+                                          max_clients=100, page_store=page_store)
+# Progressive counts of the streamed batches, threads are started on first use, after gunicorn forked the worker
+scoring_executor = ThreadPoolExecutor(max_workers=max(2, multiprocessing.cpu_count()))
+
+
+class AsyncTopKeywordsHandler(RequestHandler):
+    """
+    Same params and response as the flask `/keyword/top` resource
+    """
+
+    @gen.coroutine
+    def get(self):
+        start = time.time()
+        timer = StageTimer()
+        with_timings = parse_flag(self.get_argument('timings', None))
+        result = {
+            'ok': True,
+            'top_keywords': {},
+            'crawl_status': {}
+        }
+        try:
+            values = dict((name, self.get_argument(name)) for name in self.request.arguments)
+            params, user_agent, cache_mode, deadline = parse_top_keywords_params(values)
+            metrics = top_keyword.check_options(params['extractor'], params['metric'], params['count_mode'],
+                                                params['tfidf_mode'], params['token_filter'], params['top_n'])
+
+            @gen.coroutine
+            def compute():
+                url_list = [url for url in params['urls'].split(',') if url]
+                crawl_start = time.time()
+                crawled = yield async_crawler_client.crawl(url_list, params['extractor'], user_agent,
+                                                           timeout=top_keyword.crawl_timeout(deadline))
+                timer.record('crawl', time.time() - crawl_start)
+                crawled = TopKeywords.parse_crawled(url_list, crawled)
+                ranked = yield schedule_rank(crawled['contents'], metrics, params, timer, deadline, crawled['urls'])
+                ranked['crawl_status'] = crawled['crawl_status']
+                raise gen.Return(ranked)
+
+            cache_key = ResultCache.make_key(dict(params, user_agent=user_agent))
+            top_keywords, result['cache'] = yield result_cache.get_or_compute_async(cache_key, compute, cache_mode,
+                                                                                    cacheable=is_complete,
+                                                                                    deadline=deadline)
+            result.update(top_keywords)
+        except SchedulerBusy as e:
+            logger.warning(e.message)
+            result['ok'] = False
+            result['message'] = e.message
+            self.set_status(503)
+            self.set_header('Retry-After', e.retry_after)
+        except Exception as e:
+            logger.exception(e)
+            result['ok'] = False
+            result['message'] = e.message
+            self.set_status(500)
+
+        record_request(result, timer, start, with_timings, rejected=self.get_status() == 503)
+        with timer.stage('serialize'):
+            body = json.dumps(result)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(body)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class StreamingTopKeywordsHandler(RequestHandler):
+    """
+    Same params as `/keyword/top`, the result is streamed as newline delimited JSON events, see the module doc
+    """
+
+    def initialize(self):
+        self.disconnected = False
+        self.started = False
+
+    def on_connection_close(self):
+        self.disconnected = True
+
+    @gen.coroutine
+    def send(self, event):
+        if self.disconnected:
+            raise ClientDisconnected()
+        self.started = True
+        self.write(json.dumps(event) + '\n')
+        try:
+            # Also waits for slow clients, events are not buffered without bound
+            yield self.flush()
+        except StreamClosedError:
+            self.disconnected = True
+            raise ClientDisconnected()
+
+    @gen.coroutine
+    def get(self):
+        start = time.time()
+        timer = StageTimer()
+        with_timings = parse_flag(self.get_argument('timings', None))
+        result = {
+            'event': 'result',
+            'ok': True,
+            'top_keywords': {},
+            'crawl_status': {}
+        }
+        self.set_header('Content-Type', 'application/x-ndjson')
+        # Proxies must not buffer the events
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        rejected = False
+        try:
+            values = dict((name, self.get_argument(name)) for name in self.request.arguments)
+            params, user_agent, cache_mode, deadline = parse_top_keywords_params(values)
+            metrics = top_keyword.check_options(params['extractor'], params['metric'], params['count_mode'],
+                                                params['tfidf_mode'], params['token_filter'], params['top_n'])
+            url_list = [url for url in params['urls'].split(',') if url]
+            yield self.send({'event': 'start', 'total_urls': len(url_list), 'metrics': metrics})
+
+            @gen.coroutine
+            def compute():
+                crawled = yield self.crawl_progressively(url_list, params, user_agent, timer, deadline)
+                if not crawled['contents']:
+                    # No failed url either when the crawl was cancelled or had no page
+                    failed_urls = crawled['crawl_status']['failed_urls']
+                    raise RuntimeError(failed_urls[0]['error'] if failed_urls else 'No page content')
+                ranked = yield schedule_rank(crawled['contents'], metrics, params, timer, deadline, crawled['urls'])
+                ranked['crawl_status'] = crawled['crawl_status']
+                raise gen.Return(ranked)
+
+            cache_key = ResultCache.make_key(dict(params, user_agent=user_agent))
+            top_keywords, result['cache'] = yield result_cache.get_or_compute_async(cache_key, compute, cache_mode,
+                                                                                    cacheable=is_complete,
+                                                                                    deadline=deadline)
+            result.update(top_keywords)
+        except ClientDisconnected:
+            logger.info('Stream closed by the client after %.2fs' % (time.time() - start))
+            result['ok'] = False
+            record_request(result, timer, start, with_timings)
+            return
+        except SchedulerBusy as e:
+            # After the `start` event, reported by the `result` event only
+            logger.warning(e.message)
+            result['ok'] = False
+            result['message'] = e.message
+            result['retry_after'] = e.retry_after
+            rejected = True
+        except Exception as e:
+            logger.exception(e)
+            result['ok'] = False
+            result['message'] = e.message
+            if not self.started:
+                self.set_status(500)
+
+        record_request(result, timer, start, with_timings, rejected=rejected)
+        with timer.stage('serialize'):
+            body = json.dumps(result) + '\n'
+        self.finish(body)
+
+    @gen.coroutine
+    def crawl_progressively(self, url_list, params, user_agent, timer, deadline):
+        """
+        Crawl the urls, sending the `page` events of each batch and a `progress` event once its pages are counted
+        :return: dict of the `contents`, `urls` and `crawl_status`, as parsed by `TopKeywords.parse_crawled`
+        """
+        batches = Queue()
+        token_filter = get_token_filter(params['token_filter'])
+        counter = SpaceSavingCounter(params['count_capacity'])
+        contents = []
+        crawled_page_urls = []
+        failed_urls = []
+        crawled_urls = 0
+
+        @gen.coroutine
+        def crawl():
+            try:
+                yield async_crawler_client.crawl(url_list, params['extractor'], user_agent,
+                                                 timeout=top_keyword.crawl_timeout(deadline),
+                                                 on_batch=lambda *batch: batches.put_nowait(batch),
+                                                 cancelled=lambda: self.disconnected)
+            finally:
+                batches.put_nowait(None)
+
+        crawl_start = time.time()
+        crawling = crawl()
+        while True:
+            batch = yield batches.get()
+            if batch is None:
+                break
+            urls, pages, error = batch
+            crawled_urls += len(urls)
+            batch_contents = []
+            for url, page in pages or [(url, {'error': error}) for url in urls]:
+                if page.get('ok'):
+                    batch_contents.append(page['content'])
+                    crawled_page_urls.append(url)
+                else:
+                    failed_urls.append({'url': url, 'error': page.get('error'), 'code': page.get('code')})
+                yield self.send({'event': 'page', 'url': url, 'ok': bool(page.get('ok')), 'error': page.get('error'),
+                                 'code': page.get('code')})
+            if batch_contents:
+                contents.extend(batch_contents)
+                yield scoring_executor.submit(TopKeywords.count_pages, batch_contents, counter, params['min_ngram'],
+                                              params['max_ngram'], token_filter)
+            top_counts = counter.top(params['top_n'])
+            yield self.send({'event': 'progress', 'crawled_urls': crawled_urls, 'total_urls': len(url_list),
+                             'counted_pages': len(contents), 'top_keywords': [term for term, _, _ in top_counts],
+                             'counts': top_counts})
+        yield crawling
+        timer.record('crawl', time.time() - crawl_start)
+
+        raise gen.Return({
+            'contents': contents,
+            'urls': crawled_page_urls,
+            'crawl_status': {
+                'failed_count': len(failed_urls),
+                'succeed_count': len(url_list) - len(failed_urls),
+                'failed_urls': failed_urls
+            }
+        })
+
+
+def make_app(flask_app):
+    return Application([
+        (r'/keyword/top', AsyncTopKeywordsHandler),
+        (r'/keyword/top/stream', StreamingTopKeywordsHandler),
+        (r'.*', FallbackHandler, dict(fallback=WSGIContainer(flask_app)))
+    ])
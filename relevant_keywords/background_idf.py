@@ -0,0 +1,158 @@
+"""
+Background idf model, document frequencies of ngrams computed offline from a large local corpus.
+
+The model is a directory holding the sorted 64 bits hashes of the terms (`terms.npy`), their document frequencies
+(`df.npy`) and `meta.json`. Arrays are loaded memory mapped, so all gunicorn workers share the same pages.
+
+Build: python -m relevant_keywords.background_idf [--max-ngram 3] [--min-df 2] model_dir corpus_file [...]
+Corpus files are `.jsonl` (one page per line with a `content` field), `.xlsx` (output of `crawl_urls.py`) or plain
+text files holding one page each.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from relevant_keywords.top_keyword import keyword_tokenizer, iter_ngrams
+from relevant_keywords.util.log import get_logger
+
+FIELD_URL_PAGE_CONTENT = 'Landing Page Content'
+FIELD_URL_CRAWL_STATUS = 'Crawl Status'
+
+TERMS_FILE = 'terms.npy'
+DF_FILE = 'df.npy'
+META_FILE = 'meta.json'
+
+
+def term_hash(term, murmurhash3_32=None):
+    # Two 32 bits murmur hashes make collisions negligible for vocabularies of millions of ngrams
+    if murmurhash3_32 is None:
+        from sklearn.utils import murmurhash3_32
+    return (murmurhash3_32(term, seed=0, positive=True) << 32) | murmurhash3_32(term, seed=1, positive=True)
+
+
+def term_hashes(terms):
+    # sklearn is imported when the background metric is first used
+    from sklearn.utils import murmurhash3_32
+    return np.fromiter((term_hash(term, murmurhash3_32) for term in terms), dtype=np.uint64, count=len(terms))
+
+
+class BackgroundIdf(object):
+
+    def __init__(self, hashes, dfs, num_docs, max_ngram):
+        self.hashes = hashes
+        self.dfs = dfs
+        self.num_docs = num_docs
+        self.max_ngram = max_ngram
+
+    @classmethod
+    def load(cls, model_dir):
+        with open(os.path.join(model_dir, META_FILE)) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(model_dir, TERMS_FILE), mmap_mode='r'),
+                   np.load(os.path.join(model_dir, DF_FILE), mmap_mode='r'),
+                   meta['num_docs'], meta['max_ngram'])
+
+    def save(self, model_dir):
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        np.save(os.path.join(model_dir, TERMS_FILE), self.hashes)
+        np.save(os.path.join(model_dir, DF_FILE), self.dfs)
+        with open(os.path.join(model_dir, META_FILE), 'w') as f:
+            json.dump({'num_docs': self.num_docs, 'max_ngram': self.max_ngram, 'num_terms': len(self.hashes),
+                       'created': time.time()}, f)
+
+    def document_frequency(self, terms):
+        """
+        Background document frequency of each term, `0` for unknown terms
+        """
+        hashes = term_hashes(terms)
+        if not len(self.hashes):
+            return np.zeros(len(terms), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.where(self.hashes[positions] == hashes, self.dfs[positions], 0)
+
+    def idf(self, terms):
+        # Smoothed idf, unknown terms get the highest value
+        return np.log(float(self.num_docs + 1) / (self.document_frequency(terms) + 1)) + 1
+
+
+class BackgroundIdfBuilder(object):
+    """
+    Count document frequencies of ngrams page by page, unique hashes of a chunk of pages are merged into the totals
+    with numpy so only distinct hashes are held in memory
+    """
+
+    def __init__(self, max_ngram=1, min_df=2, chunk_docs=1000):
+        self.max_ngram = max_ngram
+        self.min_df = min_df
+        self.chunk_docs = chunk_docs
+        self.logger = get_logger(self.__class__.__name__)
+        self.num_docs = 0
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._dfs = np.empty(0, dtype=np.int64)
+        self._chunk = []
+
+    def add(self, content):
+        tokens = keyword_tokenizer.tokenize(content.lower())
+        self._chunk.append(term_hashes(set(iter_ngrams(tokens, 1, self.max_ngram))))
+        self.num_docs += 1
+        if len(self._chunk) >= self.chunk_docs:
+            self._merge_chunk()
+
+    def _merge_chunk(self):
+        if not self._chunk:
+            return
+        hashes, dfs = np.unique(np.concatenate(self._chunk), return_counts=True)
+        self._chunk = []
+        all_hashes = np.concatenate([self._hashes, hashes])
+        all_dfs = np.concatenate([self._dfs, dfs])
+        self._hashes, inverse = np.unique(all_hashes, return_inverse=True)
+        self._dfs = np.bincount(inverse, weights=all_dfs).astype(np.int64)
+        self.logger.info('Merged %d pages, %d distinct terms' % (self.num_docs, len(self._hashes)))
+
+    def build(self):
+        self._merge_chunk()
+        keep = self._dfs >= self.min_df
+        return BackgroundIdf(self._hashes[keep], self._dfs[keep].astype(np.int32), self.num_docs, self.max_ngram)
+
+
+def iter_corpus(path):
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)['content']
+    elif path.endswith('.xlsx'):
+        import pandas as pd
+        df = pd.read_excel(path)
+        for _, row in df.iterrows():
+            if row.get(FIELD_URL_CRAWL_STATUS) == 'Crawl successfully' and not pd.isnull(row[FIELD_URL_PAGE_CONTENT]):
+                yield row[FIELD_URL_PAGE_CONTENT]
+    else:
+        with open(path) as f:
+            yield f.read().decode('utf-8', 'ignore')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a background idf model from local page corpora')
+    parser.add_argument('model_dir')
+    parser.add_argument('corpus_files', nargs='+')
+    parser.add_argument('--max-ngram', type=int, default=3)
+    parser.add_argument('--min-df', type=int, default=2, help='Terms in fewer pages are not kept')
+    args = parser.parse_args()
+
+    builder = BackgroundIdfBuilder(max_ngram=args.max_ngram, min_df=args.min_df)
+    for path in args.corpus_files:
+        for content in iter_corpus(path):
+            if content:
+                builder.add(content)
+    model = builder.build()
+    model.save(args.model_dir)
+    print 'Saved background idf of %d terms from %d pages to %s' % (len(model.hashes), model.num_docs, args.model_dir)
+
+
+if __name__ == '__main__':
+    main()
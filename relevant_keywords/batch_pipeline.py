@@ -0,0 +1,286 @@
+"""
+Offline batch pipeline: top keywords of the landing pages of many seed keywords.
+
+Usage: python -m relevant_keywords.batch_pipeline input.jsonl output.jsonl [--workers 4] [--metric count,lda]
+           [--crawler-endpoint http://localhost:8888/page/extract] [--page-store cache/pages]
+
+Input rows are JSONL objects or CSV lines holding a seed keyword, a landing page url and optionally its already
+crawled content, pages without content are crawled. A first pass only records the file offsets of the rows of each
+keyword, the pages of a keyword are then read, crawled and scored by one of the worker processes with the same code
+as `TopKeywords`, so at most one keyword's pages per worker are held in memory.
+
+Every scored keyword is appended to the output JSONL as soon as it is done, the output is also the checkpoint: a
+rerun skips the keywords already in it. Keywords which failed are appended to `<output>.errors.jsonl` and retried by
+the next run.
+
+The Excel files of `crawl_urls.py` convert with pandas, e.g. `pd.read_excel(path).to_csv(path[:-5] + '.csv')`, and
+are read with `--keyword-field Keyword --url-field "Landing Page" --content-field "Landing Page Content"`.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from relevant_keywords.crawler_client import CrawlerClient
+from relevant_keywords.lda_engine import LdaEngine
+from relevant_keywords.nlp.token_filter import DEFAULT_TOKEN_FILTER
+from relevant_keywords.page_store import PageStore
+from relevant_keywords.top_keyword import TopKeywords
+from relevant_keywords.util.log import get_logger
+
+logger = get_logger('BatchPipeline')
+
+# Set in each worker process by `_init_worker`
+_worker = None
+
+
+class _OffsetLines(object):
+    """
+    Lines of a file for `csv.reader`, remembering the offset where the current record started
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.record_start = None
+        self.new_record = True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        offset = self.f.tell()
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        if self.new_record:
+            self.record_start = offset
+            self.new_record = False
+        return line
+
+
+class RowReader(object):
+    """
+    Read keyword rows of a JSONL or CSV file by offset, so that only offsets are kept between the two passes
+    """
+
+    def __init__(self, path, keyword_field='keyword', url_field='url', content_field='content'):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+        self.keyword_field = keyword_field
+        self.url_field = url_field
+        self.content_field = content_field
+        self.fieldnames = None
+
+    def iter_offsets(self):
+        """
+        :return: iterator of `(offset, keyword)` of the rows
+        """
+        with open(self.path, 'rb') as f:
+            if self.is_csv:
+                lines = _OffsetLines(f)
+                reader = csv.reader(lines)
+                self.fieldnames = next(reader)
+                lines.new_record = True
+                for values in reader:
+                    keyword = self._parse_csv(values).get(self.keyword_field)
+                    if keyword:
+                        yield lines.record_start, keyword
+                    lines.new_record = True
+            else:
+                while True:
+                    offset = f.tell()
+                    line = f.readline()
+                    if not line:
+                        break
+                    if line.strip():
+                        keyword = json.loads(line).get(self.keyword_field)
+                        if keyword:
+                            yield offset, keyword
+
+    def read_rows(self, offsets):
+        rows = []
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                if self.is_csv:
+                    row = self._parse_csv(next(csv.reader(_OffsetLines(f))))
+                else:
+                    row = json.loads(f.readline())
+                rows.append(row)
+        return rows
+
+    def _parse_csv(self, values):
+        return dict((name, value.decode('utf-8')) for name, value in zip(self.fieldnames, values))
+
+    def url(self, row):
+        return row.get(self.url_field)
+
+    def content(self, row):
+        return row.get(self.content_field) or None
+
+
+def group_offsets(reader):
+    """
+    :return: list of `(keyword, offsets)` in the order keywords first appear
+    """
+    groups = {}
+    order = []
+    for offset, keyword in reader.iter_offsets():
+        if keyword not in groups:
+            groups[keyword] = []
+            order.append(keyword)
+        groups[keyword].append(offset)
+    return [(keyword, groups[keyword]) for keyword in order]
+
+
+def load_done_keywords(output_path):
+    """
+    Keywords already in the output, a last line cut by a crash is removed so that it is computed again
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        valid_end = 0
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            try:
+                done.add(json.loads(line)['keyword'])
+            except (ValueError, KeyError):
+                logger.warning('Drop truncated output line at offset %d' % valid_end)
+                break
+            valid_end = f.tell()
+        f.truncate(valid_end)
+    return done
+
+
+class PipelineWorker(object):
+
+    def __init__(self, reader, metrics, options, crawler_endpoint=None, extractor='all_text', lda_model_dir=None,
+                 page_store_dir=None):
+        self.reader = reader
+        self.metrics = metrics
+        self.options = options
+        self.extractor = extractor
+        crawler_client = CrawlerClient(crawler_endpoint,
+                                       page_store=PageStore(page_store_dir) if page_store_dir else None)
+        self.top_keyword = TopKeywords(crawler_endpoint, lda_engine=LdaEngine(model_dir=lda_model_dir),
+                                       crawler_client=crawler_client)
+        self.crawl = crawler_endpoint is not None
+
+    def process(self, keyword, offsets):
+        start = time.time()
+        rows = self.reader.read_rows(offsets)
+        contents = [self.reader.content(row) for row in rows if self.reader.content(row)]
+        urls = [self.reader.url(row) for row in rows if not self.reader.content(row) and self.reader.url(row)]
+        crawl_status = {'failed_count': 0, 'succeed_count': 0, 'failed_urls': []}
+        if urls and self.crawl:
+            crawled = TopKeywords.parse_crawled(urls, self.top_keyword.crawler_client.crawl(urls, self.extractor))
+            contents.extend(crawled['contents'])
+            crawl_status = crawled['crawl_status']
+        elif urls:
+            crawl_status['failed_count'] = len(urls)
+            crawl_status['failed_urls'] = [{'url': url, 'error': 'No content and no crawler endpoint', 'code': None}
+                                           for url in urls]
+        if not contents:
+            raise RuntimeError('No page content')
+
+        result = {'keyword': keyword, 'num_pages': len(contents), 'crawl_status': crawl_status}
+        # Lda models are cached by keyword like the api's `lda_key`
+        result.update(self.top_keyword.rank(contents, self.metrics, lda_key=keyword, **self.options))
+        result['seconds'] = time.time() - start
+        return result
+
+
+def _init_worker(worker_args):
+    global _worker
+    _worker = PipelineWorker(*worker_args)
+
+
+def _process_group(group):
+    keyword, offsets = group
+    try:
+        return True, _worker.process(keyword, offsets)
+    except Exception as e:
+        logger.exception(e)
+        return False, {'keyword': keyword, 'error': '%s' % e}
+
+
+def run_pipeline(input_path, output_path, metric='count,lda', workers=None, crawler_endpoint=None,
+                 extractor='all_text', lda_model_dir=None, keyword_field='keyword', url_field='url',
+                 content_field='content', page_store_dir=None, **options):
+    """
+    :param page_store_dir: directory of the `PageStore` of the crawled pages, e.g. the one of the api
+    :param options: keyword args of `TopKeywords.rank`, e.g. `top_n` or `max_ngram`
+    :return: dict of the numbers of `done`, `skipped` and `failed` keywords
+    """
+    reader = RowReader(input_path, keyword_field, url_field, content_field)
+    metrics = TopKeywords(crawler_endpoint).check_options(extractor, metric, options.get('count_mode', 'matrix'),
+                                                          options.get('tfidf_mode', 'idf'),
+                                                          options.get('token_filter', DEFAULT_TOKEN_FILTER),
+                                                          options.get('top_n', 20))
+    done = load_done_keywords(output_path)
+    groups = [group for group in group_offsets(reader) if group[0] not in done]
+    logger.info('%d keywords to process, %d already done' % (len(groups), len(done)))
+
+    stats = {'done': 0, 'skipped': len(done), 'failed': 0}
+    worker_args = (reader, metrics, options, crawler_endpoint, extractor, lda_model_dir, page_store_dir)
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(), _init_worker, (worker_args,))
+    try:
+        with open(output_path, 'ab') as output, open(output_path + '.errors.jsonl', 'ab') as errors:
+            for ok, result in pool.imap_unordered(_process_group, groups, chunksize=1):
+                target = output if ok else errors
+                target.write(json.dumps(result) + '\n')
+                # Flushed per keyword, a crash loses at most the keywords in progress
+                target.flush()
+                stats['done' if ok else 'failed'] += 1
+                logger.info('Keyword `%s` %s (%d/%d)' % (result['keyword'], 'done' if ok else 'failed',
+                                                         stats['done'] + stats['failed'], len(groups)))
+    finally:
+        pool.terminate()
+        pool.join()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Top keywords of the landing pages of seed keywords')
+    parser.add_argument('input', help='JSONL or CSV rows of keyword, url and optional content')
+    parser.add_argument('output', help='JSONL results, also the checkpoint of reruns')
+    parser.add_argument('--workers', type=int, default=None, help='Keyword groups processed in parallel')
+    parser.add_argument('--metric', default='count,lda')
+    parser.add_argument('--crawler-endpoint', default=None, help='Crawler of the rows without content')
+    parser.add_argument('--page-store', default=None, help='Directory of the crawled pages store, read before crawling')
+    parser.add_argument('--extractor', default='all_text')
+    parser.add_argument('--lda-model-dir', default=None)
+    parser.add_argument('--keyword-field', default='keyword')
+    parser.add_argument('--url-field', default='url')
+    parser.add_argument('--content-field', default='content')
+    parser.add_argument('--top-n', type=int, default=20)
+    parser.add_argument('--min-df', type=float, default=0.3)
+    parser.add_argument('--max-df', type=float, default=0.9)
+    parser.add_argument('--min-ngram', type=int, default=1)
+    parser.add_argument('--max-ngram', type=int, default=3)
+    parser.add_argument('--tfidf-mode', default=TopKeywords.TFIDF_MODE_IDF)
+    parser.add_argument('--count-mode', default=TopKeywords.COUNT_MODE_MATRIX)
+    parser.add_argument('--lda-passes', type=int, default=20)
+    parser.add_argument('--token-filter', default=DEFAULT_TOKEN_FILTER)
+    parser.add_argument('--dedup', action='store_true',
+                        help='Remove near-duplicate pages and text blocks repeated over several pages')
+    args = parser.parse_args()
+
+    stats = run_pipeline(args.input, args.output, metric=args.metric, workers=args.workers,
+                         crawler_endpoint=args.crawler_endpoint, extractor=args.extractor,
+                         lda_model_dir=args.lda_model_dir, keyword_field=args.keyword_field, url_field=args.url_field,
+                         content_field=args.content_field, page_store_dir=args.page_store, top_n=args.top_n,
+                         min_df=args.min_df, max_df=args.max_df, min_ngram=args.min_ngram, max_ngram=args.max_ngram,
+                         tfidf_mode=args.tfidf_mode, count_mode=args.count_mode, lda_passes=args.lda_passes,
+                         token_filter=args.token_filter, dedup=args.dedup)
+    print 'Done %(done)d keywords, skipped %(skipped)d already done, %(failed)d failed' % stats
+
+
+if __name__ == '__main__':
+    main()
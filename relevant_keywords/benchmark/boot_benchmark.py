@@ -0,0 +1,90 @@
+"""
+Benchmark of the boot of an api worker: import time and memory of `relevant_keywords.main`, the heavy libraries it
+loads, and the cost of the first request of each metric compared to the next ones.
+
+Usage: python -m relevant_keywords.benchmark.boot_benchmark [--repeat 3]
+Every measure runs in a fresh interpreter, as a worker started by gunicorn.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ('numpy', 'scipy', 'sklearn', 'gensim', 'nltk', 'tornado', 'flask')
+FIRST_REQUEST_CASES = [
+    ('tfidf_idf', 'tfidf', dict(tfidf_mode='idf')),
+    ('tfidf_hashing', 'tfidf', dict(tfidf_mode='hashing')),
+    ('count', 'count', dict()),
+    ('lda', 'lda', dict(lda_passes=1)),
+]
+
+
+def measure_boot(warm_up):
+    if warm_up:
+        os.environ['WARM_UP'] = '1'
+    start = time.time()
+    import relevant_keywords.main  # noqa: F401
+    elapsed = time.time() - start
+    return {
+        'seconds': elapsed,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'loaded': [name for name in HEAVY_MODULES if name in sys.modules]
+    }
+
+
+def measure_first_requests():
+    from relevant_keywords.benchmark.corpus import generate_corpus
+    from relevant_keywords.lda_engine import LdaEngine
+    from relevant_keywords.top_keyword import TopKeywords
+
+    pages = generate_corpus(num_pages=10, words_per_page=300, vocab_size=500)
+    top_keyword = TopKeywords(None, lda_engine=LdaEngine())
+    results = {}
+    for name, metric, options in FIRST_REQUEST_CASES:
+        runs = []
+        for _ in range(2):
+            # Different pages each run, lda models are cached by corpus
+            pages = pages[1:] + pages[:1]
+            start = time.time()
+            top_keyword.rank(pages, [metric], min_df=0.1, **options)
+            runs.append(time.time() - start)
+        results[name] = {'first': runs[0], 'next': runs[1]}
+    return results
+
+
+def run_child(mode):
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+    env.pop('WARM_UP', None)
+    output = subprocess.check_output([sys.executable, '-m', 'relevant_keywords.benchmark.boot_benchmark',
+                                      '--child', mode], env=env, stderr=open(os.devnull, 'w'))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Boot benchmark of an api worker')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', choices=['boot', 'warm_up', 'first_requests'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == 'first_requests':
+        print json.dumps(measure_first_requests())
+        return
+    if args.child:
+        print json.dumps(measure_boot(args.child == 'warm_up'))
+        return
+
+    for mode in ('boot', 'warm_up'):
+        runs = [run_child(mode) for _ in range(args.repeat)]
+        print '%-8s import %6.3fs best  %6.1f MB max rss  loaded: %s' % (
+            mode, min(run['seconds'] for run in runs), min(run['max_rss_mb'] for run in runs),
+            ', '.join(runs[0]['loaded']))
+    for name, result in sorted(run_child('first_requests').iteritems()):
+        print '%-15s first request %6.3fs  next %6.3fs' % (name, result['first'], result['next'])
+
+
+if __name__ == '__main__':
+    main()
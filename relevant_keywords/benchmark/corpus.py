@@ -0,0 +1,78 @@
+"""
+Synthetic page corpora of configurable size, vocabulary and length.
+
+Word frequencies follow a Zipf law like natural text, so document frequencies range from terms on every page to
+terms on a single one. Stop words and markup noise of all_text pages are mixed in.
+"""
+import random
+import string
+from bisect import bisect_left
+
+from relevant_keywords.benchmark.tokenizer_benchmark import NOISE, WORDS
+from relevant_keywords.top_keyword import STOP_WORDS
+
+
+def synthetic_vocabulary(vocab_size, seed=0):
+    # The real keyword words first, so they are the most frequent ones
+    rnd = random.Random(seed)
+    words = list(WORDS[:vocab_size])
+    known = set(words)
+    while len(words) < vocab_size:
+        word = u''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 10)))
+        if word not in known:
+            known.add(word)
+            words.append(word)
+    return words
+
+
+def zipf_cumulative_weights(size, exponent=1.0):
+    cumulative = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+_distributions = {}
+
+
+def zipf_vocabulary(vocab_size, seed=0):
+    # The fake crawler generates pages one by one, the vocabulary and its weights are built once
+    key = (vocab_size, seed)
+    if key not in _distributions:
+        _distributions[key] = synthetic_vocabulary(vocab_size, seed), zipf_cumulative_weights(vocab_size)
+    return _distributions[key]
+
+
+def generate_corpus(num_pages=50, words_per_page=2000, vocab_size=5000, length_jitter=0.5, stop_word_rate=0.3,
+                    noise_rate=0.05, seed=0, vocabulary_seed=None):
+    """
+    :param words_per_page: mean number of words of a page
+    :param length_jitter: pages have between `(1 - jitter)` and `(1 + jitter)` times `words_per_page` words
+    :param stop_word_rate: share of stop words among the words
+    :param noise_rate: share of markup, numbers and punctuation tokens among the words
+    :param seed: seed of the pages, and of the vocabulary unless `vocabulary_seed` is given
+    :param vocabulary_seed: seed of the vocabulary, e.g. shared by pages generated one by one with seeds of their own
+    """
+    rnd = random.Random(seed)
+    vocabulary, cumulative = zipf_vocabulary(vocab_size, seed if vocabulary_seed is None else vocabulary_seed)
+    stop_words = sorted(STOP_WORDS)
+    total = cumulative[-1]
+    pages = []
+    for _ in range(num_pages):
+        length = max(1, int(words_per_page * rnd.uniform(1 - length_jitter, 1 + length_jitter)))
+        words = []
+        for _ in range(length):
+            draw = rnd.random()
+            if draw < noise_rate:
+                word = rnd.choice(NOISE)
+            elif draw < noise_rate + stop_word_rate:
+                word = rnd.choice(stop_words)
+            else:
+                word = vocabulary[min(bisect_left(cumulative, rnd.random() * total), len(vocabulary) - 1)]
+            if rnd.random() < 0.1:
+                word = word.capitalize()
+            words.append(word)
+        pages.append(u' '.join(words))
+    return pages
@@ -0,0 +1,122 @@
+"""
+Local stand-in of the crawler `/page/extract` endpoint, serving synthetic pages.
+
+Usage: python -m relevant_keywords.benchmark.fake_crawler [--port 8888] [--delay 0.1] [--fail-rate 0.1]
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urlparse import parse_qs
+
+from relevant_keywords.benchmark.corpus import generate_corpus
+from relevant_keywords.benchmark.tokenizer_benchmark import generate_pages
+
+
+class FakeCrawlerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay=0.0, fail_rate=0.0, page_error_rate=0.0, words_per_page=2000, seed=0,
+                 vocab_size=None, fail_first=0):
+        """
+        :param delay: seconds waited per crawled url
+        :param fail_rate: probability that a whole call fails with a `503`
+        :param fail_first: number of first calls which fail with a `503`, e.g. to check retries
+        :param page_error_rate: probability that a page is returned as not ok
+        :param vocab_size: pages are drawn from a Zipf distributed vocabulary of this size, by default from the small
+            vocabulary of the tokenizer benchmark
+        """
+        HTTPServer.__init__(self, address, FakeCrawlerHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.page_error_rate = page_error_rate
+        self.words_per_page = words_per_page
+        self.vocab_size = vocab_size
+        self.seed = seed
+        self.fail_first = fail_first
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+
+    def page(self, url):
+        # Same content for the same url
+        seed = zlib.crc32(url.encode('utf-8'))
+        if random.Random(seed).random() < self.page_error_rate:
+            return {'ok': False, 'error': 'Fake crawl error', 'code': 404}
+        if self.vocab_size:
+            content = generate_corpus(num_pages=1, words_per_page=self.words_per_page, vocab_size=self.vocab_size,
+                                      seed=seed, vocabulary_seed=self.seed)[0]
+        else:
+            content = generate_pages(num_pages=1, words_per_page=self.words_per_page, seed=seed)[0]
+        return {'ok': True, 'content': content, 'code': 200}
+
+
+class FakeCrawlerHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        with self.server._calls_lock:
+            self.server.calls += 1
+            call = self.server.calls
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        params = parse_qs(body)
+        urls = [url for url in params.get('urls', [''])[0].decode('utf-8').split(',') if url]
+        if call <= self.server.fail_first or self.server.random.random() < self.server.fail_rate:
+            self.send_error(503, 'Fake crawler unavailable')
+            return
+
+        time.sleep(self.server.delay * len(urls))
+        data = json.dumps({'pages': [[url, self.server.page(url)] for url in urls]})
+        gzipped = 'gzip' in self.headers.getheader('accept-encoding', '')
+        if gzipped:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(data)
+            data = buf.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_crawler(port=0, **kwargs):
+    """
+    Start a fake crawler in a background thread
+    :return: `(server, endpoint)`, stop it with `server.shutdown()`
+    """
+    server = FakeCrawlerServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/page/extract' % server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake crawler serving synthetic pages')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds per crawled url')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Probability of a 503 response')
+    parser.add_argument('--page-error-rate', type=float, default=0.0, help='Probability of a page error')
+    parser.add_argument('--words-per-page', type=int, default=2000)
+    parser.add_argument('--vocab-size', type=int, default=None, help='Size of the Zipf distributed vocabulary')
+    args = parser.parse_args()
+    server = FakeCrawlerServer(('0.0.0.0', args.port), delay=args.delay, fail_rate=args.fail_rate,
+                               page_error_rate=args.page_error_rate, words_per_page=args.words_per_page,
+                               vocab_size=args.vocab_size)
+    print 'Fake crawler listening on %d' % args.port
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
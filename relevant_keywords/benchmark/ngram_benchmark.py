@@ -0,0 +1,75 @@
+"""
+Benchmark of the document-term matrix built from packed ngram keys against the one built from joined ngram strings.
+
+Usage: python -m relevant_keywords.benchmark.ngram_benchmark [max_ngram] [page_file ...]
+Every variant runs in its own process, so that its peak memory can be reported.
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+from relevant_keywords.benchmark.corpus import generate_corpus
+from relevant_keywords.benchmark.tokenizer_benchmark import load_pages
+from relevant_keywords.nlp.doc_term import DocTermMatrix
+from relevant_keywords.top_keyword import generate_ngram, keyword_tokenizer, has_no_english_stop_word, no_stop_word_mask
+
+
+def string_doc_term(docs, max_ngram):
+    # The ngram strings of all pages are alive at once, as with the former `generate_ngram` documents
+    ngram_docs = [generate_ngram(tokens, 1, max_ngram) for tokens in docs]
+    allocated = sum(len(ngrams) for ngrams in ngram_docs)
+    return DocTermMatrix.from_documents(ngram_docs), allocated
+
+
+def packed_doc_term(docs, max_ngram):
+    return DocTermMatrix.from_token_documents(docs, 1, max_ngram), 0
+
+
+VARIANTS = [('joined strings', string_doc_term), ('packed keys', packed_doc_term)]
+
+
+def run_variant(func, pages, max_ngram, queue):
+    docs = keyword_tokenizer.tokenize_documents(pages, lowercase=True)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    doc_term, allocated = func(docs, max_ngram)
+    elapsed = time.time() - start
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Ranking only turns the winning ngrams into strings
+    top = [doc_term.terms[i] for i in np.argsort(-doc_term.term_frequency(), kind='mergesort')[:20]]
+    queue.put((elapsed, (rss_peak - rss_before) / 1024.0, allocated, doc_term.num_terms,
+               doc_term.matrix.nnz, top[:3]))
+
+
+def check_parity(pages, max_ngram):
+    docs = keyword_tokenizer.tokenize_documents(pages, lowercase=True)
+    expected, _ = string_doc_term(docs, max_ngram)
+    actual, _ = packed_doc_term(docs, max_ngram)
+    if list(actual.terms) != expected.terms or (actual.matrix != expected.matrix).nnz:
+        raise AssertionError('Packed ngram matrix differs from the string one')
+    if not np.array_equal(no_stop_word_mask(actual.terms),
+                          [has_no_english_stop_word(term) for term in expected.terms]):
+        raise AssertionError('Packed ngram stop word mask differs from the string one')
+
+
+def main(args):
+    max_ngram = int(args[0]) if args else 3
+    pages = load_pages(args[1:]) if len(args) > 1 else generate_corpus(num_pages=50, words_per_page=20000,
+                                                                       vocab_size=20000)
+    check_parity(pages[:10], max_ngram)
+    print 'Parity ok, %d pages, max_ngram=%d' % (len(pages), max_ngram)
+    for name, func in VARIANTS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_variant, args=(func, pages, max_ngram, queue))
+        process.start()
+        elapsed, rss_mb, allocated, num_terms, nnz, top = queue.get()
+        process.join()
+        print '%-15s %8.3fs %8.1f MB peak increase %10d ngram strings  %d terms, %d non zeros  %s' % (
+            name, elapsed, rss_mb, allocated, num_terms, nnz, ', '.join(top))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,341 @@
+"""
+Benchmark suite: tokenization, ngram generation, the Apriori pruning of the ngrams of `tfidf`, the `TopKeywords`
+metrics, the cost of log calls and end-to-end `/keyword/top` latency.
+
+Usage: python -m relevant_keywords.benchmark.suite [--pages 50] [--words-per-page 2000] [--vocab-size 5000]
+           [--output results.json] [--baseline previous.json] [--skip-e2e] [--log-async 0]
+
+The corpus is generated from `--seed`, so runs of different versions on the same options are comparable. The
+end-to-end part starts the fake crawler and a gunicorn tornado worker serving `relevant_keywords.main:async_app`
+unless `--server` points to a running api. Results are written as JSON, `--baseline` prints the ratio of every
+timing to the one of a previous result file, e.g. of a run with `--log-async 0` to see the end-to-end overhead of
+writing the logs in the request threads.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import requests
+
+from relevant_keywords.benchmark.corpus import generate_corpus
+from relevant_keywords.benchmark.fake_crawler import start_fake_crawler
+from relevant_keywords.lda_engine import LdaEngine
+from relevant_keywords.nlp.doc_term import DocTermMatrix
+from relevant_keywords.nlp.ngrams import intern_documents, pack_frequent_ngrams
+from relevant_keywords.top_keyword import TopKeywords, doc_count_bounds, generate_ngram, iter_ngrams, \
+    keyword_tokenizer, tokenize
+from relevant_keywords.util.log import DailyFileHandler, LogWriter, QueueHandler, formatter
+
+RANK_CASES = [
+    ('tfidf_idf', dict(metrics=['tfidf'], tfidf_mode='idf')),
+    ('tfidf_weight', dict(metrics=['tfidf'], tfidf_mode='weight')),
+    ('tfidf_hashing', dict(metrics=['tfidf'], tfidf_mode='hashing')),
+    ('count_matrix', dict(metrics=['count'], count_mode='matrix')),
+    ('count_stream', dict(metrics=['count'], count_mode='stream')),
+    ('count_approximate', dict(metrics=['count'], count_mode='approximate', count_capacity=2000)),
+    ('lda', dict(metrics=['lda'])),
+]
+
+
+def timed_runs(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'runs': times}
+
+
+def bench_tokenize(pages, repeat):
+    megabytes = sum(len(page) for page in pages) / 1024.0 / 1024.0
+    results = {
+        'legacy_tokenize': timed_runs(lambda: [tokenize(page.lower()) for page in pages], repeat),
+        'keyword_tokenizer': timed_runs(lambda: keyword_tokenizer.tokenize_documents(pages, lowercase=True), repeat)
+    }
+    for result in results.values():
+        result['mb_per_second'] = megabytes / result['best']
+    return results
+
+
+def bench_ngrams(pages, max_ngram, repeat):
+    docs = keyword_tokenizer.tokenize_documents(pages, lowercase=True)
+    return {
+        'legacy_generate_ngram': timed_runs(lambda: [generate_ngram(tokens, 1, max_ngram) for tokens in docs],
+                                            repeat),
+        'iter_ngrams': timed_runs(lambda: [list(iter_ngrams(tokens, 1, max_ngram)) for tokens in docs], repeat)
+    }
+
+
+def bench_ngram_pruning(pages, max_ngram, repeat, min_df=0.1, max_df=0.9):
+    """
+    Document-term matrix and `tfidf` scores of the interned pages, with all ngrams and with the ngrams longer than one
+    token pruned below `min_df`. `ngrams` is the number of ngram occurrences packed and counted, `terms` the size of
+    the vocabulary, `identical` tells whether both rank the same keywords.
+    """
+    tokens, docs = intern_documents(keyword_tokenizer.tokenize_documents(pages, lowercase=True))
+    min_doc_count = doc_count_bounds(min_df, max_df, len(docs))[0]
+
+    def score(doc_term):
+        return (TopKeywords._get_top_by_tfidf_score(doc_term, 20, min_df, max_df),
+                TopKeywords._get_top_by_tfidf_weight(doc_term, 20, min_df, max_df))
+
+    results = {}
+    scores = {}
+    for name, count in (('full', None), ('pruned', min_doc_count)):
+        doc_term = DocTermMatrix.from_interned(tokens, docs, 1, max_ngram, count)
+        scores[name] = score(doc_term)
+        results[name] = {
+            'build': timed_runs(lambda: DocTermMatrix.from_interned(tokens, docs, 1, max_ngram, count), repeat),
+            'tfidf': timed_runs(lambda: score(doc_term), repeat),
+            'terms': doc_term.num_terms
+        }
+    results['full']['ngrams'] = sum(max(0, len(ids) - n + 1) for ids in docs for n in range(1, max_ngram + 1))
+    results['pruned']['ngrams'] = pack_frequent_ngrams(docs, 1, max_ngram, min_doc_count)[2]
+    results['identical'] = scores['full'] == scores['pruned']
+    return results
+
+
+def bench_metrics(pages, max_ngram, lda_passes, repeat):
+    results = {}
+    for name, options in RANK_CASES:
+        options = dict(options, max_ngram=max_ngram, lda_passes=lda_passes, min_df=0.1)
+        metrics = options.pop('metrics')
+
+        def run():
+            # A new engine per run, a cached lda model would not be trained again
+            TopKeywords(None, lda_engine=LdaEngine()).rank(pages, metrics, **options)
+        results[name] = timed_runs(run, repeat)
+    return results
+
+
+def bench_logging(repeat, records=5000):
+    """
+    Seconds spent in the calling thread by `records` debug calls and as many `exception` calls, with the handlers
+    writing in the calling thread (`sync`) and through the queue of a `LogWriter` (`async`)
+    """
+    log_dir = tempfile.mkdtemp(prefix='keyword-bench-logs-')
+    results = {}
+    try:
+        for mode in ('sync', 'async'):
+            stream = open(os.devnull, 'w')
+            handlers = [logging.StreamHandler(stream), DailyFileHandler(log_dir)]
+            for handler in handlers:
+                handler.setFormatter(formatter)
+            writer = LogWriter(max_size=2 * records * repeat)
+            logger = logging.getLogger('LogBenchmark.%s' % mode)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            logger.handlers = [QueueHandler(writer, handlers)] if mode == 'async' else handlers
+
+            def debug():
+                for i in range(records):
+                    logger.debug('Record %d of the logging benchmark' % i)
+
+            def exception():
+                try:
+                    raise ValueError('Logging benchmark')
+                except ValueError as e:
+                    for _ in range(records):
+                        logger.exception(e)
+
+            results[mode] = {'debug': timed_runs(debug, repeat), 'exception': timed_runs(exception, repeat)}
+            writer.stop(timeout=60)
+            for handler in handlers:
+                handler.close()
+            stream.close()
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+    return results
+
+
+def percentiles(latencies):
+    values = np.asarray(latencies)
+    return dict(('p%d' % p, float(np.percentile(values, p))) for p in (50, 90, 95, 99))
+
+
+def bench_end_to_end(server, num_requests, concurrency, urls_per_request, metric, max_ngram):
+    def call(index):
+        urls = ','.join('http://bench.local/%d/%d' % (index, i) for i in range(urls_per_request))
+        start = time.time()
+        try:
+            response = requests.get(server + '/keyword/top', params={
+                'urls': urls, 'metric': metric, 'max_ngram': max_ngram, 'min_df': 0.1, 'cache': 'bypass'
+            }, timeout=600)
+            ok = response.ok and response.json().get('ok')
+        except (requests.RequestException, ValueError):
+            ok = False
+        return time.time() - start, ok
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    results = pool.map(call, range(num_requests), chunksize=1)
+    elapsed = time.time() - start
+    pool.close()
+    latencies = [latency for latency, ok in results if ok]
+    result = {
+        'requests': num_requests,
+        'concurrency': concurrency,
+        'urls_per_request': urls_per_request,
+        'metric': metric,
+        'errors': num_requests - len(latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed
+    }
+    if latencies:
+        result.update(percentiles(latencies))
+    return result
+
+
+def wait_for_server(server, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Api server exited with code %s' % process.returncode)
+        try:
+            requests.get(server + '/metrics', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError('Api server did not start in %d seconds' % timeout)
+
+
+def start_api_server(crawler_endpoint, port, workers, work_dir, log_async=True):
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))),
+               CRAWLER_ENDPOINT=crawler_endpoint,
+               RESULT_CACHE_PATH=os.path.join(work_dir, 'results.sqlite'),
+               LDA_MODEL_DIR=os.path.join(work_dir, 'lda'),
+               BACKGROUND_IDF_DIR=os.path.join(work_dir, 'background_idf'),
+               PAGE_STORE_DIR=os.path.join(work_dir, 'pages'),
+               KEYWORD_INDEX_PATH=os.path.join(work_dir, 'keyword_index.sqlite'),
+               LOG_DIR=os.path.join(work_dir, 'logs'),
+               LOG_ASYNC='1' if log_async else '0')
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn.app.wsgiapp', '-k', 'tornado', '-w', str(workers),
+                                '-b', '127.0.0.1:%d' % port, '--timeout', '600', 'relevant_keywords.main:async_app'],
+                               env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    server = 'http://127.0.0.1:%d' % port
+    wait_for_server(server, process)
+    return server, process
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def iter_timings(results, prefix=''):
+    # Flatten the nested results into `(path, seconds)` pairs of the comparable timings
+    for name, value in sorted(results.iteritems()):
+        path = prefix + name
+        if isinstance(value, dict):
+            for item in iter_timings(value, path + '.'):
+                yield item
+        elif name in ('best', 'p50', 'p90', 'p95', 'p99'):
+            yield path, value
+
+
+def compare(results, baseline):
+    previous = dict(iter_timings(baseline['results']))
+    print '%-55s %10s %10s %8s' % ('timing', 'baseline', 'current', 'ratio')
+    for path, seconds in iter_timings(results):
+        if previous.get(path):
+            print '%-55s %10.4f %10.4f %7.2fx' % (path, previous[path], seconds, seconds / previous[path])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of relevant keywords')
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--words-per-page', type=int, default=2000)
+    parser.add_argument('--vocab-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-ngram', type=int, default=2)
+    parser.add_argument('--lda-passes', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-e2e', action='store_true', help='Skip the end-to-end `/keyword/top` benchmark')
+    parser.add_argument('--server', help='Url of a running api, by default a local one is started')
+    parser.add_argument('--port', type=int, default=7790, help='Port of the local api')
+    parser.add_argument('--workers', type=int, default=1, help='Gunicorn workers of the local api')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--urls-per-request', type=int, default=20)
+    parser.add_argument('--metric', default='tfidf,count')
+    parser.add_argument('--crawler-delay', type=float, default=0.05, help='Seconds per url of the fake crawler')
+    parser.add_argument('--log-async', type=int, choices=[0, 1], default=1,
+                        help='`LOG_ASYNC` of the local api, `0` writes the logs in the request threads')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Previous result file to compare with')
+    args = parser.parse_args()
+
+    pages = generate_corpus(num_pages=args.pages, words_per_page=args.words_per_page, vocab_size=args.vocab_size,
+                            seed=args.seed)
+    results = {}
+    print 'Tokenize...'
+    results['tokenize'] = bench_tokenize(pages, args.repeat)
+    print 'Ngrams...'
+    results['ngrams'] = bench_ngrams(pages, args.max_ngram, args.repeat)
+    print 'Ngram pruning...'
+    results['ngram_pruning'] = dict(('max_ngram_%d' % n, bench_ngram_pruning(pages, n, args.repeat))
+                                    for n in sorted({max(2, args.max_ngram), 3, 4}))
+    for name, result in sorted(results['ngram_pruning'].iteritems()):
+        print '  %s: %d -> %d ngrams, %d -> %d terms, identical %s' % (
+            name, result['full']['ngrams'], result['pruned']['ngrams'], result['full']['terms'],
+            result['pruned']['terms'], result['identical'])
+    print 'Metrics...'
+    results['metrics'] = bench_metrics(pages, args.max_ngram, args.lda_passes, args.repeat)
+    print 'Logging...'
+    results['logging'] = bench_logging(args.repeat)
+
+    if not args.skip_e2e:
+        print 'End to end...'
+        if args.server:
+            results['end_to_end'] = bench_end_to_end(args.server, args.requests, args.concurrency,
+                                                     args.urls_per_request, args.metric, args.max_ngram)
+        else:
+            crawler, crawler_endpoint = start_fake_crawler(delay=args.crawler_delay,
+                                                           words_per_page=args.words_per_page,
+                                                           vocab_size=args.vocab_size)
+            work_dir = tempfile.mkdtemp(prefix='keyword-bench-')
+            process = None
+            try:
+                server, process = start_api_server(crawler_endpoint, args.port, args.workers, work_dir,
+                                                   bool(args.log_async))
+                results['end_to_end'] = bench_end_to_end(server, args.requests, args.concurrency,
+                                                         args.urls_per_request, args.metric, args.max_ngram)
+            finally:
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+                crawler.shutdown()
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'revision': git_revision(),
+        'created': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print 'Results written to %s' % args.output
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
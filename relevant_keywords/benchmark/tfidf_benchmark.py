@@ -0,0 +1,75 @@
+"""
+Benchmark of the `tfidf` metric modes against the original `TfidfVectorizer` + idf ranking path.
+
+Usage: python -m relevant_keywords.benchmark.tfidf_benchmark [max_ngram] [page_file ...]
+Every variant runs in its own process, so that its peak memory can be reported.
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from relevant_keywords.benchmark.tokenizer_benchmark import generate_pages, load_pages
+from relevant_keywords.top_keyword import TopKeywords, tokenize
+
+TOP_N = 20
+MIN_DF = 0.3
+MAX_DF = 0.9
+MAX_VOC = 200
+
+
+def legacy_tfidf(top_keyword, pages, max_ngram):
+    vectorized = TfidfVectorizer(tokenizer=tokenize, stop_words='english', ngram_range=(1, max_ngram),
+                                 min_df=MIN_DF, max_df=MAX_DF, max_features=MAX_VOC)
+    vectorized.fit_transform(pages)
+    features = vectorized.get_feature_names()
+    indices = np.argsort(vectorized.idf_)[::-1]
+    return [(features[i], vectorized.idf_[i]) for i in indices[:TOP_N]]
+
+
+def idf_tfidf(top_keyword, pages, max_ngram):
+    doc_term = top_keyword._build_doc_term(pages, 1, max_ngram)
+    return top_keyword._get_top_by_tfidf_score(doc_term, TOP_N, MIN_DF, MAX_DF, MAX_VOC)
+
+
+def weight_tfidf(top_keyword, pages, max_ngram):
+    doc_term = top_keyword._build_doc_term(pages, 1, max_ngram)
+    return top_keyword._get_top_by_tfidf_weight(doc_term, TOP_N, MIN_DF, MAX_DF)
+
+
+def hashing_tfidf(top_keyword, pages, max_ngram):
+    return top_keyword._get_top_by_hashed_tfidf_weight(pages, TOP_N, MIN_DF, MAX_DF, 1, max_ngram)
+
+
+VARIANTS = [('legacy (TfidfVectorizer)', legacy_tfidf), ('idf', idf_tfidf), ('weight', weight_tfidf),
+            ('hashing', hashing_tfidf)]
+
+
+def run_variant(func, pages, max_ngram, queue):
+    top_keyword = TopKeywords(None)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    top = func(top_keyword, pages, max_ngram)
+    elapsed = time.time() - start
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, (rss_peak - rss_before) / 1024.0, [term for term, _ in top[:5]]))
+
+
+def main(args):
+    max_ngram = int(args[0]) if args else 2
+    pages = load_pages(args[1:]) if len(args) > 1 else generate_pages(num_pages=50, words_per_page=20000)
+    print '%d pages, max_ngram=%d' % (len(pages), max_ngram)
+    for name, func in VARIANTS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_variant, args=(func, pages, max_ngram, queue))
+        process.start()
+        elapsed, rss_mb, top = queue.get()
+        process.join()
+        print '%-25s %8.3fs %8.1f MB peak increase  %s' % (name, elapsed, rss_mb, ', '.join(top))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+# coding=utf-8
+"""
+Parity check and throughput benchmark of `KeywordTokenizer` against `top_keyword.tokenize`.
+
+Usage: python -m relevant_keywords.benchmark.tokenizer_benchmark [page_file ...]
+Without page files a synthetic all_text-like corpus is generated.
+"""
+import random
+import sys
+import time
+
+from relevant_keywords.top_keyword import tokenize, keyword_tokenizer, STOP_WORDS
+
+EDGE_CASES = [
+    u'', u'   ', u'<div>', u'<div class="footer">Gifts</div>', u'[caption] [1]', u'1234 12.50 $1,299 (2017) 1e10',
+    u'NaN Infinity infinity2 nan-nan', u"don't shouldn't wouldn't's gift's", u'personalized-gifts for_her e-mail',
+    u'naïve café – résumé “quotes”', u'http://www.etsy.com/featured/personalized-gifts?ref=home_page',
+    u'ABOUT About about', u'\t\ngifts\xa0mugs frames', u'----- ***** ===== gifts!!!',
+]
+
+WORDS = [u'personalized', u'gifts', u'christmas', u'holiday', u'custom', u'engraved', u'necklace', u'photo',
+         u'wedding', u'birthday', u'jewelry', u'ornament', u'blanket', u'mugs', u'frame', u'monogram', u'shop']
+
+NOISE = [u'<div>', u'</span>', u'[more]', u'12.99', u'$25', u'2017', u'|', u'-', u'&amp;', u'©', u'www.gifts.com',
+         u'e-mail', u'sign-in', u"it's", u'(new)', u'home_page', u'«back»']
+
+
+def generate_pages(num_pages=30, words_per_page=20000, seed=0):
+    rnd = random.Random(seed)
+    vocabulary = WORDS + list(STOP_WORDS)[:60] + NOISE
+    pages = []
+    for _ in range(num_pages):
+        words = []
+        for _ in range(words_per_page):
+            word = rnd.choice(vocabulary)
+            if rnd.random() < 0.2:
+                word = word.capitalize()
+            words.append(word)
+        pages.append(u' '.join(words))
+    return pages
+
+
+def load_pages(paths):
+    pages = []
+    for path in paths:
+        with open(path) as f:
+            pages.append(f.read().decode('utf-8', 'ignore'))
+    return pages
+
+
+def check_parity(pages):
+    for text in EDGE_CASES + pages:
+        for variant in (text, text.lower(), text.encode('utf-8')):
+            expected = tokenize(variant)
+            actual = keyword_tokenizer.tokenize(variant)
+            if expected != actual:
+                raise AssertionError('Tokenizer mismatch for %r: %r != %r' % (variant[:80], expected[:20], actual[:20]))
+
+
+def measure(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(paths):
+    pages = load_pages(paths) if paths else generate_pages()
+    check_parity(pages)
+    print 'Parity ok on %d pages and %d edge cases' % (len(pages), len(EDGE_CASES))
+
+    total_mb = sum(len(p) for p in pages) / 1024.0 / 1024.0
+    legacy = measure(lambda: [tokenize(p.lower()) for p in pages])
+    single = measure(lambda: [keyword_tokenizer.tokenize(p.lower()) for p in pages])
+    batch = measure(lambda: keyword_tokenizer.tokenize_documents(pages, lowercase=True))
+    for name, elapsed in (('top_keyword.tokenize', legacy), ('KeywordTokenizer.tokenize', single),
+                          ('KeywordTokenizer.tokenize_documents', batch)):
+        print '%-40s %8.3fs %8.2f MB/s %6.1fx' % (name, elapsed, total_mb / elapsed, legacy / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,9 +1,7 @@
-import pandas as pd
-from parser.content_getter import ContentGetter
-from parser.crawler import PageCrawler
-from parser.extractor import GooseDragnetPageExtractor
 from pprint import pprint
 
+from relevant_keywords.page_store import DEFAULT_DIRECTORY, PageStore
+
 FIELD_KEYWORD = 'Keyword'
 FIELD_URL = 'Landing Page'
 FIELD_URL_PAGE_CONTENT = 'Landing Page Content'
@@ -12,11 +10,35 @@ FIELD_URL_TYPE = 'Url Type'
 URL_TYPE_WEB = 'Web'
 URL_TYPE_NEWS = 'News'
 
-crawler = PageCrawler()
-extractor = GooseDragnetPageExtractor()
-content_getter = ContentGetter(crawler=crawler, extractor=extractor)
+EXTRACTOR_NAME = 'goose_dragnet'
+
+
+def crawl_pages(urls, content_getter, page_store, extractor_name=EXTRACTOR_NAME):
+    """
+    Pages of the urls read from the page store, the others crawled and stored
+    :return: dict of url to page as returned by `ContentGetter.process`, `{'content': ..., 'error': ...}`
+    """
+    url_page_contents = dict((url, {'content': page['content'], 'error': None})
+                             for url, page in page_store.get_pages(list(urls), extractor_name).iteritems())
+    crawled = content_getter.process(set(url for url in urls if url not in url_page_contents))
+    page_store.put_pages([[url, {'ok': not page['error'], 'content': page['content'], 'code': None}]
+                          for url, page in crawled.iteritems()], extractor_name)
+    url_page_contents.update(crawled)
+    return url_page_contents
+
 
 if __name__ == '__main__':
+    import pandas as pd
+    from parser.content_getter import ContentGetter
+    from parser.crawler import PageCrawler
+    from parser.extractor import GooseDragnetPageExtractor
+
+    crawler = PageCrawler()
+    extractor = GooseDragnetPageExtractor()
+    content_getter = ContentGetter(crawler=crawler, extractor=extractor)
+    # Same store as the api, pages crawled by either are not crawled again
+    page_store = PageStore(DEFAULT_DIRECTORY)
+
     url_file = 'data/top_10_ranking_keywords.xlsx'
     df = pd.read_excel(url_file)
     urls = set()
@@ -26,7 +48,7 @@ if __name__ == '__main__':
         # if idx == 5:
         #     break
 
-    url_page_contents = content_getter.process(urls)
+    url_page_contents = crawl_pages(urls, content_getter, page_store)
     for idx, row in df.iterrows():
         url = row[FIELD_URL]
         crawled_page = url_page_contents.get(url)
@@ -0,0 +1,423 @@
+import json
+import os
+import re
+import time
+import urllib
+from multiprocessing.pool import ThreadPool
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.locks import Semaphore
+
+from relevant_keywords.util.log import get_logger
+
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+# Bytes of the response read at a time, the raw response is never held whole
+CHUNK_SIZE = 64 * 1024
+
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_PAGE_URL = re.compile(r'\[\s*("(?:[^"\\]|\\.)*")')
+
+
+class PagesParser(object):
+    """
+    Incremental parser of the `pages` array of a crawler response: every `[url, page]` item is decoded as soon as its
+    last byte is received, and only the bytes of the item in progress are kept. An item larger than `max_page_bytes`
+    is not kept past that size, it is returned as a failed page.
+    """
+
+    def __init__(self, max_page_bytes=None, key='pages'):
+        self.max_page_bytes = max_page_bytes
+        self.key = key
+        self.depth = 0
+        self.in_string = False
+        # The escaped character of a string is the first one of the next chunk
+        self.escaped = False
+        self.in_array = False
+        self.done = False
+        # Chunks of the object key and of the array item in progress
+        self.key_parts = None
+        self.last_key = None
+        self.item_parts = None
+        self.item_bytes = 0
+        # Start of an item too large to be kept, until its end
+        self.oversized_head = None
+
+    def feed(self, data):
+        """
+        :return: list of the `[url, page]` items completed by `data`
+        """
+        items = []
+        pos = 0
+        if self.escaped and data:
+            pos = 1
+            self.escaped = False
+        string_start = 0
+        item_start = 0
+        while not self.done:
+            if self.in_string:
+                end, pos = self._string_end(data, pos)
+                if end < 0:
+                    break
+                self.in_string = False
+                if self.depth == 1 and self.key_parts is not None:
+                    self.last_key = ''.join(self.key_parts) + data[string_start:end]
+                    self.key_parts = None
+                continue
+
+            match = _STRUCTURE.search(data, pos)
+            if match is None:
+                pos = len(data)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1:
+                    string_start = pos
+                    self.key_parts = []
+            elif char in '[{':
+                self.depth += 1
+                if self.depth == 2 and char == '[' and self.last_key == self.key:
+                    self.in_array = True
+                elif self.depth == 3 and self.in_array:
+                    item_start = match.start()
+                    self.item_parts = []
+                    self.item_bytes = 0
+            else:
+                self.depth -= 1
+                if self.in_array and self.depth == 2 and self.item_parts is not None:
+                    items.append(self._item(''.join(self.item_parts) + data[item_start:pos],
+                                            self.item_bytes + pos - item_start))
+                    self.item_parts = None
+                    self.oversized_head = None
+                elif self.in_array and self.depth == 1:
+                    self.done = True
+
+        if self.in_string and self.key_parts is not None:
+            self.key_parts.append(data[string_start:])
+            if sum(len(part) for part in self.key_parts) > len(self.key):
+                # Not the key of the array
+                self.key_parts = None
+        if self.item_parts is not None:
+            self.item_bytes += len(data) - item_start
+            if self.oversized_head is None:
+                self.item_parts.append(data[item_start:])
+                if self.item_bytes > self.max_page_bytes > 0:
+                    self.oversized_head = ''.join(self.item_parts)[:4096]
+                    self.item_parts = []
+        return items
+
+    def _string_end(self, data, pos):
+        """
+        :return: `(end, pos)`, the index of the closing quote of the string and the index after it, or `-1` and the end
+            of `data` when the string goes on in the next chunk
+        """
+        # `str.find` scans far faster than a regex, quotes are only searched again after an escaped one
+        quote = data.find('"', pos)
+        while True:
+            backslash = data.find('\\', pos, quote if quote >= 0 else len(data))
+            if backslash < 0:
+                if quote < 0:
+                    return -1, len(data)
+                return quote, quote + 1
+            pos = backslash + 2
+            if pos > len(data):
+                self.escaped = True
+                return -1, len(data)
+            if quote >= 0 and pos > quote:
+                quote = data.find('"', pos)
+
+    def _item(self, raw, size):
+        if self.oversized_head is None and not size > self.max_page_bytes > 0:
+            return json.loads(raw)
+        match = _PAGE_URL.match(self.oversized_head or raw)
+        url = json.loads(match.group(1)) if match else None
+        return [url, {'ok': False, 'error': 'Page larger than %d bytes' % self.max_page_bytes, 'code': None}]
+
+    def close(self):
+        if not self.done:
+            raise ValueError('No complete `%s` array' % self.key)
+
+
+class BaseCrawlerClient(object):
+    """
+    Batching, retry and deadline rules shared by the blocking and the asynchronous crawler clients
+    """
+
+    def __init__(self, endpoint, batch_size=10, concurrency=4, timeout=120, retries=2, backoff=0.5,
+                 max_page_bytes=2 * 1024 * 1024, page_store=None):
+        """
+        :param batch_size: max number of urls per crawler call
+        :param concurrency: max number of concurrent crawler calls of one crawl
+        :param timeout: default deadline in seconds of a whole crawl
+        :param retries: number of retries of a failed batch
+        :param backoff: delay in seconds before the first retry, doubled before each next one
+        :param max_page_bytes: max size of a page in the crawler response, larger pages are returned as not ok
+        :param page_store: `PageStore` of the crawled pages, urls found in it are not crawled again
+        """
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_page_bytes = max_page_bytes
+        self.page_store = page_store
+        self.logger = get_logger(self.__class__.__name__)
+
+    def _split_batches(self, urls):
+        return [urls[i:i + self.batch_size] for i in range(0, len(urls), self.batch_size)]
+
+    @staticmethod
+    def _payload(urls, extractor, user_agent):
+        payload = {
+            'urls': ','.join(urls),
+            'extractor': extractor,
+            'cache': 1
+        }
+        if user_agent is not None:
+            payload['user_agent'] = user_agent
+        return payload
+
+    @staticmethod
+    def _merge_batches(batches, results):
+        pages = []
+        failed_batches = []
+        for batch, (batch_pages, error) in zip(batches, results):
+            if error is None:
+                pages.extend(batch_pages)
+            else:
+                failed_batches.append({'urls': batch, 'error': error})
+        return {'pages': pages, 'failed_batches': failed_batches}
+
+    def _stored_pages(self, urls, extractor):
+        """
+        :return: `(pages, urls)`, the `[url, page]` pairs found in the page store and the urls left to crawl
+        """
+        if self.page_store is None:
+            return [], urls
+        stored = self.page_store.get_pages(urls, extractor)
+        if stored:
+            self.logger.debug('%d of %d urls read from the page store' % (len(stored), len(urls)))
+        return [[url, stored[url]] for url in urls if url in stored], [url for url in urls if url not in stored]
+
+    def _store_pages(self, pages, extractor):
+        if self.page_store is not None and pages:
+            self.page_store.put_pages(pages, extractor)
+
+    @staticmethod
+    def _add_stored_pages(urls, stored, crawled):
+        # Pages in the order of the urls, as if all were crawled
+        if stored:
+            order = dict((url, i) for i, url in reversed(list(enumerate(urls))))
+            crawled['pages'] = sorted(stored + crawled['pages'], key=lambda page: order.get(page[0], len(urls)))
+        return crawled
+
+    def _should_retry(self, urls, attempt, transient, delay, deadline, error):
+        if not transient or attempt > self.retries or time.time() + delay >= deadline:
+            self.logger.warning('Crawl batch of %d urls failed after %d attempts: %s' % (len(urls), attempt, error))
+            return False
+        return True
+
+
+class CrawlerClient(BaseCrawlerClient):
+    """
+    Client of the crawler `/page/extract` api. Url lists are split into batches which are crawled concurrently over
+    one pooled session, transient failures are retried with exponential backoff, and every call is bounded by a
+    deadline. Pages of the batches which succeeded are returned even when other batches failed.
+
+    Responses are gzip compressed by the crawler when it supports it and parsed page by page as they are read, see
+    `PagesParser`. With a `page_store`, stored pages are not crawled again and crawled ones are stored.
+    """
+
+    def __init__(self, endpoint, batch_size=10, concurrency=4, timeout=120, retries=2, backoff=0.5,
+                 max_page_bytes=2 * 1024 * 1024, page_store=None):
+        BaseCrawlerClient.__init__(self, endpoint, batch_size, concurrency, timeout, retries, backoff, max_page_bytes,
+                                   page_store)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._pool = None
+
+    def _get_pool(self):
+        # Created on first use so that each forked gunicorn worker gets its own threads
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        return self._pool
+
+    def crawl(self, urls, extractor, user_agent=None, timeout=None):
+        """
+        :param urls: list of urls
+        :param timeout: deadline in seconds of the whole crawl, default is the client timeout
+        :return: dict of `pages`, the `[url, page]` pairs returned by the crawler, and `failed_batches`, the list of
+            `{'urls': [...], 'error': ...}` of the batches which could not be crawled
+        """
+        deadline = time.time() + (timeout or self.timeout)
+        stored, crawl_urls = self._stored_pages(urls, extractor)
+        batches = self._split_batches(crawl_urls)
+        if len(batches) > 1:
+            results = self._get_pool().map(lambda batch: self._crawl_batch(batch, extractor, user_agent, deadline),
+                                           batches, chunksize=1)
+        else:
+            results = [self._crawl_batch(batch, extractor, user_agent, deadline) for batch in batches]
+        crawled = self._merge_batches(batches, results)
+        self._store_pages(crawled['pages'], extractor)
+        return self._add_stored_pages(urls, stored, crawled)
+
+    def _crawl_batch(self, urls, extractor, user_agent, deadline):
+        payload = self._payload(urls, extractor, user_agent)
+        delay = self.backoff
+        attempt = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, 'Crawl deadline exceeded'
+            try:
+                response = self.session.post(url=self.endpoint, data=payload, timeout=remaining, stream=True,
+                                             headers={'Accept-Encoding': 'gzip'})
+                try:
+                    if response.ok:
+                        return self._read_pages(response, deadline), None
+                    error = 'Call crawler api error: %s - %s' % (response.status_code, response.reason)
+                    transient = response.status_code in RETRY_STATUS_CODES
+                finally:
+                    response.close()
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = 'Call crawler api error: %s' % e
+                transient = True
+            except ValueError as e:
+                return None, 'Invalid crawler response: %s' % e
+
+            attempt += 1
+            if not self._should_retry(urls, attempt, transient, delay, deadline, error):
+                return None, error
+            time.sleep(delay)
+            delay *= 2
+
+    def _read_pages(self, response, deadline):
+        parser = PagesParser(self.max_page_bytes)
+        pages = []
+        # Decompressed chunk by chunk
+        for chunk in response.iter_content(CHUNK_SIZE):
+            pages.extend(parser.feed(chunk))
+            if time.time() >= deadline:
+                raise requests.Timeout('Crawl deadline exceeded while reading the response')
+        parser.close()
+        return pages
+
+
+class AsyncCrawlerClient(BaseCrawlerClient):
+    """
+    Non blocking client of the crawler api for the tornado IOLoop, same batching, retry and deadline rules as
+    `CrawlerClient`. A worker waits on the crawler for many requests at once, `max_clients` bounds the number of
+    connections opened by the worker over all of them.
+    """
+
+    def __init__(self, endpoint, batch_size=10, concurrency=4, timeout=120, retries=2, backoff=0.5, max_clients=100,
+                 max_page_bytes=2 * 1024 * 1024, page_store=None, store_workers=2):
+        """
+        :param store_workers: number of threads reading and writing the page store off the IOLoop
+        """
+        BaseCrawlerClient.__init__(self, endpoint, batch_size, concurrency, timeout, retries, backoff, max_page_bytes,
+                                   page_store)
+        self.max_clients = max_clients
+        self.store_workers = store_workers
+        self._store_executor = None
+        self._pid = None
+
+    def _get_store_executor(self):
+        # Created on first use in each process, e.g. in every gunicorn worker forked after the import
+        if self._pid != os.getpid():
+            self._store_executor = ThreadPoolExecutor(max_workers=self.store_workers)
+            self._pid = os.getpid()
+        return self._store_executor
+
+    def _get_http_client(self):
+        # One client per IOLoop, `max_clients` only applies when it is first created
+        return AsyncHTTPClient(max_clients=self.max_clients)
+
+    @gen.coroutine
+    def crawl(self, urls, extractor, user_agent=None, timeout=None, on_batch=None, cancelled=None):
+        """
+        Coroutine, see `CrawlerClient.crawl`
+        :param on_batch: called with the `(urls, pages, error)` of each batch as soon as it is crawled, `pages` is
+            `None` when the batch failed. The pages found in the page store come first as one batch
+        :param cancelled: function returning `True` once the crawl is not needed any more, batches not started yet
+            are then skipped
+        """
+        deadline = time.time() + (timeout or self.timeout)
+        stored, crawl_urls = [], urls
+        if self.page_store is not None:
+            # SQLite reads and decompression of the stored pages run on the store threads
+            stored, crawl_urls = yield self._get_store_executor().submit(self._stored_pages, urls, extractor)
+        if stored and on_batch is not None:
+            on_batch([url for url, _ in stored], stored, None)
+        batches = self._split_batches(crawl_urls)
+        semaphore = Semaphore(self.concurrency)
+
+        @gen.coroutine
+        def crawl_batch(batch):
+            with (yield semaphore.acquire()):
+                if cancelled is not None and cancelled():
+                    raise gen.Return((None, 'Crawl cancelled'))
+                result = yield self._crawl_batch(batch, extractor, user_agent, deadline)
+            if self.page_store is not None and result[0]:
+                yield self._get_store_executor().submit(self._store_pages, result[0], extractor)
+            if on_batch is not None:
+                on_batch(batch, *result)
+            raise gen.Return(result)
+
+        results = yield [crawl_batch(batch) for batch in batches]
+        raise gen.Return(self._add_stored_pages(urls, stored, self._merge_batches(batches, results)))
+
+    @gen.coroutine
+    def _crawl_batch(self, urls, extractor, user_agent, deadline):
+        body = urllib.urlencode(self._payload(urls, extractor, user_agent))
+        delay = self.backoff
+        attempt = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise gen.Return((None, 'Crawl deadline exceeded'))
+            parser = PagesParser(self.max_page_bytes)
+            pages = []
+            errors = []
+
+            def on_chunk(chunk, parser=parser, pages=pages, errors=errors):
+                # Decompressed chunks, pages are decoded as they arrive instead of from the whole body
+                if not errors:
+                    try:
+                        pages.extend(parser.feed(chunk))
+                    except ValueError as e:
+                        errors.append(e)
+
+            request = HTTPRequest(self.endpoint, method='POST', body=body, request_timeout=remaining,
+                                  connect_timeout=remaining, decompress_response=True, streaming_callback=on_chunk)
+            response = yield self._get_http_client().fetch(request, raise_error=False)
+            if 200 <= response.code < 300:
+                try:
+                    if errors:
+                        raise errors[0]
+                    parser.close()
+                except ValueError as e:
+                    raise gen.Return((None, 'Invalid crawler response: %s' % e))
+                raise gen.Return((pages, None))
+            if response.code == 599:
+                # Connection error or timeout
+                error = 'Call crawler api error: %s' % response.error
+                transient = True
+            else:
+                error = 'Call crawler api error: %s - %s' % (response.code, response.reason)
+                transient = response.code in RETRY_STATUS_CODES
+
+            attempt += 1
+            if not self._should_retry(urls, attempt, transient, delay, deadline, error):
+                raise gen.Return((None, error))
+            yield gen.sleep(delay)
+            delay *= 2
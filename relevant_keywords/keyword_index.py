@@ -0,0 +1,376 @@
+"""
+Persistent corpus index per seed keyword, updated with the pages which changed since the last request.
+
+The pages analysed for a seed keyword (e.g. its top ranking urls) mostly stay the same from one request to the next.
+The index keeps in SQLite the ngram counts of every indexed page and, per term, its document frequency and total
+count over the corpus. Syncing it with the pages of a request only tokenizes and applies the pages which were added or
+removed (pages are identified by the sha1 of their url and raw content), and the `count` and `tfidf` top terms are
+read from the stored frequencies without tokenizing the unchanged pages again.
+
+The raw crawled pages are indexed, so that neither their order nor dedup change the indexed pages. The lines and
+pages removed by dedup, which depend on the other pages of the request, are applied to the frequencies at query time
+(see `dedup_adjustment`).
+
+Indexes are keyed by seed keyword, token filter, ngram range and `tfidf` view (see `TokenFilter`), and shared by all
+worker processes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from relevant_keywords.nlp.doc_term import smooth_idf
+from relevant_keywords.nlp.token_filter import DEFAULT_TOKEN_FILTER, get_token_filter
+from relevant_keywords.top_keyword import doc_count_bounds, iter_ngrams, no_stop_word_mask
+from relevant_keywords.util.log import get_logger
+
+
+def _utf8(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def doc_id(content, url=None):
+    return hashlib.sha1('%s\0%s' % (_utf8(url or ''), _utf8(content))).hexdigest()
+
+
+class KeywordIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = get_logger(self.__class__.__name__)
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _connect(self):
+        # Files and tables are created on first use, e.g. in each gunicorn worker after the fork, not at import
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    def _open(self):
+        # One connection per call, connections must not be shared between forked workers
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _init_db(self):
+        index_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        conn = self._open()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Rows of docs and terms refer to their index by integer id, shorter keys than the sha1 `key`
+            conn.execute('CREATE TABLE IF NOT EXISTS indexes '
+                         '(id INTEGER PRIMARY KEY, key TEXT UNIQUE, keyword TEXT, num_docs INTEGER, updated REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS docs '
+                         '(id INTEGER, doc_id TEXT, counts BLOB, added REAL, PRIMARY KEY (id, doc_id)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS terms '
+                         '(id INTEGER, term TEXT, df INTEGER, tf INTEGER, stop INTEGER, PRIMARY KEY (id, term)) '
+                         'WITHOUT ROWID')
+            # Top terms by total count, see `top_by_count` and `top_by_tfidf_score`
+            conn.execute('CREATE INDEX IF NOT EXISTS terms_tf ON terms (id, tf)')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(keyword, min_ngram=1, max_ngram=1, token_filter=DEFAULT_TOKEN_FILTER, tfidf=False):
+        return hashlib.sha1(('%s\0%s\0%d-%d%s' % (keyword, token_filter, min_ngram, max_ngram,
+                                                   '\0tfidf' if tfidf else '')).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def count_terms(content, min_ngram, max_ngram, tokenizer):
+        tokens = tokenizer.tokenize(content.lower())
+        return Counter(iter_ngrams(tokens, min_ngram, max_ngram))
+
+    def update(self, keyword, contents, min_ngram=1, max_ngram=1, token_filter=DEFAULT_TOKEN_FILTER, tfidf=False,
+               urls=None):
+        """
+        Sync the index of a seed keyword with the pages of a request: pages not indexed yet are added, indexed pages
+        which are not in `contents` any more are removed
+        :param contents: raw contents of the crawled pages, before dedup
+        :param tfidf: whether the stop words of the `tfidf` metric are removed from the tokens as well, see
+            `TokenFilter`
+        :param urls: url of each page, pages are identified by their content only when not given
+        :return: `(key, stats)`, the key of the index and the numbers of `docs`, `added` and `removed` pages
+        """
+        key = self.make_key(keyword, min_ngram, max_ngram, token_filter, tfidf)
+        token_filter = get_token_filter(token_filter)
+        tokenizer = token_filter.tfidf_tokenizer if tfidf else token_filter.tokenizer
+        docs = dict((doc_id(content, url), content) for content, url in zip(contents, urls or [None] * len(contents)))
+
+        # Pages are tokenized before the write lock is taken, the ones indexed meanwhile by another worker are skipped
+        conn = self._connect()
+        try:
+            known = self._doc_ids(conn, self._index_id(conn, key))
+        finally:
+            conn.close()
+        counts = dict((did, self.count_terms(content, min_ngram, max_ngram, tokenizer))
+                      for did, content in docs.iteritems() if did not in known)
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            index_id = self._index_id(conn, key, keyword)
+            known = self._doc_ids(conn, index_id)
+            added = [did for did in docs if did not in known]
+            removed = [did for did in known if did not in docs]
+            for did in added:
+                if did not in counts:
+                    counts[did] = self.count_terms(docs[did], min_ngram, max_ngram, tokenizer)
+            self._apply(conn, index_id, dict((did, counts[did]) for did in added), removed, token_filter)
+            self._set_num_docs(conn, index_id)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        if added or removed:
+            self.logger.debug('Index %s of `%s`: added %d, removed %d pages' % (key, keyword, len(added), len(removed)))
+        return key, {'docs': len(docs), 'added': len(added), 'removed': len(removed)}
+
+    def add(self, key, contents, min_ngram=1, max_ngram=1, token_filter=DEFAULT_TOKEN_FILTER, tfidf=False,
+            urls=None):
+        """
+        Add pages to the index `key` of `make_key`, already indexed pages are skipped
+        :return: ids of the added pages
+        """
+        token_filter = get_token_filter(token_filter)
+        tokenizer = token_filter.tfidf_tokenizer if tfidf else token_filter.tokenizer
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            index_id = self._index_id(conn, key, create=True)
+            known = self._doc_ids(conn, index_id)
+            docs = dict((doc_id(content, url), content)
+                        for content, url in zip(contents, urls or [None] * len(contents)))
+            counts = dict((did, self.count_terms(content, min_ngram, max_ngram, tokenizer))
+                          for did, content in docs.iteritems() if did not in known)
+            self._apply(conn, index_id, counts, [], token_filter)
+            self._set_num_docs(conn, index_id)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return sorted(counts)
+
+    def remove(self, key, doc_ids):
+        """
+        Remove pages by id from the index `key`, unknown ids are ignored
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            index_id = self._index_id(conn, key)
+            known = self._doc_ids(conn, index_id)
+            self._apply(conn, index_id, {}, [did for did in doc_ids if did in known], None)
+            if index_id is not None:
+                self._set_num_docs(conn, index_id)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _index_id(conn, key, keyword=None, create=False):
+        """
+        :param create: create the index if missing, also when a `keyword` is given
+        :return: id of the index, `None` if it does not exist
+        """
+        row = conn.execute('SELECT id FROM indexes WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create and keyword is None:
+            return None
+        return conn.execute('INSERT INTO indexes (key, keyword, num_docs, updated) VALUES (?, ?, 0, ?)',
+                            (key, keyword, time.time())).lastrowid
+
+    @staticmethod
+    def _doc_ids(conn, index_id):
+        return set(row[0] for row in conn.execute('SELECT doc_id FROM docs WHERE id = ?', (index_id,)))
+
+    @staticmethod
+    def _set_num_docs(conn, index_id):
+        conn.execute('UPDATE indexes SET num_docs = (SELECT COUNT(*) FROM docs WHERE id = ?), updated = ? '
+                     'WHERE id = ?', (index_id, time.time(), index_id))
+
+    def _apply(self, conn, index_id, added, removed, token_filter):
+        """
+        Add the term counts of the `added` pages and subtract the ones of the `removed` page ids, in one pass over
+        the distinct terms of these pages only
+        """
+        dfs = Counter()
+        tfs = Counter()
+        now = time.time()
+        for did, counts in added.iteritems():
+            for term, count in counts.iteritems():
+                dfs[term] += 1
+                tfs[term] += count
+            conn.execute('INSERT INTO docs VALUES (?, ?, ?, ?)',
+                         (index_id, did, sqlite3.Binary(zlib.compress(json.dumps(counts))), now))
+        for did in removed:
+            row = conn.execute('SELECT counts FROM docs WHERE id = ? AND doc_id = ?', (index_id, did)).fetchone()
+            for term, count in json.loads(zlib.decompress(row[0])).iteritems():
+                dfs[term] -= 1
+                tfs[term] -= count
+            conn.execute('DELETE FROM docs WHERE id = ? AND doc_id = ?', (index_id, did))
+        if not dfs:
+            return
+
+        terms = [term for term in dfs if dfs[term] or tfs[term]]
+        if added:
+            # Whether an ngram holds a stop word of the filter is only computed for its first page
+            stops = ~no_stop_word_mask(terms, token_filter.tfidf_stop_words)
+            conn.executemany('INSERT OR IGNORE INTO terms VALUES (?, ?, 0, 0, ?)',
+                             ((index_id, term, int(stop)) for term, stop in zip(terms, stops)))
+        conn.executemany('UPDATE terms SET df = df + ?, tf = tf + ? WHERE id = ? AND term = ?',
+                         ((dfs[term], tfs[term], index_id, term) for term in terms))
+        conn.executemany('DELETE FROM terms WHERE id = ? AND term = ? AND df <= 0',
+                         ((index_id, term) for term in terms if dfs[term] < 0))
+
+    def num_docs(self, key):
+        conn = self._connect()
+        try:
+            return self._num_docs(conn, key)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _num_docs(conn, key):
+        row = conn.execute('SELECT num_docs FROM indexes WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def dedup_adjustment(self, key, contents, deduped, min_ngram=1, max_ngram=1, token_filter=DEFAULT_TOKEN_FILTER,
+                         tfidf=False, urls=None):
+        """
+        Frequency changes of the index `key` synced with the raw `contents` once dedup removed their repeated lines
+        and duplicate pages, only the pages changed by dedup are tokenized
+        :param deduped: content of each page after dedup, `None` for a removed page, see `deduplicate_pages`
+        :return: dict of the change of `num_docs` and of the `(df, tf, stop)` changes of each changed term under
+            `terms`, `stop` tells whether the term holds a stop word of the filter
+        """
+        token_filter = get_token_filter(token_filter)
+        tokenizer = token_filter.tfidf_tokenizer if tfidf else token_filter.tokenizer
+        dfs = Counter()
+        tfs = Counter()
+        num_docs = 0
+        seen = set()
+        conn = self._connect()
+        try:
+            index_id = self._index_id(conn, key)
+            for content, page, url in zip(contents, deduped, urls or [None] * len(contents)):
+                did = doc_id(content, url)
+                # Pages repeated in a request are indexed once, dedup keeps their first occurrence
+                if did in seen:
+                    continue
+                seen.add(did)
+                if page == content:
+                    continue
+                row = conn.execute('SELECT counts FROM docs WHERE id = ? AND doc_id = ?', (index_id, did)).fetchone()
+                if row is None:
+                    # Removed meanwhile by the sync of another request
+                    continue
+                indexed = json.loads(zlib.decompress(row[0]))
+                if page is None:
+                    num_docs -= 1
+                    counts = {}
+                else:
+                    counts = self.count_terms(page, min_ngram, max_ngram, tokenizer)
+                for term in set(indexed).union(counts):
+                    count = counts.get(term, 0)
+                    indexed_count = indexed.get(term, 0)
+                    dfs[term] += (count > 0) - (indexed_count > 0)
+                    tfs[term] += count - indexed_count
+        finally:
+            conn.close()
+
+        terms = [term for term in dfs if dfs[term] or tfs[term]]
+        stops = ~no_stop_word_mask(terms, token_filter.tfidf_stop_words)
+        return {'num_docs': num_docs,
+                'terms': dict((term, (dfs[term], tfs[term], bool(stop))) for term, stop in zip(terms, stops))}
+
+    @staticmethod
+    def _adjusted_terms(conn, index_id, adjustment):
+        """
+        Frequencies of the terms changed by a `dedup_adjustment` as `{term: (df, tf, stop)}`, without the terms left
+        on no page
+        """
+        terms = {}
+        for term, (df, tf, stop) in adjustment['terms'].iteritems():
+            row = conn.execute('SELECT df, tf, stop FROM terms WHERE id = ? AND term = ?', (index_id, term)).fetchone()
+            if row is not None:
+                df, tf, stop = df + row[0], tf + row[1], bool(row[2])
+            if df > 0:
+                terms[term] = (df, tf, stop)
+        return terms
+
+    def top_by_count(self, key, top_n, adjustment=None):
+        """
+        Most frequent terms, same as `TopKeywords._get_top_by_count`
+        :param adjustment: `dedup_adjustment` of the pages of the request
+        """
+        changed = adjustment['terms'] if adjustment else {}
+        conn = self._connect()
+        try:
+            index_id = self._index_id(conn, key)
+            adjusted = self._adjusted_terms(conn, index_id, adjustment) if adjustment else {}
+            # The top unchanged terms are among the first rows, whatever the changed terms ahead of them
+            rows = [(term, tf) for term, tf in conn.execute('SELECT term, tf FROM terms WHERE id = ? '
+                                                            'ORDER BY tf DESC, term LIMIT ?',
+                                                            (index_id, top_n + len(changed)))
+                    if term not in changed]
+        finally:
+            conn.close()
+        rows.extend((term, tf) for term, (_, tf, _) in adjusted.iteritems())
+        return [term for term, _ in sorted(rows, key=lambda row: (-row[1], row[0]))[:top_n]]
+
+    def top_by_tfidf_score(self, key, top_n, min_df=0.3, max_df=0.9, max_voc=200, adjustment=None):
+        """
+        Same ranking as `TopKeywords._get_top_by_tfidf_score`, terms tied in frequency at the `max_voc` limit are
+        kept in alphabetical order
+        :param adjustment: `dedup_adjustment` of the pages of the request
+        """
+        changed = adjustment['terms'] if adjustment else {}
+        conn = self._connect()
+        try:
+            index_id = self._index_id(conn, key)
+            num_docs = self._num_docs(conn, key) + (adjustment['num_docs'] if adjustment else 0)
+            adjusted = self._adjusted_terms(conn, index_id, adjustment) if adjustment else {}
+            unchanged = conn.execute('SELECT term FROM terms WHERE id = ? AND stop = 0 LIMIT ?',
+                                     (index_id, len(changed) + 1))
+            if all(term in changed for term, in unchanged) and all(stop for _, _, stop in adjusted.itervalues()):
+                raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+            min_doc_count, max_doc_count = doc_count_bounds(min_df, max_df, num_docs)
+            rows = [row for row in conn.execute('SELECT term, df, tf FROM terms WHERE id = ? AND stop = 0 AND df >= ? '
+                                                'AND df <= ? ORDER BY tf DESC, term LIMIT ?',
+                                                (index_id, min_doc_count, max_doc_count, max_voc + len(changed)))
+                    if row[0] not in changed]
+        finally:
+            conn.close()
+        rows.extend((term, df, tf) for term, (df, tf, stop) in adjusted.iteritems()
+                    if not stop and min_doc_count <= df <= max_doc_count)
+        # Columns of the vocabulary in alphabetical order, as in the document-term matrix
+        rows = sorted((term, df) for term, df, _ in sorted(rows, key=lambda row: (-row[2], row[0]))[:max_voc])
+        if not rows:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        idf = smooth_idf(np.array([df for _, df in rows], dtype=np.int64), num_docs)
+        indices = np.argsort(idf)[::-1]
+        return [(rows[i][0], idf[i]) for i in indices[:top_n]]
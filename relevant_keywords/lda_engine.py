@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from relevant_keywords.util.log import get_logger
+
+MODEL_FILE = 'lda'
+DOCS_FILE = 'docs.json'
+KEY_LOCKS = 64
+
+
+def corpus_fingerprint(doc_term):
+    digest = hashlib.sha1()
+    for term in doc_term.terms:
+        digest.update(term.encode('utf-8'))
+        digest.update('\0')
+    matrix = doc_term.matrix
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def doc_fingerprints(doc_term):
+    # One fingerprint per document from its (term, count) pairs
+    matrix = doc_term.matrix
+    # Terms as strings once, so that fingerprints do not depend on how the terms are stored
+    terms = list(doc_term.terms)
+    fingerprints = []
+    for row in range(doc_term.num_docs):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        digest = hashlib.sha1()
+        for idx, count in zip(matrix.indices[start:end], matrix.data[start:end]):
+            digest.update(('%s\0%d\0' % (terms[idx], count)).encode('utf-8'))
+        fingerprints.append(digest.hexdigest())
+    return fingerprints
+
+
+class LdaEngine(object):
+    """
+    Train LDA models once and reuse them: models are cached in memory and on disk, keyed by a seed keyword or by the
+    fingerprint of the corpus. A cached model keyed by seed keyword is updated online with the documents it has not
+    seen yet, as long as they are mostly covered by its vocabulary, otherwise a new model is trained.
+    """
+
+    def __init__(self, model_dir=None, workers=0, passes=20, min_coverage=0.5, memory_cache_size=16):
+        """
+        :param model_dir: directory of persisted models, `None` keeps them in memory only
+        :param workers: number of `LdaMulticore` worker processes, less than `2` trains in the calling process
+        :param passes: default number of passes over a new corpus
+        :param min_coverage: min share of the new documents' term counts known by a cached model to update it
+        """
+        self.model_dir = model_dir
+        self.workers = workers
+        self.passes = passes
+        self.min_coverage = min_coverage
+        self.memory_cache_size = memory_cache_size
+        self.logger = get_logger(self.__class__.__name__)
+        self._models = OrderedDict()
+        # Threads of one worker share the engine, a model is trained or updated by one thread at a time
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCKS)]
+
+    def get_topics(self, doc_term, num_topics, key=None, passes=None, time_budget=None, doc_ids=None, stats=None):
+        """
+        :param key: seed keyword of the corpus, by default the corpus fingerprint
+        :param doc_ids: ids telling which documents a cached model has already seen, by default the fingerprints of
+            the rows of `doc_term`. Fingerprints of the documents before vocabulary filtering are more stable.
+        :param passes: max number of passes over the documents to train on
+        :param time_budget: max seconds of training, the number of passes is the one which fits at the duration of
+            the first pass, at least one pass is always done
+        :param stats: dict filled with the number of `passes` trained by this call and whether training was `stopped`
+            by the time budget
+        :return: topics as printed by `LdaModel.print_topics`
+        """
+        model_key = self._model_key(key if key is not None else corpus_fingerprint(doc_term), num_topics)
+        fingerprints = doc_ids if doc_ids is not None else doc_fingerprints(doc_term)
+        with self._key_lock(model_key):
+            return self._get_topics(model_key, doc_term, num_topics, fingerprints, passes, time_budget,
+                                    stats if stats is not None else {})
+
+    def _key_lock(self, model_key):
+        # Striped locks, models of different keys rarely wait for each other
+        return self._key_locks[int(model_key[:8], 16) % len(self._key_locks)]
+
+    def _get_topics(self, model_key, doc_term, num_topics, fingerprints, passes, time_budget, stats):
+        cached = self._get_cached(model_key)
+
+        stats.update(passes=0, stopped=False)
+        if cached is not None:
+            lda, seen_docs = cached
+            new_rows = [row for row, fp in enumerate(fingerprints) if fp not in seen_docs]
+            if not new_rows:
+                self.logger.debug('Reuse lda model %s' % model_key)
+                return [t[1] for t in lda.print_topics(num_topics=num_topics)]
+
+            corpus, coverage = self._map_corpus(doc_term, new_rows, lda.id2word)
+            if coverage >= self.min_coverage:
+                self.logger.debug('Update lda model %s with %d documents, coverage %.2f'
+                                  % (model_key, len(new_rows), coverage))
+                self._train(lda, corpus, passes, time_budget, stats)
+                seen_docs.update(fingerprints[row] for row in new_rows)
+                self._put_cached(model_key, lda, seen_docs)
+                return [t[1] for t in lda.print_topics(num_topics=num_topics)]
+
+        from gensim.matutils import Sparse2Corpus
+        from gensim.models import LdaModel, LdaMulticore
+
+        self.logger.debug('Train lda model %s on %d documents' % (model_key, doc_term.num_docs))
+        id2word = dict(enumerate(doc_term.terms))
+        corpus = list(Sparse2Corpus(doc_term.matrix, documents_columns=False))
+        if self.workers > 1:
+            lda = LdaMulticore(id2word=id2word, num_topics=num_topics, workers=self.workers, eval_every=None)
+        else:
+            lda = LdaModel(id2word=id2word, num_topics=num_topics, eval_every=None)
+        self._train(lda, corpus, passes, time_budget, stats)
+        self._put_cached(model_key, lda, set(fingerprints))
+        return [t[1] for t in lda.print_topics(num_topics=num_topics)]
+
+    def _train(self, lda, corpus, passes, time_budget, stats):
+        # Each update of `LdaMulticore` starts a pool of processes, the passes are run by at most two updates
+        passes = passes or self.passes
+        if time_budget is None:
+            self._update(lda, corpus, passes)
+            stats['passes'] = passes
+            return
+
+        start = time.time()
+        self._update(lda, corpus, 1)
+        pass_seconds = time.time() - start
+        # Passes which fit in the rest of the time budget at the duration of the first one
+        more = passes - 1
+        if pass_seconds > 0:
+            more = max(0, min(more, int((time_budget - pass_seconds) / pass_seconds)))
+        if more:
+            self._update(lda, corpus, more)
+        stats['passes'] = 1 + more
+        if 1 + more < passes:
+            self.logger.debug('Lda training stopped after %d of %d passes' % (1 + more, passes))
+            stats['stopped'] = True
+
+    @staticmethod
+    def _update(lda, corpus, passes):
+        # `LdaMulticore.update` reads the number of passes from the model, `LdaModel.update` defaults to it
+        lda.passes = passes
+        lda.update(corpus)
+
+    @staticmethod
+    def _map_corpus(doc_term, rows, id2word):
+        # Map documents onto the vocabulary of a cached model, unknown terms are dropped
+        term2id = dict((term, idx) for idx, term in id2word.iteritems())
+        model_ids = [term2id.get(term) for term in doc_term.terms]
+        matrix = doc_term.matrix
+        corpus = []
+        known = total = 0
+        for row in rows:
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            bow = []
+            for idx, count in zip(matrix.indices[start:end], matrix.data[start:end]):
+                total += count
+                if model_ids[idx] is not None:
+                    bow.append((model_ids[idx], count))
+                    known += count
+            corpus.append(bow)
+        return corpus, float(known) / total if total else 0.0
+
+    @staticmethod
+    def _model_key(key, num_topics):
+        return hashlib.sha1(('%s\0%d' % (key, num_topics)).encode('utf-8')).hexdigest()
+
+    def _get_cached(self, model_key):
+        with self._lock:
+            if model_key in self._models:
+                cached = self._models.pop(model_key)
+                self._models[model_key] = cached
+                return cached
+        if not self.model_dir:
+            return None
+
+        path = os.path.join(self.model_dir, model_key)
+        if not os.path.exists(os.path.join(path, DOCS_FILE)):
+            return None
+        from gensim.models import LdaModel
+        try:
+            lda = LdaModel.load(os.path.join(path, MODEL_FILE))
+            with open(os.path.join(path, DOCS_FILE)) as f:
+                seen_docs = set(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning('Load lda model %s error: %s' % (model_key, e))
+            return None
+        self._remember(model_key, lda, seen_docs)
+        return lda, seen_docs
+
+    def _put_cached(self, model_key, lda, seen_docs):
+        self._remember(model_key, lda, seen_docs)
+        if not self.model_dir:
+            return
+
+        # Write into a temporary directory first so that other workers never load a half written model
+        path = os.path.join(self.model_dir, model_key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        lda.save(os.path.join(tmp_path, MODEL_FILE))
+        with open(os.path.join(tmp_path, DOCS_FILE), 'w') as f:
+            json.dump(sorted(seen_docs), f)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError as e:
+            # Another worker saved the same model in between, its model is kept
+            self.logger.debug('Lda model %s saved by another worker: %s' % (model_key, e))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _remember(self, model_key, lda, seen_docs):
+        with self._lock:
+            self._models.pop(model_key, None)
+            self._models[model_key] = (lda, seen_docs)
+            while len(self._models) > self.memory_cache_size:
+                self._models.popitem(last=False)
@@ -1,5 +1,16 @@
+import os
+
 from app import app
 import api
+from async_api import make_app
+
+# Libraries of the metrics are imported on first use, `WARM_UP=1` imports them now. With gunicorn `--preload` the
+# master warms up once and forked workers share the loaded modules.
+if os.environ.get('WARM_UP'):
+    api.top_keyword.warm_up()
+
+# Served by the gunicorn tornado worker, `/keyword/top` is async, the other routes are served by the flask app
+async_app = make_app(app)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=7777)
@@ -0,0 +1,105 @@
+"""
+Near-duplicate pages and repeated blocks among the pages of one request, removed before scoring.
+
+Pages are compared by the SimHash of their word shingles: a page within `max_distance` bits of an earlier page is
+dropped. Extractors return text blocks (navigation, footer, paragraphs) as lines, a line found in at least
+`min_line_pages` pages (and `min_line_share` of the pages) is template text and only its first occurrence is kept, so
+that it neither costs tokenization again nor counts in the document frequency of its terms once per page. A line
+shared by fewer pages, e.g. a quote, is content and kept in every page.
+"""
+import numpy as np
+
+# Odd multiplier combining the word hashes of a shingle, arithmetic wraps modulo 2 ** 64
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def simhash(text, shingle_size=4):
+    """
+    64 bits SimHash of the word shingles of a text, near-duplicate texts differ in few bits
+    """
+    # `hash` of a string is stable within the process, fingerprints are only compared within one request
+    words = np.array([hash(word) for word in text.lower().split()] or [0], dtype=np.int64).view(np.uint64)
+    num_shingles = max(1, len(words) - shingle_size + 1)
+    hashes = words[:num_shingles].copy()
+    with np.errstate(over='ignore'):
+        for i in range(1, min(shingle_size, len(words))):
+            hashes = hashes * _SHINGLE_MULTIPLIER + words[i:i + num_shingles]
+    counts = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=0, dtype=np.int64)
+    return np.packbits(counts * 2 > num_shingles).view(np.uint64)[0]
+
+
+def hamming_distances(fingerprint, fingerprints):
+    xor = np.bitwise_xor(np.asarray(fingerprints, dtype=np.uint64), fingerprint)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def _byte_length(text):
+    return len(text.encode('utf-8')) if isinstance(text, unicode) else len(text)
+
+
+def _line_key(line):
+    return hash(u' '.join(line.lower().split()))
+
+
+def deduplicate(contents, max_distance=3, shingle_size=4, min_line_pages=3, min_line_share=0.0):
+    """
+    :param max_distance: max number of different SimHash bits of near-duplicate pages, `-1` keeps all pages
+    :param min_line_pages: min number of the remaining pages holding a line for it to be template text
+    :param min_line_share: min proportion of the remaining pages holding a line for it to be template text
+    :return: `(contents, stats)`, the remaining contents in their order and the counts of `duplicate_pages`,
+        `repeated_lines` and `removed_bytes`, pages left with only repeated lines are duplicate pages
+    """
+    pages, stats = deduplicate_pages(contents, max_distance, shingle_size, min_line_pages, min_line_share)
+    return [content for content in pages if content is not None], stats
+
+
+def deduplicate_pages(contents, max_distance=3, shingle_size=4, min_line_pages=3, min_line_share=0.0):
+    """
+    Same as `deduplicate`, the result has one item per page of `contents`
+    :return: `(pages, stats)`, the content of each page without its repeated lines, `None` for a duplicate page
+    """
+    stats = {'input_pages': len(contents), 'duplicate_pages': 0, 'repeated_lines': 0, 'removed_bytes': 0}
+
+    result = [None] * len(contents)
+    pages = []
+    fingerprints = []
+    for position, content in enumerate(contents):
+        if max_distance >= 0:
+            fingerprint = simhash(content, shingle_size)
+            if fingerprints and hamming_distances(fingerprint, fingerprints).min() <= max_distance:
+                stats['duplicate_pages'] += 1
+                stats['removed_bytes'] += _byte_length(content)
+                continue
+            fingerprints.append(fingerprint)
+        pages.append((position, content))
+
+    # Number of pages holding each line, and the first of them
+    line_pages = {}
+    page_lines = []
+    for index, (_, content) in enumerate(pages):
+        keys = [_line_key(line) for line in content.splitlines()]
+        page_lines.append(keys)
+        for key in set(keys):
+            first, count = line_pages.get(key, (index, 0))
+            line_pages[key] = first, count + 1
+    min_pages = max(min_line_pages, min_line_share * len(pages))
+
+    for index, (position, content) in enumerate(pages):
+        lines = content.splitlines()
+        kept = []
+        for line, key in zip(lines, page_lines[index]):
+            first, count = line_pages[key]
+            # Repeats within a page are kept, only blocks of earlier pages are template text
+            if first != index and count >= min_pages and line.strip():
+                stats['repeated_lines'] += 1
+                stats['removed_bytes'] += _byte_length(line) + 1
+            else:
+                kept.append(line)
+        if len(kept) == len(lines):
+            result[position] = content
+        elif any(line.strip() for line in kept):
+            result[position] = u'\n'.join(kept)
+        else:
+            # Only blocks of earlier pages
+            stats['duplicate_pages'] += 1
+    return result, stats
@@ -0,0 +1,175 @@
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+from relevant_keywords.nlp.ngrams import NgramTerms, can_pack, intern_documents, pack_frequent_ngrams, pack_ngrams
+
+
+class DocTermMatrix(object):
+    """
+    Sparse document-term count matrix with its vocabulary, terms are sorted alphabetically like sklearn vectorizers
+    """
+
+    def __init__(self, matrix, terms):
+        self.matrix = matrix
+        self.terms = terms
+
+    @classmethod
+    def from_documents(cls, docs):
+        """
+        Build the matrix from documents given as lists of terms
+        """
+        vocabulary = {}
+        indices = array('i')
+        values = array('i')
+        indptr = array('i', [0])
+        for doc in docs:
+            term_count = {}
+            for term in doc:
+                idx = vocabulary.get(term)
+                if idx is None:
+                    idx = vocabulary[term] = len(vocabulary)
+                term_count[idx] = term_count.get(idx, 0) + 1
+            indices.extend(term_count.keys())
+            values.extend(term_count.values())
+            indptr.append(len(indices))
+
+        terms = sorted(vocabulary)
+        new_ids = np.empty(len(terms), dtype=np.int32)
+        for new_id, term in enumerate(terms):
+            new_ids[vocabulary[term]] = new_id
+
+        matrix = sp.csr_matrix((np.frombuffer(values, dtype=np.int32),
+                                new_ids[np.frombuffer(indices, dtype=np.int32)],
+                                np.frombuffer(indptr, dtype=np.int32)),
+                               shape=(len(indptr) - 1, len(terms)), dtype=np.int64)
+        matrix.sort_indices()
+        return cls(matrix, terms)
+
+    @classmethod
+    def from_token_documents(cls, token_docs, min_ngram=1, max_ngram=1, min_doc_count=None):
+        """
+        Build the matrix of the ngrams of documents given as lists of tokens, same matrix as `from_documents` of their
+        `generate_ngram` strings. Ngrams are counted as packed integer keys and `terms` is a `NgramTerms`, only the
+        terms which are read are turned into strings.
+        :param min_doc_count: the ngrams longer than `min_ngram` in fewer documents may be left out, see
+            `pack_frequent_ngrams`, the columns of the other terms are the same as in the full matrix
+        """
+        tokens, docs = intern_documents(token_docs)
+        return cls.from_interned(tokens, docs, min_ngram, max_ngram, min_doc_count)
+
+    @classmethod
+    def from_interned(cls, tokens, docs, min_ngram=1, max_ngram=1, min_doc_count=None):
+        """
+        Same as `from_token_documents` of documents already interned by `intern_documents`
+        """
+        if not can_pack(len(tokens), max_ngram):
+            return cls.from_documents([[' '.join(tokens[i] for i in ids[start:start + n])
+                                        for n in range(min_ngram, max_ngram + 1)
+                                        for start in range(len(ids) - n + 1)] for ids in docs])
+
+        if min_doc_count is not None and min_doc_count > 1 and max_ngram > min_ngram:
+            rows, all_keys, _ = pack_frequent_ngrams(docs, min_ngram, max_ngram, min_doc_count)
+        else:
+            doc_keys = [pack_ngrams(ids, min_ngram, max_ngram) for ids in docs]
+            lengths = np.array([len(keys) for keys in doc_keys], dtype=np.int64)
+            all_keys = np.concatenate(doc_keys) if doc_keys else np.empty(0, dtype=np.int64)
+            del doc_keys
+            rows = np.repeat(np.arange(len(docs), dtype=np.int32), lengths)
+        keys, columns = np.unique(all_keys, return_inverse=True)
+        del all_keys
+        matrix = sp.csr_matrix((np.ones(len(columns), dtype=np.int64), (rows, columns.astype(np.int32))),
+                               shape=(len(docs), len(keys)))
+        matrix.sum_duplicates()
+        return cls(matrix, NgramTerms(keys, tokens, max_ngram))
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        Stack the matrices of consecutive document shards into one, same result as building it from all documents
+        """
+        if parts and all(isinstance(part.terms, NgramTerms) for part in parts):
+            terms, column_maps = NgramTerms.union([part.terms for part in parts])
+        else:
+            terms = sorted(set().union(*(part.terms for part in parts)))
+            term_ids = dict((term, idx) for idx, term in enumerate(terms))
+            column_maps = [np.array([term_ids[term] for term in part.terms], dtype=np.int32) for part in parts]
+        matrices = []
+        for part, new_ids in zip(parts, column_maps):
+            matrix = part.matrix
+            matrices.append(sp.csr_matrix((matrix.data, new_ids[matrix.indices], matrix.indptr),
+                                          shape=(matrix.shape[0], len(terms))))
+        matrix = sp.vstack(matrices, format='csr') if matrices else sp.csr_matrix((0, 0), dtype=np.int64)
+        matrix.sort_indices()
+        return cls(matrix, terms)
+
+    @property
+    def num_docs(self):
+        return self.matrix.shape[0]
+
+    @property
+    def num_terms(self):
+        return self.matrix.shape[1]
+
+    def document_frequency(self):
+        return np.bincount(self.matrix.indices, minlength=self.num_terms)
+
+    def term_frequency(self):
+        return np.asarray(self.matrix.sum(axis=0)).ravel()
+
+    def select(self, mask):
+        """
+        Keep only the terms of a boolean mask, term order is preserved
+        """
+        kept_indices = np.where(mask)[0]
+        if isinstance(self.terms, NgramTerms):
+            return DocTermMatrix(self.matrix[:, kept_indices], self.terms.take(kept_indices))
+        return DocTermMatrix(self.matrix[:, kept_indices], [self.terms[i] for i in kept_indices])
+
+    def limit_features(self, high=None, low=None, limit=None):
+        """
+        Remove terms with document frequency higher than `high` or lower than `low`, then keep at most the `limit`
+        most frequent ones, same as `CountVectorizer._limit_features`
+        """
+        dfs = self.document_frequency()
+        mask = np.ones(len(dfs), dtype=bool)
+        if high is not None:
+            mask &= dfs <= high
+        if low is not None:
+            mask &= dfs >= low
+        if limit is not None and mask.sum() > limit:
+            tfs = self.term_frequency()
+            mask_inds = (-tfs[mask]).argsort()[:limit]
+            new_mask = np.zeros(len(dfs), dtype=bool)
+            new_mask[np.where(mask)[0][mask_inds]] = True
+            mask = new_mask
+        return self.select(mask)
+
+
+def smooth_idf(dfs, num_docs):
+    # Same as `TfidfTransformer(smooth_idf=True).idf_`
+    return np.log(float(num_docs + 1) / (dfs + 1)) + 1
+
+
+def tfidf_weight_sums(matrix, idf):
+    """
+    Sum over documents of the l2 normalized tf-idf weights of each column, same weights as `TfidfTransformer`
+    """
+    weights = matrix.astype(np.float64)
+    weights.data *= idf[weights.indices]
+    norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    weights.data /= np.repeat(norms, np.diff(weights.indptr))
+    return np.asarray(weights.sum(axis=0)).ravel()
+
+
+def top_indices(scores, n):
+    """
+    Indices of the `n` highest scores in decreasing order, without sorting all of them
+    """
+    if n < len(scores):
+        indices = np.argpartition(-scores, n)[:n]
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind='mergesort')]
@@ -0,0 +1,219 @@
+"""
+Ngrams as packed integer keys instead of joined strings.
+
+Tokens are interned to their rank in the sorted token vocabulary, and an ngram of at most `max_ngram` tokens is
+packed into one int64, first token in the highest bits and `0` in the slots after its last token. Tokens never contain
+a space (or anything sorting before it), so the order of the keys is the alphabetical order of the joined ngram
+strings, and matrices built from keys have the same columns as the ones built from strings. Ngrams are turned back
+into text only when a term is read.
+"""
+from array import array
+
+import numpy as np
+
+KEY_BITS = 63
+
+
+def slot_bits(max_ngram):
+    return KEY_BITS // max_ngram
+
+
+def can_pack(num_tokens, max_ngram):
+    # Slot value `0` means no token, ids are shifted by one
+    return num_tokens < (1 << slot_bits(max_ngram)) - 1
+
+
+def intern_documents(token_docs):
+    """
+    :param token_docs: iterable of lists of tokens
+    :return: `(tokens, docs)`, the sorted token vocabulary and one int64 array of token ranks per document
+    """
+    token_ids = {}
+    docs = []
+    for tokens in token_docs:
+        ids = array('i')
+        for token in tokens:
+            idx = token_ids.get(token)
+            if idx is None:
+                idx = token_ids[token] = len(token_ids)
+            ids.append(idx)
+        docs.append(ids)
+
+    tokens = sorted(token_ids)
+    ranks = np.empty(len(tokens), dtype=np.int64)
+    for rank, token in enumerate(tokens):
+        ranks[token_ids[token]] = rank
+    return tokens, [ranks[np.frombuffer(ids, dtype=np.int32)] if len(ids) else np.empty(0, dtype=np.int64)
+                    for ids in docs]
+
+
+def merge_interned(parts):
+    """
+    Join the interned documents of consecutive shards, same result as interning all documents at once
+    :param parts: `(tokens, docs)` of each shard, as returned by `intern_documents`
+    """
+    tokens = sorted(set().union(*(part_tokens for part_tokens, _ in parts)))
+    token_ranks = dict((token, rank) for rank, token in enumerate(tokens))
+    docs = []
+    for part_tokens, part_docs in parts:
+        new_ranks = np.array([token_ranks[token] for token in part_tokens], dtype=np.int64)
+        docs.extend(new_ranks[ids] for ids in part_docs)
+    return tokens, docs
+
+
+def pack_ngrams(ids, min_ngram, max_ngram):
+    """
+    Packed keys of all ngrams of a document given as an array of token ranks, same order as `generate_ngram`
+    """
+    bits = slot_bits(max_ngram)
+    slots = ids + 1
+    keys = []
+    for n in range(min_ngram, max_ngram + 1):
+        length = len(slots) - n + 1
+        if length <= 0:
+            continue
+        packed = slots[:length] << (bits * (max_ngram - 1))
+        for i in range(1, n):
+            packed |= slots[i:i + length] << (bits * (max_ngram - 1 - i))
+        keys.append(packed)
+    return np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+
+
+def pack_frequent_ngrams(docs, min_ngram, max_ngram, min_doc_count):
+    """
+    Packed keys of the ngrams of documents pruned level by level, Apriori style: all ngrams of `min_ngram` tokens,
+    then only the longer ngrams in at least `min_doc_count` documents. An ngram is in no more documents than its
+    prefix and its suffix, the ngrams one token shorter, so it is only packed and counted where both of them are in
+    enough documents.
+    :param docs: arrays of token ranks of the documents
+    :return: `(rows, keys, candidates)`, the document and the key of each ngram occurrence which is kept, same as
+        `pack_ngrams` of each document without the pruned longer ngrams, and the number of occurrences counted
+    """
+    bits = slot_bits(max_ngram)
+    lengths = np.array([len(ids) for ids in docs], dtype=np.int64)
+    # Documents joined with an empty slot after each one, the ngrams across two documents hold an empty slot
+    slots = np.zeros(lengths.sum() + len(docs), dtype=np.int64)
+    doc_rows = np.repeat(np.arange(len(docs), dtype=np.int32), lengths + 1)
+    ends = np.cumsum(lengths + 1)
+    for ids, end in zip(docs, ends):
+        slots[end - len(ids) - 1:end - 1] = ids + 1
+    empty_before = np.concatenate([[0], np.cumsum(slots == 0)])
+
+    kept_rows = []
+    kept_keys = []
+    candidates = 0
+    # Whether the ngram of the previous level starting at each position is in enough documents
+    frequent = None
+    for n in range(min_ngram, max_ngram + 1):
+        length = len(slots) - n + 1
+        if length <= 0:
+            break
+        if frequent is None:
+            starts = np.flatnonzero(empty_before[n:] == empty_before[:length])
+        else:
+            starts = np.flatnonzero(frequent[:-1] & frequent[1:])
+        keys = slots[starts] << (bits * (max_ngram - 1))
+        for k in range(1, n):
+            keys |= slots[starts + k] << (bits * (max_ngram - 1 - k))
+        rows = doc_rows[starts]
+        candidates += len(keys)
+
+        # Document frequency of the counted ngrams, from their distinct `(row, ngram)` pairs
+        if n == 1:
+            # Unigram keys stand for their token rank
+            labels, num_labels = slots[starts] - 1, int(slots.max()) if len(slots) else 0
+        else:
+            unique_keys, labels = np.unique(keys, return_inverse=True)
+            num_labels = len(unique_keys)
+        pairs = np.unique(rows.astype(np.int64) * num_labels + labels)
+        dfs = np.bincount(pairs % num_labels, minlength=num_labels) if num_labels else np.empty(0, dtype=np.int64)
+        is_frequent = dfs[labels] >= min_doc_count
+
+        frequent = np.zeros(length, dtype=bool)
+        frequent[starts[is_frequent]] = True
+        if n == min_ngram:
+            kept_rows.append(rows)
+            kept_keys.append(keys)
+        else:
+            kept_rows.append(rows[is_frequent])
+            kept_keys.append(keys[is_frequent])
+    if not kept_keys:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), candidates
+    return np.concatenate(kept_rows), np.concatenate(kept_keys), candidates
+
+
+class NgramTerms(object):
+    """
+    Sorted packed ngram keys with their token vocabulary, a read only sequence of the ngram strings
+    """
+
+    def __init__(self, keys, tokens, max_ngram):
+        self.keys = keys
+        self.tokens = tokens
+        self.max_ngram = max_ngram
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        return self.decode(int(self.keys[idx]))
+
+    def __iter__(self):
+        for key in self.keys.tolist():
+            yield self.decode(key)
+
+    def decode(self, key):
+        bits = slot_bits(self.max_ngram)
+        mask = (1 << bits) - 1
+        words = []
+        for i in range(self.max_ngram - 1, -1, -1):
+            slot = (key >> (bits * i)) & mask
+            if not slot:
+                break
+            words.append(self.tokens[slot - 1])
+        return ' '.join(words)
+
+    def slots(self):
+        """
+        Token ranks of each ngram, one array per position, `-1` after the last token
+        """
+        bits = slot_bits(self.max_ngram)
+        mask = (1 << bits) - 1
+        return [((self.keys >> (bits * i)) & mask) - 1 for i in range(self.max_ngram - 1, -1, -1)]
+
+    def take(self, indices):
+        return NgramTerms(self.keys[indices], self.tokens, self.max_ngram)
+
+    def without_tokens(self, predicate):
+        """
+        Boolean mask of the ngrams which have no token matching `predicate`, evaluated once per distinct token
+        """
+        flagged = np.array([bool(predicate(token)) for token in self.tokens] + [False], dtype=bool)
+        mask = np.ones(len(self.keys), dtype=bool)
+        for ranks in self.slots():
+            # Rank `-1` reads the trailing `False`
+            mask &= ~flagged[ranks]
+        return mask
+
+    @classmethod
+    def union(cls, parts):
+        """
+        Merge the terms of several vocabularies
+        :return: `(terms, column_maps)`, the merged terms and for each part the new column of each of its terms
+        """
+        max_ngram = parts[0].max_ngram
+        tokens = sorted(set().union(*(part.tokens for part in parts)))
+        if not can_pack(len(tokens), max_ngram):
+            raise ValueError('Too many distinct tokens to pack %d-grams' % max_ngram)
+        token_ranks = dict((token, rank) for rank, token in enumerate(tokens))
+        bits = slot_bits(max_ngram)
+        part_keys = []
+        for part in parts:
+            # Rank `-1` of the empty slots maps to the trailing `-1`
+            new_ranks = np.array([token_ranks[token] for token in part.tokens] + [-1], dtype=np.int64)
+            keys = np.zeros(len(part.keys), dtype=np.int64)
+            for i, ranks in enumerate(part.slots()):
+                keys |= (new_ranks[ranks] + 1) << (bits * (max_ngram - 1 - i))
+            part_keys.append(keys)
+        keys = np.unique(np.concatenate(part_keys)) if part_keys else np.empty(0, dtype=np.int64)
+        return cls(keys, tokens, max_ngram), [np.searchsorted(keys, part).astype(np.int32) for part in part_keys]
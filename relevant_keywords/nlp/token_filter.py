@@ -0,0 +1,99 @@
+"""
+Token filters: stop word lists, length and number rules applied by the tokenizer in one pass over the pages.
+
+A filter is selected by name per request. Filters are built on first use and then shared by all requests of the
+process, nltk and sklearn are only imported by the filters using their lists.
+"""
+import threading
+
+from relevant_keywords.nlp.tokenizer import KeywordTokenizer
+
+BASE_STOP_WORDS = frozenset(
+    "a,about,above,after,again,against,all,am,an,and,any,are,aren't,as,at,be,because,been,before,being,below," \
+    "between,both,but,by,can't,cannot,could,couldn't,did,didn't,do,does,doesn't,doing,don't,down,during,each," \
+    "few,for,from,further,had,hadn't,has,hasn't,have,haven't,having,he,he'd,he'll,he's,her,here,here's,hers," \
+    "herself,him,himself,his,how,how's,i,i'd,i'll,i'm,i've,if,in,into,is,isn't,it,it's,its,itself,let's,me," \
+    "more,most,mustn't,my,myself,no,nor,not,of,off,on,once,only,or,other,ought,our,ours,out,over,own,same," \
+    "shan't,she,she'd,she'll,she's,should,shouldn't,so,some,such,than,that,that's,the,their,theirs,them," \
+    "themselves,then,there,there's,these,they,they'd,they'll,they're,they've,this,those,through,to,too," \
+    "under,until,up,very,was,wasn't,we,we'd,we'll,we're,we've,were,weren't,what,what's,when,when's,where," \
+    "where's,which,while,who,who's,whom,why,why's,with,won't,would,wouldn't,you,you'd,you'll,you're,you've," \
+    "your,yours,yourself,yourselves,ourselves".split(','))
+
+# Words of page markup and boilerplate
+WEB_STOP_WORDS = frozenset([
+    'www', 'http', 'https', 'href', 'links', 'link', 'copyright', 'style', 'function', 'tags', 'corporate', 'sort',
+    'details', 'detail', 'comment', 'comments', 'reviews', 'review', 'icon', 'footer', 'body', 'begin', 'data',
+    'stylesheet', 'javascript', 'html', 'font', 'display'])
+ADDITIONAL_STOP_WORDS = WEB_STOP_WORDS
+
+URL_STOP_WORDS = frozenset({'http', 'com', 'https', 'www'})
+
+# Same set as the former `top_keyword.STOP_WORDS`
+STOP_WORDS = BASE_STOP_WORDS | WEB_STOP_WORDS
+
+
+def nltk_stop_words():
+    import nltk
+    return frozenset(nltk.corpus.stopwords.words('english'))
+
+
+def english_stop_words():
+    # Stop words of `TfidfVectorizer(stop_words='english')`
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    return ENGLISH_STOP_WORDS
+
+
+class TokenFilter(object):
+    """
+    Stop words and min token length of the tokenizer, plus the words only removed from the tokens of the `tfidf`
+    metric (sklearn's `stop_words='english'` of the former `TfidfVectorizer`, which dropped them from the tokens
+    before building the ngrams, while `count` and `lda` kept them)
+    """
+
+    def __init__(self, name, stop_words, min_length=4, tfidf_stop_words=frozenset()):
+        self.name = name
+        self.stop_words = frozenset(stop_words)
+        self.min_length = min_length
+        self.tfidf_stop_words = frozenset(tfidf_stop_words) - self.stop_words
+        self.tokenizer = KeywordTokenizer(self.stop_words, min_length)
+        self.tfidf_tokenizer = KeywordTokenizer(self.stop_words | self.tfidf_stop_words, min_length) \
+            if self.tfidf_stop_words else self.tokenizer
+
+    def __contains__(self, word):
+        return word in self.stop_words
+
+    def is_valid(self, word):
+        return len(word) >= self.min_length and word not in self.stop_words
+
+
+DEFAULT_TOKEN_FILTER = 'default'
+
+# Name: function returning the args of the filter, called once per process
+TOKEN_FILTERS = {
+    # Rules of the former `top_keyword.tokenize` for all metrics, `tfidf` also removes the stop words of the former
+    # `TfidfVectorizer(stop_words='english')` before building its ngrams, as the vectorizer did
+    DEFAULT_TOKEN_FILTER: lambda: dict(stop_words=STOP_WORDS, min_length=4, tfidf_stop_words=english_stop_words()),
+    # sklearn's English stop words are removed for all metrics, `count` and `lda` ngrams may span a removed word
+    'english': lambda: dict(stop_words=STOP_WORDS | english_stop_words(), min_length=4),
+    # Rules of the offline keyword scripts
+    'nltk': lambda: dict(stop_words=BASE_STOP_WORDS | URL_STOP_WORDS | nltk_stop_words(), min_length=3),
+}
+
+_token_filters = {}
+_token_filters_lock = threading.Lock()
+
+
+def get_token_filter(name=DEFAULT_TOKEN_FILTER):
+    with _token_filters_lock:
+        token_filter = _token_filters.get(name)
+        if token_filter is None:
+            if name not in TOKEN_FILTERS:
+                raise RuntimeError('Token filter `%s` is not supported, accepted are %s' %
+                                   (name, get_supported_token_filters()))
+            token_filter = _token_filters[name] = TokenFilter(name, **TOKEN_FILTERS[name]())
+        return token_filter
+
+
+def get_supported_token_filters():
+    return ', '.join('`%s`' % name for name in sorted(TOKEN_FILTERS))
@@ -1,7 +1,7 @@
 # coding=utf-8
+import re
 import string
 from abc import ABCMeta, abstractmethod
-from nltk import wordpunct_tokenize, WhitespaceTokenizer
 
 
 class Tokenizer(object):
@@ -15,6 +15,8 @@ class Tokenizer(object):
 class GeneralTokenizer(Tokenizer):
 
     def __init__(self):
+        # nltk is slow to import, only the offline scripts use this tokenizer
+        from nltk import WhitespaceTokenizer
         self.tokenizer = WhitespaceTokenizer()
 
     def normalize(self, text):
@@ -36,3 +38,50 @@ class GeneralTokenizer(Tokenizer):
             if word and word.strip():
                 result.append(word)
         return result
+
+
+class KeywordTokenizer(Tokenizer):
+    """
+    Single pass tokenizer with the same filtering rules as `top_keyword.tokenize`: a raw token is dropped when it
+    looks like markup (`<...`, `...>`, `[...`, `...]`), is too short or is a stop word, otherwise its word pieces
+    are kept when they are long enough, are not stop words and are not numbers.
+    """
+    # `top_keyword.clean_token` replaces `[\W\-]` by spaces, so the pieces of a token are its `\w+` runs
+    WORD_PATTERN = re.compile(r'\w+')
+    # Pieces only hold word characters, so these are the only forms `float()` accepts
+    NUMBER_PATTERN = re.compile(r'(?:\d+(?:e\d+)?|nan|inf|infinity)$', re.IGNORECASE)
+
+    def __init__(self, stop_words=(), min_length=4):
+        self.stop_words = frozenset(stop_words)
+        self.min_length = min_length
+
+    def tokenize(self, text):
+        return self._tokenize(text, {})
+
+    def tokenize_documents(self, texts, lowercase=False):
+        """
+        Tokenize a batch of documents, sharing the per raw token cache across the whole batch
+        """
+        cache = {}
+        return [self._tokenize(text.lower() if lowercase else text, cache) for text in texts]
+
+    def _tokenize(self, text, cache):
+        result = []
+        extend = result.extend
+        get_cached = cache.get
+        for token in text.split():
+            words = get_cached(token)
+            if words is None:
+                words = cache[token] = self._token_words(token)
+            if words:
+                extend(words)
+        return result
+
+    def _token_words(self, token):
+        stop_words = self.stop_words
+        min_length = self.min_length
+        if len(token) < min_length or token[0] in '<[' or token[-1] in '>]' or token in stop_words:
+            return ()
+        is_number = self.NUMBER_PATTERN.match
+        return tuple(w for w in self.WORD_PATTERN.findall(token)
+                     if len(w) >= min_length and w not in stop_words and not is_number(w))
@@ -0,0 +1,100 @@
+import heapq
+
+
+def _rank_key(item):
+    # Highest count first, ties in alphabetical order like the matrix based ranking
+    return -item[1], item[0]
+
+
+class ExactCounter(object):
+    """
+    Exact term counter, keeps one entry per distinct term but selects the top terms with a heap
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def update(self, terms):
+        counts = self.counts
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+            self.total += 1
+
+    def top(self, n):
+        """
+        :return: list of `(term, count, error)`, error is always `0`
+        """
+        return [(term, count, 0) for term, count in heapq.nsmallest(n, self.counts.iteritems(), key=_rank_key)]
+
+    def max_error(self):
+        return 0
+
+
+class SpaceSavingCounter(object):
+    """
+    Approximate term counter with at most `capacity` counters (Metwally et al., Space-Saving). When a new term arrives
+    and all counters are taken, the smallest counter is given to it. A reported count is never lower than the true
+    count and overestimates it by at most its `error`, which is bounded by `total / capacity`.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Counter capacity must be positive, got %s' % capacity)
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # (count, term) entries ordered by count, outdated ones are skipped when popping
+        self._heap = []
+
+    def update(self, terms):
+        term_counts = {}
+        for term in terms:
+            term_counts[term] = term_counts.get(term, 0) + 1
+        for term, count in term_counts.iteritems():
+            self.add(term, count)
+
+    def add(self, term, count=1):
+        counts = self.counts
+        self.total += count
+        if term in counts:
+            counts[term] += count
+        elif len(counts) < self.capacity:
+            counts[term] = count
+            self.errors[term] = 0
+        else:
+            min_count, min_term = self._pop_min()
+            del counts[min_term]
+            del self.errors[min_term]
+            counts[term] = min_count + count
+            self.errors[term] = min_count
+
+        heapq.heappush(self._heap, (counts[term], term))
+        if len(self._heap) > 2 * self.capacity:
+            self._heap = [(c, t) for t, c in counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, term = heapq.heappop(self._heap)
+            if self.counts.get(term) == count:
+                return count, term
+
+    def top(self, n):
+        """
+        :return: list of `(term, count, error)`, the true count of a term is within `[count - error, count]`
+        """
+        errors = self.errors
+        return [(term, count, errors[term])
+                for term, count in heapq.nsmallest(n, self.counts.iteritems(), key=_rank_key)]
+
+    def max_error(self):
+        """
+        Upper bound of the overestimation of any count, also of terms which are not monitored any more
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        while self.counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
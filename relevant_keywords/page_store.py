@@ -0,0 +1,240 @@
+"""
+Local store of crawled pages, consulted before calling the crawler and shared by the api and the offline scripts.
+
+Pages are keyed by url and extractor. A content is stored once per sha1 of its text, so the same content served under
+several urls or extracted the same way by several extractors takes the space of one record: a zlib compressed file
+of its own under `blobs/`, read back through `mmap`. A SQLite index maps the keys to the content hashes. Pages older
+than `ttl` are crawled again, and the least recently read ones are evicted once the compressed contents exceed
+`max_bytes`.
+
+Usage: python -m relevant_keywords.page_store [directory] [--evict], prints the size of the store
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from relevant_keywords.util.log import get_logger
+
+# Shared by the api and the offline scripts unless `PAGE_STORE_DIR` is set
+DEFAULT_DIRECTORY = os.environ.get('PAGE_STORE_DIR',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)), '../cache/pages'))
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+
+
+class PageStore(object):
+
+    def __init__(self, directory, ttl=7 * 24 * 3600, max_bytes=1024 ** 3):
+        """
+        :param ttl: seconds after which a page is crawled again
+        :param max_bytes: max size of the compressed contents, least recently read pages are evicted above it
+        """
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.path = os.path.join(directory, 'pages.sqlite')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.logger = get_logger(self.__class__.__name__)
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _connect(self):
+        # Files and tables are created on first use, e.g. in each gunicorn worker after the fork, not at import
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    def _open(self):
+        # One connection per call, connections must not be shared between forked workers
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _init_db(self):
+        if not os.path.exists(self.blob_dir):
+            try:
+                os.makedirs(self.blob_dir)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        conn = self._open()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT, extractor TEXT, hash TEXT, code INTEGER, '
+                         'created REAL, accessed REAL, PRIMARY KEY (url, extractor))')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash)')
+            conn.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER)')
+        finally:
+            conn.close()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:] + '.zz')
+
+    def get_pages(self, urls, extractor):
+        """
+        :return: dict of url to page, as returned by the crawler, of the urls stored and not expired
+        """
+        if not urls:
+            return {}
+        conn = self._connect()
+        try:
+            now = time.time()
+            rows = []
+            unique_urls = list(set(urls))
+            # Within the max number of SQLite variables
+            for i in range(0, len(unique_urls), 500):
+                part = unique_urls[i:i + 500]
+                rows.extend(conn.execute('SELECT url, hash, code FROM pages WHERE extractor = ? AND created > ? '
+                                         'AND url IN (%s)' % ','.join('?' * len(part)),
+                                         [extractor, now - self.ttl] + part))
+            pages = {}
+            for url, digest, code in rows:
+                content = self._read_blob(digest)
+                if content is not None:
+                    pages[url] = {'ok': True, 'content': content, 'code': code}
+            conn.executemany('UPDATE pages SET accessed = ? WHERE url = ? AND extractor = ?',
+                             ((now, url, extractor) for url in pages))
+            return pages
+        finally:
+            conn.close()
+
+    def _read_blob(self, digest):
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # Evicted meanwhile by another worker
+            return None
+        try:
+            return zlib.decompress(mapped).decode('utf-8')
+        finally:
+            mapped.close()
+
+    def put_pages(self, pages, extractor):
+        """
+        Store the ok pages of a crawler response, then evict expired and least recently read pages
+        :param pages: list of `[url, page]` pairs
+        """
+        records = []
+        for url, page in pages:
+            if page.get('ok') and page.get('content') is not None:
+                records.append((url, self._write_blob(page['content']), page.get('code')))
+        if not records:
+            return
+
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?)',
+                             ((digest, size) for _, (digest, size), _ in records))
+            conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                             ((url, extractor, digest, code, now, now) for url, (digest, _), code in records))
+            self._evict(conn, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _write_blob(self, content):
+        """
+        :return: `(hash, size)` of the compressed content, written unless already stored
+        """
+        data = content.encode('utf-8') if isinstance(content, unicode) else content
+        digest = content_hash(data)
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return digest, os.path.getsize(path)
+        blob_dir = os.path.dirname(path)
+        if not os.path.exists(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        compressed = zlib.compress(data, 6)
+        # Renamed once complete, readers never see a partial record
+        fd, tmp_path = tempfile.mkstemp(dir=blob_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.rename(tmp_path, path)
+        return digest, len(compressed)
+
+    def evict(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self._evict(conn, time.time())
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        if conn.execute('DELETE FROM pages WHERE created <= ?', (now - self.ttl,)).rowcount:
+            # Also the contents of pages replaced by a new crawl since the last eviction
+            self._delete_orphan_blobs(conn)
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        while total > self.max_bytes:
+            # A tenth of the pages at a time, the least recently read first
+            conn.execute('DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages ORDER BY accessed LIMIT '
+                         'MAX(1, (SELECT COUNT(*) FROM pages) / 10))')
+            total -= self._delete_orphan_blobs(conn)
+            if not conn.execute('SELECT 1 FROM pages LIMIT 1').fetchone():
+                break
+
+    def _delete_orphan_blobs(self, conn):
+        """
+        :return: size of the deleted blobs
+        """
+        orphans = conn.execute('SELECT hash, size FROM blobs WHERE hash NOT IN (SELECT hash FROM pages)').fetchall()
+        for digest, _ in orphans:
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+        conn.executemany('DELETE FROM blobs WHERE hash = ?', ((digest,) for digest, _ in orphans))
+        if orphans:
+            self.logger.debug('Evicted %d page contents' % len(orphans))
+        return sum(size for _, size in orphans)
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            pages = conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            contents, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        finally:
+            conn.close()
+        return {'pages': pages, 'contents': contents, 'bytes': size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local store of crawled pages')
+    parser.add_argument('directory', nargs='?', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--ttl', type=float, default=7 * 24 * 3600)
+    parser.add_argument('--max-bytes', type=int, default=1024 ** 3)
+    parser.add_argument('--evict', action='store_true', help='Evict expired and least recently read pages now')
+    args = parser.parse_args()
+
+    store = PageStore(args.directory, ttl=args.ttl, max_bytes=args.max_bytes)
+    if args.evict:
+        store.evict()
+    print '%(pages)d pages, %(contents)d contents, %(bytes)d compressed bytes' % store.stats()
+
+
+if __name__ == '__main__':
+    main()
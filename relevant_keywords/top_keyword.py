@@ -1,35 +1,29 @@
+import importlib
+import multiprocessing
+import numbers
 import re
+import threading
+import time
+from multiprocessing.util import register_after_fork
 
-import nltk
 import numpy as np
-import requests
-from sklearn.feature_extraction.text import TfidfVectorizer
-from gensim.corpora import Dictionary
-from gensim.models import LdaModel
 
+from relevant_keywords.crawler_client import CrawlerClient
+from relevant_keywords.lda_engine import LdaEngine, doc_fingerprints
+from relevant_keywords.nlp.dedup import deduplicate_pages
+from relevant_keywords.nlp.doc_term import DocTermMatrix, smooth_idf, tfidf_weight_sums, top_indices
+from relevant_keywords.nlp.ngrams import NgramTerms, intern_documents, merge_interned
+from relevant_keywords.nlp.top_k import ExactCounter, SpaceSavingCounter
+from relevant_keywords.nlp.token_filter import ADDITIONAL_STOP_WORDS, DEFAULT_TOKEN_FILTER, STOP_WORDS, \
+    TOKEN_FILTERS, english_stop_words, get_supported_token_filters, get_token_filter
+from relevant_keywords.nlp.tokenizer import KeywordTokenizer
 from relevant_keywords.util.log import get_logger
-
-STOP_WORDS = set(
-    "a,about,above,after,again,against,all,am,an,and,any,are,aren't,as,at,be,because,been,before,being,below," \
-    "between,both,but,by,can't,cannot,could,couldn't,did,didn't,do,does,doesn't,doing,don't,down,during,each," \
-    "few,for,from,further,had,hadn't,has,hasn't,have,haven't,having,he,he'd,he'll,he's,her,here,here's,hers," \
-    "herself,him,himself,his,how,how's,i,i'd,i'll,i'm,i've,if,in,into,is,isn't,it,it's,its,itself,let's,me," \
-    "more,most,mustn't,my,myself,no,nor,not,of,off,on,once,only,or,other,ought,our,ours,out,over,own,same," \
-    "shan't,she,she'd,she'll,she's,should,shouldn't,so,some,such,than,that,that's,the,their,theirs,them," \
-    "themselves,then,there,there's,these,they,they'd,they'll,they're,they've,this,those,through,to,too," \
-    "under,until,up,very,was,wasn't,we,we'd,we'll,we're,we've,were,weren't,what,what's,when,when's,where," \
-    "where's,which,while,who,who's,whom,why,why's,with,won't,would,wouldn't,you,you'd,you'll,you're,you've," \
-    "your,yours,yourself,yourselves,ourselves".split(','))
-
-ADDITIONAL_STOP_WORDS = {'www', 'http', 'https', 'href', 'links', 'link', 'copyright', 'style', 'function',
-                         'tags', 'corporate', 'sort', 'details', 'detail', 'comment', 'comments', 'reviews', 'review',
-                         'icon', 'footer', 'icon', 'body', 'begin', 'data', 'stylesheet', 'javascript', 'html', 'font',
-                         'display'}
-
-STOP_WORDS = STOP_WORDS | ADDITIONAL_STOP_WORDS
+from relevant_keywords.util.metrics import StageTimer
+from relevant_keywords.util.timeout import Deadline
 
 
 def generate_ngram(words, min_ngram, max_ngram):
+    import nltk
     result = []
     for i in range(min_ngram, max_ngram + 1):
         result += (' '.join(_) for _ in nltk.ngrams(words, i))
@@ -37,6 +31,37 @@ def generate_ngram(words, min_ngram, max_ngram):
     return result
 
 
+def iter_ngrams(words, min_ngram, max_ngram):
+    # Same ngrams as `generate_ngram`, generated lazily
+    for i in range(min_ngram, max_ngram + 1):
+        for start in range(len(words) - i + 1):
+            yield ' '.join(words[start:start + i])
+
+
+def doc_count_bounds(min_df, max_df, num_docs):
+    # Float thresholds are proportions of documents, integer ones absolute counts, same as sklearn vectorizers
+    max_doc_count = max_df if isinstance(max_df, numbers.Integral) else max_df * num_docs
+    min_doc_count = min_df if isinstance(min_df, numbers.Integral) else min_df * num_docs
+    if max_doc_count < min_doc_count:
+        raise ValueError('max_df corresponds to < documents than min_df')
+    return min_doc_count, max_doc_count
+
+
+def has_no_english_stop_word(term):
+    return english_stop_words().isdisjoint(term.split())
+
+
+def no_stop_word_mask(terms, stop_words=None):
+    # Ngram keys are checked token by token, without building the ngram strings
+    if stop_words is None:
+        stop_words = english_stop_words()
+    if not stop_words:
+        return np.ones(len(terms), dtype=bool)
+    if isinstance(terms, NgramTerms):
+        return terms.without_tokens(stop_words.__contains__)
+    return np.array([stop_words.isdisjoint(term.split()) for term in terms], dtype=bool)
+
+
 def is_number(text):
     try:
         float(text)
@@ -64,18 +89,113 @@ def tokenize(text):
     return [token.strip() for token in text.split() if token.strip() and is_valid_token(token.strip())]
 
 
+# Same rules as the `default` token filter, which is only built on first use
+keyword_tokenizer = KeywordTokenizer(STOP_WORDS)
+
+
+def get_tokenizer(token_filter=DEFAULT_TOKEN_FILTER, tfidf=False):
+    token_filter = get_token_filter(token_filter)
+    return token_filter.tfidf_tokenizer if tfidf else token_filter.tokenizer
+
+
+def build_doc_term(contents, min_ngram, max_ngram, token_filter=DEFAULT_TOKEN_FILTER, min_doc_count=None,
+                   tfidf=False):
+    # Tokenize, filter stop words and count ngrams as packed integer keys
+    tokenizer = get_tokenizer(token_filter, tfidf)
+    return DocTermMatrix.from_token_documents(tokenizer.tokenize_documents(contents, lowercase=True),
+                                              min_ngram, max_ngram, min_doc_count)
+
+
+def _build_doc_term_shard(args):
+    return build_doc_term(*args)
+
+
+def _intern_shard(args):
+    contents, token_filter, tfidf = args
+    return intern_documents(get_tokenizer(token_filter, tfidf).tokenize_documents(contents, lowercase=True))
+
+
+def split_shards(contents, num_shards):
+    """
+    Split contents into at most `num_shards` consecutive shards of roughly equal text length
+    """
+    total = float(sum(len(content) for content in contents)) or 1.0
+    shards = [[] for _ in range(num_shards)]
+    size = 0
+    for content in contents:
+        shards[min(int(size * num_shards / total), num_shards - 1)].append(content)
+        size += len(content)
+    return [shard for shard in shards if shard]
+
+
 class TopKeywords(object):
     METRIC_TFIDF = 'tfidf'
     METRIC_COUNT = 'count'
     METRIC_LDA = 'lda'
+    METRIC_BACKGROUND = 'background'
+
+    COUNT_MODE_MATRIX = 'matrix'
+    COUNT_MODE_STREAM = 'stream'
+    COUNT_MODE_APPROXIMATE = 'approximate'
+    COUNT_MODES = {COUNT_MODE_MATRIX, COUNT_MODE_STREAM, COUNT_MODE_APPROXIMATE}
+
+    TFIDF_MODE_IDF = 'idf'
+    TFIDF_MODE_WEIGHT = 'weight'
+    TFIDF_MODE_HASHING = 'hashing'
+    TFIDF_MODES = {TFIDF_MODE_IDF, TFIDF_MODE_WEIGHT, TFIDF_MODE_HASHING}
 
     EXTRACTORS = {'dragnet', 'goose', 'goose_dragnet', 'readability', 'selective', 'all_text'}
 
-    def __init__(self, crawler_endpoint):
+    # Deadlines, see `rank`: below `LDA_MIN_SECONDS` of remaining budget lda falls back to count, pages are not
+    # tokenized for the matrix when `TOKENIZE_SECONDS_PER_MB` says it would not fit, and the crawl leaves
+    # `SCORING_RESERVE_SECONDS` to the scoring
+    LDA_MIN_SECONDS = 2.0
+    TOKENIZE_SECONDS_PER_MB = 0.5
+    SCORING_RESERVE_SECONDS = 5.0
+
+    # Imported by the metrics on first use, see `warm_up`
+    WARM_UP_MODULES = ('sklearn.feature_extraction.text', 'sklearn.utils', 'gensim.matutils', 'gensim.models')
+
+    def __init__(self, crawler_endpoint, preprocess_workers=0, parallel_min_docs=50, hashing_features=2 ** 20,
+                 background_idf=None, lda_engine=None, crawler_client=None, keyword_index=None):
+        """
+        :param preprocess_workers: number of processes used to tokenize and vectorize large batches of pages,
+            `0` keeps everything in the calling process
+        :param parallel_min_docs: batches with fewer pages than this are always preprocessed serially
+        :param hashing_features: number of hashed columns of the `hashing` tf-idf mode
+        :param background_idf: `BackgroundIdf` model, enables the `background` metric
+        :param lda_engine: `LdaEngine` training and caching the models of the `lda` metric
+        :param crawler_client: `CrawlerClient` of the crawler endpoint, a default one is created if not given
+        :param keyword_index: `KeywordIndex` of the requests with an `index_key`
+        """
         self.crawler_endpoint = crawler_endpoint
+        self.crawler_client = crawler_client or CrawlerClient(crawler_endpoint)
         self.logger = get_logger(self.__class__.__name__)
         self.supported_metrics = {self.METRIC_TFIDF, self.METRIC_COUNT, self.METRIC_LDA}
         self.crawler_user_agent = None
+        self.preprocess_workers = preprocess_workers
+        self.parallel_min_docs = parallel_min_docs
+        self.hashing_features = hashing_features
+        self.background_idf = background_idf
+        self.lda_engine = lda_engine or LdaEngine()
+        self.keyword_index = keyword_index
+        if background_idf is not None:
+            self.supported_metrics.add(self.METRIC_BACKGROUND)
+        self._preprocess_pool = None
+        self._preprocess_pool_lock = threading.Lock()
+        # Processes started by `multiprocessing`, e.g. the `lda` jobs of the scheduler, create their own pool
+        register_after_fork(self, TopKeywords._reset_preprocess_pool)
+
+    def _reset_preprocess_pool(self):
+        self._preprocess_pool = None
+        self._preprocess_pool_lock = threading.Lock()
+
+    def _get_preprocess_pool(self):
+        # Created on first use so that each forked gunicorn worker gets its own pool
+        with self._preprocess_pool_lock:
+            if self._preprocess_pool is None:
+                self._preprocess_pool = multiprocessing.Pool(self.preprocess_workers)
+        return self._preprocess_pool
 
     def get_supported_metric_names(self):
         return ', '.join('`%s`' % m for m in self.supported_metrics)
@@ -86,106 +206,467 @@ class TopKeywords(object):
     def get_supported_extractors(self):
         return ', '.join('`%s`' % e for e in self.EXTRACTORS)
 
-    def _crawl(self, urls, extractor):
-        payload = {
-            'urls': urls,
-            'extractor': extractor,
-            'cache': 1,
-            'user_agent': self.crawler_user_agent
-        }
-        response = requests.post(url=self.crawler_endpoint, data=payload)
-        if not response.ok:
-            raise RuntimeError('Call crawler api error: %s - %s' % (response.status_code, response.reason))
-        url_pages = response.json()
+    def get_supported_count_modes(self):
+        return ', '.join('`%s`' % m for m in self.COUNT_MODES)
+
+    def get_supported_tfidf_modes(self):
+        return ', '.join('`%s`' % m for m in self.TFIDF_MODES)
+
+    @staticmethod
+    def get_supported_token_filters():
+        return get_supported_token_filters()
+
+    def warm_up(self):
+        """
+        Import the libraries of the metrics and build the token filters now instead of on the first request, e.g.
+        in the gunicorn master before workers are forked
+        """
+        start = time.time()
+        for module in self.WARM_UP_MODULES:
+            importlib.import_module(module)
+        for name in sorted(TOKEN_FILTERS):
+            try:
+                get_token_filter(name)
+            except LookupError as e:
+                # e.g. the nltk stopwords corpus is not installed, the filter fails on use as before
+                self.logger.warning('Token filter `%s` not warmed up: %s' % (name, e.__class__.__name__))
+        self.logger.info('Warmed up in %.2fs' % (time.time() - start))
+
+    def _crawl(self, urls, extractor, user_agent=None, deadline=None):
+        url_list = [url for url in urls.split(',') if url]
+        crawled = self.crawler_client.crawl(url_list, extractor, user_agent or self.crawler_user_agent,
+                                            timeout=self.crawl_timeout(deadline))
+        return self.parse_crawled(url_list, crawled)
+
+    def crawl_timeout(self, deadline):
+        # Pages of the batches crawled in time are scored, the others are reported as failed urls
+        if deadline is None:
+            return None
+        return deadline.timeout(self.crawler_client.timeout, reserve=self.SCORING_RESERVE_SECONDS)
+
+    @staticmethod
+    def parse_crawled(url_list, crawled):
+        """
+        Split the result of a crawler client into the page contents, their `urls` and the crawl status of the urls
+        """
+        if crawled['failed_batches'] and not crawled['pages']:
+            raise RuntimeError(crawled['failed_batches'][0]['error'])
+
         failed_crawl = []
         contents = []
-        for url, page in url_pages['pages']:
+        urls = []
+        for url, page in crawled['pages']:
             if page.get('ok'):
                 contents.append(page['content'])
+                urls.append(url)
             else:
                 failed_crawl.append({
                     'url': url,
                     'error': page.get('error'),
                     'code': page.get('code')
                 })
+        # Urls of batches which could not be crawled at all
+        for batch in crawled['failed_batches']:
+            failed_crawl.extend({'url': url, 'error': batch['error'], 'code': None} for url in batch['urls'])
 
         return {
             'contents': contents,
+            'urls': urls,
             'crawl_status': {
                 'failed_count': len(failed_crawl),
-                'succeed_count': len(urls.split(',')) - len(failed_crawl),
+                'succeed_count': len(url_list) - len(failed_crawl),
                 'failed_urls': failed_crawl
             }
         }
 
-    def get_top_keywords(self, urls, extractor='all_text', top_n=20, metric='tfidf', min_df=0.3, max_df=0.9,
-                         max_voc=200, min_ngram=1, max_ngram=1):
-
+    def _parse_metrics(self, metric):
+        metrics = []
+        for name in metric.split(','):
+            name = name.strip()
+            if name not in self.supported_metrics:
+                raise RuntimeError('Metric name `%s` is not supported, accepted are %s' %
+                                   (name, self.get_supported_metric_names()))
+            if name not in metrics:
+                metrics.append(name)
+        return metrics
+
+    def check_options(self, extractor='all_text', metric='tfidf', count_mode='matrix', tfidf_mode='idf',
+                      token_filter=DEFAULT_TOKEN_FILTER, top_n=20):
+        """
+        Validate the options of a request before anything is crawled
+        :return: list of the requested metric names
+        """
         if extractor not in self.EXTRACTORS:
             raise RuntimeError('Extractor `%s` is not supported, accepted are %s' %
                                (extractor, self.get_supported_extractors()))
 
-        if metric not in self.supported_metrics:
-            raise RuntimeError('Metric name `%s` is not supported, accepted are %s' %
-                               (metric, self.get_supported_metric_names()))
+        metrics = self._parse_metrics(metric)
 
-        crawled = self._crawl(urls, extractor)
-        contents = crawled['contents']
-        top_keywords = []
-        if metric == self.METRIC_TFIDF:
-            top_keywords = self._get_top_by_tfidf_score(contents, top_n, min_df, max_df, max_voc, min_ngram, max_ngram)
-        elif metric == self.METRIC_COUNT:
-            top_keywords = self._get_top_by_count(contents, top_n, min_ngram, max_ngram)
-        elif metric == self.METRIC_LDA:
-            top_keywords = self._get_top_lda_topics(contents, top_n, min_ngram, max_ngram)
+        if count_mode not in self.COUNT_MODES:
+            raise RuntimeError('Count mode `%s` is not supported, accepted are %s' %
+                               (count_mode, self.get_supported_count_modes()))
 
-        return {
-            'top_keywords': top_keywords,
-            'crawl_status': crawled['crawl_status']
-        }
+        if tfidf_mode not in self.TFIDF_MODES:
+            raise RuntimeError('Tf-idf mode `%s` is not supported, accepted are %s' %
+                               (tfidf_mode, self.get_supported_tfidf_modes()))
+
+        if top_n < 1:
+            raise RuntimeError('Top n `%s` is not supported, accepted is at least `1`' % top_n)
+
+        # Also builds the filter, once per process
+        get_token_filter(token_filter)
+        return metrics
+
+    def get_top_keywords(self, urls, extractor='all_text', top_n=20, metric='tfidf', min_df=0.3, max_df=0.9,
+                         max_voc=200, min_ngram=1, max_ngram=1, count_mode='matrix', count_capacity=10000,
+                         tfidf_mode='idf', lda_key=None, lda_passes=20, lda_time_budget=None, user_agent=None,
+                         timer=None, token_filter=DEFAULT_TOKEN_FILTER, deadline=None, dedup=False, index_key=None):
+        """
+        Get top keywords of crawled urls by one metric, or by several comma separated metrics (e.g. `tfidf,count`)
+        which then share the same tokenized document-term matrix and are returned as a dict keyed by metric name.
+
+        The `count` metric is computed from that matrix unless `count_mode` is `stream`, which counts ngrams page by
+        page without building the matrix, or `approximate`, which also keeps at most `count_capacity` counters and
+        reports the error bounds of the counts under `count_error_bounds`.
+
+        The `tfidf` metric ranks the `max_voc` most frequent terms by idf when `tfidf_mode` is `idf`, or ranks all
+        terms by their tf-idf weight summed over pages when it is `weight`. The `hashing` mode approximates `weight`
+        (up to hash collisions) with a bounded memory `HashingVectorizer` instead of the shared matrix. When `tfidf` is
+        the only metric, the ngrams longer than `min_ngram` are counted level by level and only extended while they are
+        in at least `min_df` pages (see `nlp.ngrams.pack_frequent_ngrams`), with the same results.
+
+        The `lda` model is cached by `lda_key` (e.g. the seed keyword of the urls) or by the corpus fingerprint, and
+        updated with the pages it has not seen yet. Training is limited to `lda_passes` passes and to
+        `lda_time_budget` seconds if given.
+
+        All options are per call, `user_agent` overrides the one set by `set_crawler_user_agent`, so one instance can
+        serve concurrent requests. Durations of the `crawl`, `tokenize` and per metric stages are recorded by `timer`,
+        a `StageTimer` of the request.
+
+        `token_filter` names the stop words and token rules applied by the tokenizer (see `nlp.token_filter`). The
+        `default` one keeps the results of the former tokenizer and vectorizer: sklearn's English stop words are
+        removed from the tokens of `tfidf` before building its ngrams, `count` and `lda` keep them.
+
+        `deadline` is the `Deadline` of the request: the crawl stops in time to leave a budget to the scoring, and the
+        metrics fall back to cheaper engines when they would not fit, which is reported under `degraded`.
+
+        With `dedup`, near-duplicate pages and the text blocks repeated over several pages (navigation, footers) are
+        removed before scoring, see `nlp.dedup`. What was removed is reported under `dedup`.
+
+        With an `index_key` (e.g. the seed keyword of the urls) and a `keyword_index`, the pages are synced with the
+        persistent index of that key and the `count` (`matrix` mode) and `tfidf` (`idf` mode) metrics are read from
+        it, so only the pages which changed since the last request are tokenized. Its sync is reported under `index`.
+        """
+        timer = timer or StageTimer()
+        metrics = self.check_options(extractor, metric, count_mode, tfidf_mode, token_filter, top_n)
+        with timer.stage('crawl'):
+            crawled = self._crawl(urls, extractor, user_agent, deadline)
+        result = {'crawl_status': crawled['crawl_status']}
+        result.update(self.rank(crawled['contents'], metrics, top_n=top_n, min_df=min_df, max_df=max_df,
+                                max_voc=max_voc, min_ngram=min_ngram, max_ngram=max_ngram, count_mode=count_mode,
+                                count_capacity=count_capacity, tfidf_mode=tfidf_mode, lda_key=lda_key,
+                                lda_passes=lda_passes, lda_time_budget=lda_time_budget, timer=timer,
+                                token_filter=token_filter, deadline=deadline, dedup=dedup, index_key=index_key,
+                                urls=crawled['urls']))
+        return result
+
+    def rank(self, contents, metrics, top_n=20, min_df=0.3, max_df=0.9, max_voc=200, min_ngram=1, max_ngram=1,
+             count_mode='matrix', count_capacity=10000, tfidf_mode='idf', lda_key=None, lda_passes=20,
+             lda_time_budget=None, timer=None, token_filter=DEFAULT_TOKEN_FILTER, deadline=None, dedup=False,
+             index_key=None, urls=None):
+        """
+        Score already crawled page contents, CPU bound part of `get_top_keywords`
+
+        With a `deadline`, `lda` is scored by `count` when less than `LDA_MIN_SECONDS` remain and its training is
+        bounded by the remaining budget. When tokenizing the pages for the matrix would not fit, metrics are scored by
+        an `approximate` count which stops at the deadline, after at least one page. Every such fallback is listed
+        under `degraded` as `{'metric', 'engine', 'reason'}`, the results of the fallback engine are returned under
+        the requested metric name.
+        :param metrics: list of metric names as returned by `check_options`
+        :param urls: url of each page of `contents`, identifies the pages in the `keyword_index`
+        :return: dict of `top_keywords`, `dedup`, `index` and, in the `approximate` count mode, `count_error_bounds`
+        """
+        timer = timer or StageTimer()
+        deadline = deadline or Deadline()
+        token_filter = get_token_filter(token_filter)
+        result = {}
+        # The index holds the raw pages, dedup is applied to its frequencies at query time
+        raw_contents = contents
+        deduped = None
+        if dedup and len(contents) > 1:
+            with timer.stage('dedup'):
+                deduped, result['dedup'] = deduplicate_pages(contents)
+            contents = [content for content in deduped if content is not None]
+        top_keywords = {}
+        degraded = []
+        # Matrices and indexes by `tfidf` view: unless no token is only a stop word of `tfidf`, or only unigrams are
+        # counted, `tfidf` reads ngrams built from the tokens without its stop words, see `TokenFilter`
+        tfidf_view = max_ngram > 1 and token_filter.tfidf_tokenizer is not token_filter.tokenizer
+        doc_terms = {}
+        indexes = {}
+        for name in metrics:
+            engine, engine_count_mode, reason = self._plan_engine(name, count_mode, tfidf_mode, contents,
+                                                                  (tfidf_view and name == self.METRIC_TFIDF)
+                                                                  in doc_terms, deadline)
+            if reason is not None:
+                degraded.append({'metric': name, 'engine': '%s:%s' % (engine, engine_count_mode)
+                                 if engine == self.METRIC_COUNT else engine, 'reason': reason})
+
+            if engine == self.METRIC_COUNT and engine_count_mode != self.COUNT_MODE_MATRIX:
+                counter = SpaceSavingCounter(count_capacity) if engine_count_mode == self.COUNT_MODE_APPROXIMATE \
+                    else ExactCounter()
+                with timer.stage(engine):
+                    top_counts, counted = self._get_top_by_count_stream(contents, top_n, min_ngram, max_ngram,
+                                                                        counter, token_filter, deadline)
+                if counted < len(contents):
+                    degraded.append({'metric': name, 'engine': '%s:%s' % (engine, engine_count_mode),
+                                     'reason': 'Deadline reached after counting %d of %d pages'
+                                               % (counted, len(contents))})
+                top_keywords[name] = [term for term, _, _ in top_counts]
+                if name == self.METRIC_COUNT and count_mode == self.COUNT_MODE_APPROXIMATE:
+                    result['count_error_bounds'] = {
+                        'capacity': count_capacity,
+                        'total_count': counter.total,
+                        'max_error': counter.max_error(),
+                        'keywords': top_counts
+                    }
+                continue
+
+            if engine == self.METRIC_TFIDF and tfidf_mode == self.TFIDF_MODE_HASHING:
+                with timer.stage(engine):
+                    top_keywords[name] = self._get_top_by_hashed_tfidf_weight(contents, top_n, min_df, max_df,
+                                                                              min_ngram, max_ngram, token_filter)
+                continue
+
+            tfidf = tfidf_view and engine == self.METRIC_TFIDF
+            if self.keyword_index is not None and index_key and (
+                    engine == self.METRIC_COUNT or engine == self.METRIC_TFIDF and tfidf_mode == self.TFIDF_MODE_IDF):
+                if tfidf not in indexes:
+                    with timer.stage('index'):
+                        index, result['index'] = self.keyword_index.update(index_key, raw_contents, min_ngram,
+                                                                           max_ngram, token_filter.name, tfidf, urls)
+                        adjustment = None if deduped is None else self.keyword_index.dedup_adjustment(
+                            index, raw_contents, deduped, min_ngram, max_ngram, token_filter.name, tfidf, urls)
+                    indexes[tfidf] = index, adjustment
+                index, adjustment = indexes[tfidf]
+                with timer.stage(engine):
+                    if engine == self.METRIC_TFIDF:
+                        top_keywords[name] = self.keyword_index.top_by_tfidf_score(index, top_n, min_df, max_df,
+                                                                                   max_voc, adjustment)
+                    else:
+                        top_keywords[name] = self.keyword_index.top_by_count(index, top_n, adjustment)
+                continue
+
+            if tfidf not in doc_terms:
+                # Read by the `tfidf` metric only, or by all the metrics but `tfidf` when it has its own view
+                readers = [self.METRIC_TFIDF] if tfidf else \
+                    [m for m in metrics if not (tfidf_view and m == self.METRIC_TFIDF)]
+                with timer.stage('tokenize'):
+                    doc_terms[tfidf] = self._build_doc_term(contents, min_ngram, max_ngram, token_filter.name,
+                                                            self._min_doc_count(readers, min_df, max_df, min_ngram,
+                                                                                max_ngram, len(contents)), tfidf)
+            doc_term = doc_terms[tfidf]
+            # No token of the `tfidf` view is a stop word, the unigrams of the shared view are checked
+            stop_words = frozenset() if tfidf else token_filter.tfidf_stop_words
+            with timer.stage(engine):
+                if engine == self.METRIC_TFIDF and tfidf_mode == self.TFIDF_MODE_WEIGHT:
+                    top_keywords[name] = self._get_top_by_tfidf_weight(doc_term, top_n, min_df, max_df, stop_words)
+                elif engine == self.METRIC_TFIDF:
+                    top_keywords[name] = self._get_top_by_tfidf_score(doc_term, top_n, min_df, max_df, max_voc,
+                                                                      stop_words)
+                elif engine == self.METRIC_COUNT:
+                    top_keywords[name] = self._get_top_by_count(doc_term, top_n)
+                elif engine == self.METRIC_LDA:
+                    key = '%s\0%d-%d' % (lda_key, min_ngram, max_ngram) if lda_key else None
+                    time_budget = lda_time_budget
+                    if deadline.expires is not None:
+                        # Training stops in time, the model is cached as trained so far
+                        time_budget = min(lda_time_budget or float('inf'), deadline.remaining() - 1.0)
+                    lda_stats = {}
+                    top_keywords[name] = self._get_top_lda_topics(doc_term, top_n, key, lda_passes, time_budget,
+                                                                  lda_stats)
+                    if lda_stats.get('stopped') and time_budget != lda_time_budget:
+                        degraded.append({'metric': name, 'engine': engine,
+                                         'reason': 'Training stopped by the deadline after %d of %d passes'
+                                                   % (lda_stats['passes'], lda_passes)})
+                elif engine == self.METRIC_BACKGROUND:
+                    top_keywords[name] = self._get_top_by_background_tfidf(doc_term, top_n)
+
+        result['top_keywords'] = top_keywords[metrics[0]] if len(metrics) == 1 else top_keywords
+        if degraded:
+            self.logger.warning('Degraded %s' % degraded)
+            result['degraded'] = degraded
+        return result
+
+    def _plan_engine(self, name, count_mode, tfidf_mode, contents, has_doc_term, deadline):
+        """
+        Engine scoring a metric in the remaining budget of the deadline
+        :return: `(engine, count_mode, reason)`, reason is `None` unless the engine is a fallback
+        """
+        if deadline.expires is None:
+            return name, count_mode, None
+
+        engine, reason = name, None
+        if name == self.METRIC_LDA and not deadline.allows(self.LDA_MIN_SECONDS):
+            engine, count_mode = self.METRIC_COUNT, self.COUNT_MODE_MATRIX
+            reason = 'Remaining budget %.1fs below the %.1fs of lda' % (deadline.remaining(), self.LDA_MIN_SECONDS)
+
+        streamed = engine == self.METRIC_COUNT and count_mode != self.COUNT_MODE_MATRIX
+        # Hashing tf-idf does not use the matrix but tokenizes all pages as well
+        hashed = engine == self.METRIC_TFIDF and tfidf_mode == self.TFIDF_MODE_HASHING
+        if not streamed and (not has_doc_term or hashed):
+            estimate = sum(len(content) for content in contents) / 1024.0 / 1024.0 * self.TOKENIZE_SECONDS_PER_MB
+            if not deadline.allows(estimate):
+                reason = 'Remaining budget %.1fs below the %.1fs estimated to tokenize the pages' \
+                         % (deadline.remaining(), estimate)
+                engine, count_mode = self.METRIC_COUNT, self.COUNT_MODE_APPROXIMATE
+        return engine, count_mode, reason
+
+    def _min_doc_count(self, metrics, min_df, max_df, min_ngram, max_ngram, num_docs):
+        """
+        Document frequency below which no metric of a request reads a term, the longer ngrams under it need not be
+        counted. Only `tfidf` drops them, `count`, `background` and `lda` read all terms.
+        :return: `None` when nothing would be pruned
+        """
+        if any(name != self.METRIC_TFIDF for name in metrics) or max_ngram <= min_ngram or not num_docs:
+            return None
+        min_doc_count = doc_count_bounds(min_df, max_df, num_docs)[0]
+        return min_doc_count if min_doc_count > 1 else None
+
+    def _build_doc_term(self, contents, min_ngram, max_ngram, token_filter=DEFAULT_TOKEN_FILTER, min_doc_count=None,
+                        tfidf=False):
+        """
+        Tokenize, filter stop words and generate ngrams once for all metrics
+        :param min_doc_count: see `DocTermMatrix.from_token_documents`
+        :param tfidf: whether the stop words of the `tfidf` metric are removed from the tokens as well
+        """
+        if self.preprocess_workers < 2 or len(contents) < self.parallel_min_docs:
+            return build_doc_term(contents, min_ngram, max_ngram, token_filter, min_doc_count, tfidf)
+
+        shards = split_shards(contents, self.preprocess_workers)
+        self.logger.debug('Preprocess %d pages in %d shards' % (len(contents), len(shards)))
+        if min_doc_count is not None:
+            # Document frequencies are over all pages, shards are only tokenized in parallel
+            parts = self._get_preprocess_pool().map(_intern_shard,
+                                                    [(shard, token_filter, tfidf) for shard in shards], chunksize=1)
+            tokens, docs = merge_interned(parts)
+            return DocTermMatrix.from_interned(tokens, docs, min_ngram, max_ngram, min_doc_count)
+        parts = self._get_preprocess_pool().map(_build_doc_term_shard,
+                                                [(shard, min_ngram, max_ngram, token_filter, None, tfidf)
+                                                 for shard in shards], chunksize=1)
+        return DocTermMatrix.merge(parts)
 
     @staticmethod
-    def _get_top_by_tfidf_score(contents, top_n, min_df=0.3, max_df=0.9,
-                                max_voc=200, min_ngram=1, max_ngram=1):
-        vectorized = TfidfVectorizer(tokenizer=tokenize, stop_words='english', ngram_range=(min_ngram, max_ngram),
-                                     min_df=min_df, max_df=max_df, max_features=max_voc)
-        vectorized.fit_transform(contents)
-        features = vectorized.get_feature_names()
-        indices = np.argsort(vectorized.idf_)[::-1]
-        return [(features[i], vectorized.idf_[i]) for i in indices[:top_n]]
+    def _get_top_by_tfidf_score(doc_term, top_n, min_df=0.3, max_df=0.9, max_voc=200, stop_words=None):
+        # Same vocabulary pruning as `TfidfVectorizer(stop_words='english', min_df, max_df, max_features)`
+        num_docs = doc_term.num_docs
+        min_doc_count, max_doc_count = doc_count_bounds(min_df, max_df, num_docs)
+        doc_term = doc_term.select(no_stop_word_mask(doc_term.terms, stop_words))
+        if not doc_term.num_terms:
+            raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+        doc_term = doc_term.limit_features(max_doc_count, min_doc_count, max_voc)
+        if not doc_term.num_terms:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        idf = smooth_idf(doc_term.document_frequency(), num_docs)
+        indices = np.argsort(idf)[::-1]
+        return [(doc_term.terms[i], idf[i]) for i in indices[:top_n]]
 
     @staticmethod
-    def _get_top_by_count(contents, top_n, min_ngram, max_ngram):
-        # Tokenize and filter stop words
-        for idx, content in enumerate(contents):
-            content = content.lower()
-            contents[idx] = generate_ngram(tokenize(content), min_ngram, max_ngram)
-
-        # Counting keywords
-        kw_count = {}
-        for content in contents:
-            for kw in content:
-                if kw in kw_count:
-                    kw_count[kw] += 1
-                else:
-                    kw_count[kw] = 1
+    def _get_top_by_tfidf_weight(doc_term, top_n, min_df=0.3, max_df=0.9, stop_words=None):
+        # Rank by the tf-idf weight summed over pages, no vocabulary limit is needed to select the top terms
+        num_docs = doc_term.num_docs
+        min_doc_count, max_doc_count = doc_count_bounds(min_df, max_df, num_docs)
+        dfs = doc_term.document_frequency()
+        mask = (dfs >= min_doc_count) & (dfs <= max_doc_count)
+        mask &= no_stop_word_mask(doc_term.terms, stop_words)
+        doc_term = doc_term.select(mask)
+        if not doc_term.num_terms:
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        scores = tfidf_weight_sums(doc_term.matrix, smooth_idf(dfs[mask], num_docs))
+        return [(doc_term.terms[i], scores[i]) for i in top_indices(scores, top_n)]
+
+    def _get_top_by_hashed_tfidf_weight(self, contents, top_n, min_df=0.3, max_df=0.9, min_ngram=1, max_ngram=1,
+                                        token_filter=None):
+        # Same ranking as `_get_top_by_tfidf_weight` up to hash collisions, terms are hashed into a fixed number of
+        # columns so no vocabulary is kept, only the winning columns are mapped back to their most frequent term
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.utils import murmurhash3_32
+        token_filter = token_filter or get_token_filter()
+        docs = token_filter.tfidf_tokenizer.tokenize_documents(contents, lowercase=True)
+
+        def analyzer(tokens):
+            return iter_ngrams(tokens, min_ngram, max_ngram)
+
+        n_features = self.hashing_features
+        vectorizer = HashingVectorizer(analyzer=analyzer, n_features=n_features, alternate_sign=False, norm=None)
+        matrix = vectorizer.transform(docs)
+        num_docs = matrix.shape[0]
+        min_doc_count, max_doc_count = doc_count_bounds(min_df, max_df, num_docs)
+        dfs = np.bincount(matrix.indices, minlength=n_features)
+        mask = (dfs >= min_doc_count) & (dfs <= max_doc_count) & (dfs > 0)
+        if not mask.any():
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        # Pruned columns get a zero weight so that they do not count in the page norms either
+        scores = tfidf_weight_sums(matrix, smooth_idf(dfs, num_docs) * mask)
+        scores[~mask] = -1
+        winners = dict((idx, {}) for idx in top_indices(scores, min(top_n, mask.sum())))
+        for tokens in docs:
+            for term in analyzer(tokens):
+                term_count = winners.get(abs(murmurhash3_32(term, seed=0)) % n_features)
+                if term_count is not None:
+                    term_count[term] = term_count.get(term, 0) + 1
 
-        # Short and get most occurring keywords
-        return sorted(kw_count, key=kw_count.__getitem__, reverse=True)[:top_n]
+        top_keywords = []
+        for idx in sorted(winners, key=lambda i: -scores[i]):
+            term_count = winners[idx]
+            top_keywords.append((min(term_count, key=lambda t: (-term_count[t], t)), scores[idx]))
+        return top_keywords
+
+    @staticmethod
+    def _get_top_by_count(doc_term, top_n):
+        # Sort and get most occurring keywords
+        indices = np.argsort(-doc_term.term_frequency(), kind='mergesort')
+        return [doc_term.terms[i] for i in indices[:top_n]]
 
     @staticmethod
-    def _get_top_lda_topics(contents, top_n, min_ngram, max_ngram):
-        # Tokenize and filter stop words
-        for idx, content in enumerate(contents):
-            content = content.lower()
-            contents[idx] = generate_ngram(tokenize(content), min_ngram, max_ngram)
-
-        dictionary = Dictionary(contents)
-        dictionary.filter_extremes(no_below=3, no_above=0.9)
-        corpus = [dictionary.doc2bow(content) for content in contents]
-        if not corpus or not dictionary.token2id:
+    def _get_top_by_count_stream(contents, top_n, min_ngram, max_ngram, counter, token_filter=None, deadline=None):
+        counted = TopKeywords.count_pages(contents, counter, min_ngram, max_ngram, token_filter, deadline)
+        return counter.top(top_n), counted
+
+    @staticmethod
+    def count_pages(contents, counter, min_ngram=1, max_ngram=1, token_filter=None, deadline=None):
+        """
+        Add the ngrams of pages to an `ExactCounter` or `SpaceSavingCounter`, e.g. as the pages of a request arrive
+        :param deadline: checked between pages, counting stops once it is reached, after at least one page
+        :return: number of pages counted
+        """
+        # Page by page, only one page's tokens are held at a time
+        tokenizer = (token_filter or get_token_filter()).tokenizer
+        counted = 0
+        for content in contents:
+            if counted and deadline is not None and deadline.expired():
+                break
+            counter.update(iter_ngrams(tokenizer.tokenize(content.lower()), min_ngram, max_ngram))
+            counted += 1
+        return counted
+
+    def _get_top_by_background_tfidf(self, doc_term, top_n):
+        # Term frequency of the pages weighted by the idf of the precomputed background model
+        if not doc_term.num_terms:
+            return []
+        scores = doc_term.term_frequency() * self.background_idf.idf(doc_term.terms)
+        return [(doc_term.terms[i], scores[i]) for i in top_indices(scores, top_n)]
+
+    def _get_top_lda_topics(self, doc_term, top_n, key=None, passes=20, time_budget=None, stats=None):
+        # Same filtering as `Dictionary.filter_extremes(no_below=3, no_above=0.9)`
+        doc_ids = doc_fingerprints(doc_term)
+        dfs = doc_term.document_frequency()
+        doc_term = doc_term.select((dfs >= 3) & (dfs <= int(0.9 * doc_term.num_docs)))
+        if not doc_term.num_docs or not doc_term.num_terms:
             raise RuntimeError('Empty corpus')
 
-        lda = LdaModel(corpus=corpus, id2word=dictionary, passes=20, num_topics=top_n)
-        top_topics = lda.print_topics(num_topics=top_n)
-        return [t[1] for t in top_topics]
+        return self.lda_engine.get_topics(doc_term, top_n, key=key, passes=passes, time_budget=time_budget,
+                                          doc_ids=doc_ids, stats=stats)
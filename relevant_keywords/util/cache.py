@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+
+from relevant_keywords.util.log import get_logger
+from relevant_keywords.util.timeout import Deadline
+
+CACHE_USE = 'use'
+CACHE_BYPASS = 'bypass'
+CACHE_REFRESH = 'refresh'
+CACHE_MODES = {CACHE_USE, CACHE_BYPASS, CACHE_REFRESH}
+
+
+class ResultCache(object):
+    """
+    Cache of JSON results in a SQLite file, shared by all worker processes. Entries expire after `ttl` seconds and
+    the least recently used ones are evicted above `max_entries`. Concurrent computations of the same key are
+    serialized by a lock row, so only one worker computes while the others wait for its result.
+    """
+
+    def __init__(self, path, ttl=3600, max_entries=10000, lock_timeout=230, poll_interval=0.2, io_workers=4):
+        """
+        :param lock_timeout: max seconds a computation holds its lock, below the 240s timeout after which gunicorn
+            kills a worker, so the lock of a killed worker does not outlive it
+        :param io_workers: number of threads running the SQLite calls of `get_or_compute_async` off the IOLoop
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.io_workers = io_workers
+        self.logger = get_logger(self.__class__.__name__)
+        self._executor = None
+        self._pid = None
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use in each process, e.g. in every gunicorn worker forked after the import
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.io_workers)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _connect(self):
+        # Files and tables are created on first use, e.g. in each gunicorn worker after the fork, not at import
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    def _open(self):
+        # One connection per call, connections must not be shared between forked workers
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _init_db(self):
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        conn = self._open()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, expires REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            for name in ('hits', 'misses', 'waits', 'bypasses', 'refreshes'):
+                conn.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            return self._lookup(conn, key, time.time())
+        finally:
+            conn.close()
+
+    def _lookup(self, conn, key, now):
+        row = conn.execute('SELECT value FROM results WHERE key = ? AND created > ?', (key, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        conn = self._connect()
+        try:
+            self._store(conn, key, value, time.time())
+        finally:
+            conn.close()
+
+    def _store(self, conn, key, value, now):
+        conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+        conn.execute('DELETE FROM results WHERE created <= ?', (now - self.ttl,))
+        conn.execute('DELETE FROM results WHERE key IN '
+                     '(SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def get_or_compute(self, key, compute, mode=CACHE_USE, cacheable=None, deadline=None):
+        """
+        :param compute: function computing the value on a miss, the value must be JSON serializable
+        :param mode: `use` the cache, `bypass` it completely or `refresh` the cached value
+        :param cacheable: function telling whether a computed value is stored, by default all are
+        :param deadline: `Deadline` of the request, bounds the wait for another worker and the lock of this one
+        :return: `(value, status)` where status is `hit`, `miss`, `bypass` or `refresh`
+        :raise RuntimeError: when the deadline is reached while another worker computes the same key
+        """
+        if mode == CACHE_BYPASS:
+            self._count('bypasses')
+            return compute(), 'bypass'
+
+        deadline = deadline or Deadline()
+        while True:
+            acquired, value = self._acquire(key, mode, deadline)
+            if value is not None:
+                return value, 'hit'
+            if acquired:
+                break
+            # Another worker is computing the same key, wait for its result
+            time.sleep(self._wait_interval(deadline))
+        try:
+            value = compute()
+            store = cacheable is None or cacheable(value)
+        except Exception:
+            self._release(key)
+            raise
+        return value, self._release(key, mode, value if store else None)
+
+    @gen.coroutine
+    def get_or_compute_async(self, key, compute, mode=CACHE_USE, cacheable=None, deadline=None):
+        """
+        Coroutine version of `get_or_compute` for the tornado IOLoop, waiting for another worker does not block and
+        the SQLite calls run on the threads of the cache
+        :param compute: function returning a future of the value
+        """
+        run = self._get_executor().submit
+        if mode == CACHE_BYPASS:
+            yield run(self._count, 'bypasses')
+            value = yield compute()
+            raise gen.Return((value, 'bypass'))
+
+        deadline = deadline or Deadline()
+        while True:
+            acquired, value = yield run(self._acquire, key, mode, deadline)
+            if value is not None:
+                raise gen.Return((value, 'hit'))
+            if acquired:
+                break
+            yield gen.sleep(self._wait_interval(deadline))
+        try:
+            value = yield compute()
+            store = cacheable is None or cacheable(value)
+        except Exception:
+            yield run(self._release, key)
+            raise
+        status = yield run(self._release, key, mode, value if store else None)
+        raise gen.Return((value, status))
+
+    def _wait_interval(self, deadline):
+        if deadline.expired():
+            raise RuntimeError('Deadline reached while waiting for the result computed by another worker')
+        return min(self.poll_interval, deadline.remaining())
+
+    def _acquire(self, key, mode=CACHE_USE, deadline=None):
+        """
+        Take the lock of `key` unless another worker computes it, in the `use` mode the value stored meanwhile is
+        returned instead. Hits and waits are counted in the same transaction.
+        :param deadline: `Deadline` of the request, the lock expires with it or after `lock_timeout`
+        :return: `(acquired, value)`
+        """
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            value = self._lookup(conn, key, now) if mode == CACHE_USE else None
+            if value is not None:
+                self._increment(conn, 'hits')
+                conn.execute('COMMIT')
+                return False, value
+            row = conn.execute('SELECT expires FROM locks WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] > now:
+                self._increment(conn, 'waits')
+                conn.execute('COMMIT')
+                return False, None
+            expires = now + self.lock_timeout
+            if deadline is not None and deadline.expires is not None:
+                expires = min(expires, deadline.expires)
+            conn.execute('INSERT OR REPLACE INTO locks VALUES (?, ?)', (key, expires))
+            conn.execute('COMMIT')
+            return True, None
+        finally:
+            conn.close()
+
+    def _release(self, key, mode=None, value=None):
+        """
+        Release the lock of `key`, storing the computed `value` if any and counting the computation of the `mode` in
+        the same transaction
+        :param mode: `None` when the computation failed
+        :return: status of the computation, `miss` or `refresh`
+        """
+        conn = self._connect()
+        try:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            if value is not None:
+                self._store(conn, key, value, now)
+            conn.execute('DELETE FROM locks WHERE key = ?', (key,))
+            if mode is not None:
+                self._increment(conn, 'refreshes' if mode == CACHE_REFRESH else 'misses')
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return 'refresh' if mode == CACHE_REFRESH else 'miss'
+
+    def _count(self, name):
+        conn = self._connect()
+        try:
+            self._increment(conn, name)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _increment(conn, name):
+        conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?', (name,))
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            result = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+            result['entries'] = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        finally:
+            conn.close()
+        lookups = result['hits'] + result['misses']
+        result['hit_ratio'] = float(result['hits']) / lookups if lookups else 0.0
+        return result
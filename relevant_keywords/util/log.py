@@ -1,5 +1,21 @@
+"""
+Loggers of the package.
+
+Log calls only put the record on a queue, a background thread writes it to stderr and to the log file of the day
+(`<utc date>.log`, a new file is opened when the date changes), so a log call on the request path never waits on the
+disk. Configured from the environment:
+    LOG_LEVEL        level of the loggers, default `DEBUG`
+    LOG_SAMPLE_RATE  fraction of the `DEBUG` and `INFO` records kept, default `1`, warnings and errors are always kept
+    LOG_ASYNC        `0` writes the records in the calling thread instead, default `1`
+    LOG_QUEUE_SIZE   max records waiting for the writer, default `10000`, further records are dropped and counted
+    LOG_DIR          directory of the log files, default `relevant_keywords/logs`
+"""
+import Queue
+import atexit
 import logging
 import os
+import random
+import threading
 from datetime import datetime
 
 CRITICAL = logging.CRITICAL
@@ -13,30 +29,183 @@ NOTSET = logging.NOTSET
 
 _LOGGERS = {}
 
-logger_level = DEBUG
+logger_level = logging.getLevelName(os.environ.get('LOG_LEVEL', 'DEBUG').upper())
+if not isinstance(logger_level, int):
+    logger_level = DEBUG
+sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+async_logging = os.environ.get('LOG_ASYNC', '1') != '0'
+queue_size = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+logs_dir = os.environ.get('LOG_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), '../logs'))
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)')
+
+
+class DailyFileHandler(logging.FileHandler):
+    """
+    Appends to `<directory>/<utc date>.log` of the date of each record
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.date = datetime.utcnow().date()
+        logging.FileHandler.__init__(self, self._path(self.date), delay=True)
+
+    def _path(self, date):
+        return os.path.join(self.directory, '%s.log' % date)
+
+    def emit(self, record):
+        date = datetime.utcfromtimestamp(record.created).date()
+        if date != self.date:
+            self.date = date
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(self._path(date))
+        if self.stream is None and not os.path.exists(self.directory):
+            # Created with the first record, not on import
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        logging.FileHandler.emit(self, record)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a `rate` fraction of the records below `WARNING`
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class LogWriter(object):
+    """
+    Background thread writing queued records to their handlers, started by the first record of each process, e.g.
+    in every gunicorn worker forked after the import
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, handlers, record):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait((handlers, record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            # A queue inherited from the parent process has no reader
+            self.queue = Queue.Queue(self.max_size)
+            self.dropped = 0
+            self.thread = threading.Thread(target=self._run, name='LogWriter')
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def _run(self):
+        reported = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            handlers, record = item
+            self._write(handlers, record)
+            if self.dropped > reported and self.queue.empty():
+                record = logging.LogRecord('LogWriter', WARNING, __file__, 0, 'Dropped %d log records, queue full',
+                                           (self.dropped - reported,), None)
+                reported = self.dropped
+                self._write(handlers, record)
+
+    @staticmethod
+    def _write(handlers, record):
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self, timeout=5.0):
+        """
+        Write the records still queued, at exit
+        """
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting the records of the calling thread on the queue of a `LogWriter`, which passes them to `handlers`
+    """
+
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        try:
+            # Formatted now, the arguments and the traceback may have changed by the time the record is written
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.put(self.handlers, record)
+        except Exception:
+            self.handleError(record)
+
+
+def _make_handlers():
+    stream_handler = logging.StreamHandler()
+    file_handler = DailyFileHandler(logs_dir)
+    for handler in (stream_handler, file_handler):
+        handler.setFormatter(formatter)
+    return [stream_handler, file_handler], [stream_handler]
 
-logs_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../logs')
 
-if not os.path.exists(logs_dir):
-    os.makedirs(logs_dir)
+_writer = LogWriter(queue_size)
+_file_handlers, _stream_handlers = _make_handlers()
+if async_logging:
+    _file_handlers = [QueueHandler(_writer, _file_handlers)]
+    _stream_handlers = [QueueHandler(_writer, _stream_handlers)]
+    atexit.register(_writer.stop)
+_sample_filter = SampleFilter(sample_rate)
+for _handler in _file_handlers + _stream_handlers:
+    _handler.addFilter(_sample_filter)
 
 
-def get_logger(name, level=logger_level, log_file=os.path.join(logs_dir, '%s.log' % str(datetime.utcnow().date()))):
+def get_logger(name, level=None, log_file=True):
+    """
+    :param level: level of the logger, default is `LOG_LEVEL`
+    :param log_file: also write to the log file of the day, not only to stderr
+    """
     global _LOGGERS
     if name in _LOGGERS:
         return _LOGGERS[name]
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)')
-    # add stream handle
-    sh = logging.StreamHandler()
-    sh.setFormatter(formatter)
-    logger.addHandler(sh)
-    # add file logger handle if exist file path
-    if log_file:
-        fh = logging.FileHandler(log_file)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
+    logger.setLevel(logger_level if level is None else level)
+    for handler in _file_handlers if log_file else _stream_handlers:
+        logger.addHandler(handler)
 
     _LOGGERS[name] = logger
     return logger
@@ -0,0 +1,300 @@
+"""
+Latency metrics exposed in the Prometheus text format, aggregated over the worker processes.
+
+With `METRICS_DIR` set, every process writes its values in place in a file of its own in that directory, read through
+`mmap`, and a scrape landing on any gunicorn worker sums the files of all of them: series are labelled by metric label
+only, never by pid. Gauges only count the processes still alive, counters and histograms of exited workers, e.g.
+restarted after `--max-requests`, are kept. The directory must be emptied when the server starts. Without it, e.g.
+in tests and scripts, values are only kept in the process.
+"""
+import errno
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+metrics_dir = os.environ.get('METRICS_DIR')
+
+
+def _format_labels(labels):
+    return ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+
+def _entries(data, used):
+    """
+    Entries of a values file: 8 bytes of used size, then per value the length of its key, the key padded to a
+    multiple of 8 bytes and the value as a double
+    """
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', data, position)[0]
+        key = data[position + 4:position + 4 + length]
+        position += 4 + length + (-(4 + length) % 8)
+        yield key, struct.unpack_from('d', data, position)[0], position
+        position += 8
+
+
+class _LocalValues(object):
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, increments):
+        with self._lock:
+            for key, amount in increments:
+                self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def items(self):
+        with self._lock:
+            return self._values.items()
+
+
+class _MmapValues(object):
+    """
+    Values of one process in a file of `metrics_dir`, written in place so that the other processes read them at once
+    """
+
+    def __init__(self, path, initial_size=64 * 1024):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self._size = os.fstat(self._fd).st_size
+        if self._size == 0:
+            self._size = initial_size
+            os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._used = struct.unpack_from('i', self._map, 0)[0] or 8
+        # Kept when a pid is reused, the counters of the former process go on
+        self._positions = dict((key, position) for key, _, position in _entries(self._map, self._used))
+        self._lock = threading.Lock()
+
+    def _position(self, key):
+        # Called with the lock held
+        position = self._positions.get(key)
+        if position is None:
+            padded = 4 + len(key) + (-(4 + len(key)) % 8)
+            while self._used + padded + 8 > self._size:
+                self._map.close()
+                self._size *= 2
+                os.ftruncate(self._fd, self._size)
+                self._map = mmap.mmap(self._fd, self._size)
+            struct.pack_into('i%ds' % len(key), self._map, self._used, len(key), key)
+            position = self._positions[key] = self._used + padded
+            # The used size is written last, a reader never sees an entry before its value is initialized
+            struct.pack_into('d', self._map, position, 0.0)
+            self._used = position + 8
+            struct.pack_into('i', self._map, 0, self._used)
+        return position
+
+    def add(self, increments):
+        with self._lock:
+            for key, amount in increments:
+                position = self._position(key)
+                struct.pack_into('d', self._map, position, struct.unpack_from('d', self._map, position)[0] + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            struct.pack_into('d', self._map, self._position(key), value)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value, _ in _entries(self._map, self._used)]
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def _get_values():
+    # Created on first use in each process, e.g. in every gunicorn worker forked after the import
+    global _values, _values_pid
+    if _values_pid != os.getpid():
+        with _values_lock:
+            if _values_pid != os.getpid():
+                if metrics_dir:
+                    try:
+                        os.makedirs(metrics_dir)
+                    except OSError:
+                        pass  # Created meanwhile by another worker
+                    _values = _MmapValues(os.path.join(metrics_dir, 'metrics_%d.db' % os.getpid()))
+                else:
+                    _values = _LocalValues()
+                _values_pid = os.getpid()
+    return _values
+
+
+def _key(name, label_value, sample=''):
+    return json.dumps([name, label_value, sample])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _collect():
+    """
+    :return: values summed over all processes, and over the processes alive only
+    """
+    if metrics_dir:
+        processes = []
+        for path in glob.glob(os.path.join(metrics_dir, 'metrics_*.db')):
+            pid = int(os.path.basename(path)[len('metrics_'):-len('.db')])
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) >= 8:
+                processes.append((pid, [(key, value) for key, value, _ in
+                                        _entries(data, struct.unpack_from('i', data, 0)[0])]))
+    else:
+        processes = [(os.getpid(), _get_values().items())]
+    totals, live_totals = {}, {}
+    for pid, items in processes:
+        alive = pid == os.getpid() or _alive(pid)
+        for key, value in items:
+            name, label_value, sample = json.loads(key)
+            totals[name, label_value, sample] = totals.get((name, label_value, sample), 0) + value
+            if alive:
+                live_totals[name, label_value, sample] = live_totals.get((name, label_value, sample), 0) + value
+    return totals, live_totals
+
+
+def _series(values, name):
+    series = {}
+    for (metric_name, label_value, sample), value in values.iteritems():
+        if metric_name == name:
+            series.setdefault(label_value, {})[sample] = value
+    return sorted(series.iteritems())
+
+
+class Histogram(object):
+    """
+    Histogram of observed values per label value, an observation is one bisect and three additions under a lock
+    """
+
+    def __init__(self, name, documentation, label_name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+
+    def observe(self, label_value, value):
+        index = bisect_left(self.buckets, value)
+        _get_values().add([(_key(self.name, label_value, str(index)), 1), (_key(self.name, label_value, 'sum'), value),
+                           (_key(self.name, label_value, 'count'), 1)])
+
+    def render(self, totals, live_totals):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        for label_value, samples in _series(totals, self.name):
+            series_labels = [(self.label_name, label_value)]
+            cumulative = 0
+            for index, bound in enumerate(self.buckets + ('+Inf',)):
+                cumulative += samples.get(str(index), 0)
+                lines.append('%s_bucket{%s} %d' % (self.name, _format_labels(series_labels + [('le', bound)]),
+                                                   cumulative))
+            lines.append('%s_sum{%s} %r' % (self.name, _format_labels(series_labels), samples.get('sum', 0.0)))
+            lines.append('%s_count{%s} %d' % (self.name, _format_labels(series_labels), samples.get('count', 0)))
+        return lines
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, label_name):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+
+    def inc(self, label_value, amount=1):
+        _get_values().add([(_key(self.name, label_value), amount)])
+
+    def render(self, totals, live_totals):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        for label_value, samples in _series(totals, self.name):
+            lines.append('%s{%s} %d' % (self.name, _format_labels([(self.label_name, label_value)]), samples['']))
+        return lines
+
+
+class Gauge(object):
+    """
+    Current value per label value, e.g. the number of queued jobs, summed over the processes alive
+    """
+
+    def __init__(self, name, documentation, label_name):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+
+    def set(self, label_value, value):
+        _get_values().set(_key(self.name, label_value), value)
+
+    def render(self, totals, live_totals):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s gauge' % self.name]
+        for label_value, samples in _series(live_totals, self.name):
+            lines.append('%s{%s} %r' % (self.name, _format_labels([(self.label_name, label_value)]), samples['']))
+        return lines
+
+
+stage_seconds = Histogram('keyword_stage_seconds', 'Seconds spent per stage of a top keywords request', 'stage')
+requests_total = Counter('keyword_requests_total', 'Top keywords requests by outcome', 'status')
+scheduler_wait_seconds = Histogram('keyword_scheduler_wait_seconds', 'Seconds a scoring job waited for a free slot',
+                                   'workload')
+scheduler_queued = Gauge('keyword_scheduler_queued_jobs', 'Scoring jobs waiting for a free slot', 'workload')
+scheduler_running = Gauge('keyword_scheduler_running_jobs', 'Scoring jobs running', 'workload')
+scheduler_rejected = Counter('keyword_scheduler_rejected_total', 'Scoring jobs rejected by a full queue', 'workload')
+
+
+class StageTimer(object):
+    """
+    Timings of the stages of one request, each stage is also observed in the `keyword_stage_seconds` histogram.
+    A timer belongs to one request, it may be handed over between threads but is not used by two at once.
+    """
+
+    def __init__(self, histogram=stage_seconds):
+        """
+        :param histogram: `None` only keeps the timings, e.g. in a job process whose timings are recorded by the
+            timer of the request
+        """
+        self.histogram = histogram
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        # A stage run several times in one request, e.g. per metric, adds up
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        if self.histogram is not None:
+            self.histogram.observe(name, seconds)
+
+    def record_all(self, timings):
+        for name, seconds in timings.iteritems():
+            self.record(name, seconds)
+
+
+def render_metrics():
+    totals, live_totals = _collect()
+    lines = []
+    for metric in (stage_seconds, requests_total, scheduler_wait_seconds, scheduler_queued, scheduler_running,
+                   scheduler_rejected):
+        lines.extend(metric.render(totals, live_totals))
+    return '\n'.join(lines) + '\n'
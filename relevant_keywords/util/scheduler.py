@@ -0,0 +1,199 @@
+"""
+Scoring jobs of the requests scheduled per workload class, so that slow jobs never delay fast ones.
+
+Each class (e.g. `cheap` metrics scored in seconds and `expensive` ones trained for minutes) has its own executor, at
+most `max_workers` of its jobs run at once and at most `max_queue` more wait for a slot. A job submitted to a full
+class is rejected at once with `SchedulerBusy`, the request fails fast instead of holding a connection until its
+deadline. Waits, queued and running jobs and rejections are observed in the metrics of `util.metrics`.
+
+Executors are created on first use in each process, e.g. in every gunicorn worker forked after the import.
+
+A job still running after `job_timeout` fails and frees its slot: a job run in a process which died, e.g. killed by
+the OOM killer, never completes otherwise and would hold its slot for good. `ProcessPool` runs jobs in processes
+which are replaced when they die, the `ProcessPoolExecutor` backport never notices a dead process.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+
+from concurrent.futures import Future
+
+from relevant_keywords.util.metrics import scheduler_queued, scheduler_rejected, scheduler_running, \
+    scheduler_wait_seconds
+
+
+class SchedulerBusy(RuntimeError):
+
+    def __init__(self, workload, retry_after):
+        RuntimeError.__init__(self, 'Too many `%s` jobs, retry in %ds' % (workload, retry_after))
+        self.workload = workload
+        self.retry_after = retry_after
+
+
+class JobTimeout(RuntimeError):
+    pass
+
+
+def _call(fn, args, kwargs):
+    # Exceptions are returned, the callback of `Pool.apply_async` is only called with results
+    try:
+        return True, fn(*args, **kwargs)
+    except Exception as e:
+        return False, e
+
+
+class ProcessPool(object):
+    """
+    Executor of jobs in a `multiprocessing.Pool`, jobs and their results must be picklable
+    """
+
+    def __init__(self, max_workers, max_tasks_per_worker=None):
+        """
+        :param max_tasks_per_worker: number of jobs after which a process is replaced, e.g. to return the memory it
+            grew to, `None` keeps processes
+        """
+        self._pool = multiprocessing.Pool(max_workers, maxtasksperchild=max_tasks_per_worker)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def done(result):
+            ok, value = result
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        # The job of a process which died never calls back, `WorkloadQueue.job_timeout` gives it up
+        self._pool.apply_async(_call, (fn, args, kwargs), callback=done)
+        return future
+
+    def shutdown(self, wait=True):
+        self._pool.close()
+        if wait:
+            self._pool.join()
+
+
+class WorkloadQueue(object):
+    """
+    Bounded queue of the jobs of one workload class in front of its executor
+    """
+
+    def __init__(self, name, executor_factory, max_workers, max_queue, retry_after=1, job_timeout=None):
+        """
+        :param executor_factory: called with `max_workers`, e.g. `ThreadPoolExecutor` or `ProcessPool` whose jobs must
+            then be picklable
+        :param max_queue: max number of jobs waiting for a slot, `0` rejects jobs as soon as all workers are busy
+        :param retry_after: seconds after which a rejected client should retry
+        :param job_timeout: seconds after which a running job fails with `JobTimeout` and frees its slot, `None` waits
+            for it
+        """
+        self.name = name
+        self.executor_factory = executor_factory
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.job_timeout = job_timeout
+        self.rejected = 0
+        self.timed_out = 0
+        self._queue = deque()
+        self._running = 0
+        # Timer of each running job, a job is done or timed out once removed
+        self._jobs = {}
+        self._executor = None
+        self._pid = None
+        # Reentrant, a job which is already done when dispatched completes in the dispatching thread
+        self._lock = threading.RLock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        :return: `Future` of the result of `fn`
+        :raise SchedulerBusy: when the queue is full
+        """
+        future = Future()
+        with self._lock:
+            if self._running >= self.max_workers and len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                scheduler_rejected.inc(self.name)
+                raise SchedulerBusy(self.name, self.retry_after)
+            self._queue.append((future, fn, args, kwargs, time.time()))
+            self._dispatch()
+        return future
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            self._executor = self.executor_factory(self.max_workers)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _dispatch(self):
+        # Called with the lock held
+        while self._queue and self._running < self.max_workers:
+            future, fn, args, kwargs, queued = self._queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            scheduler_wait_seconds.observe(self.name, time.time() - queued)
+            self._running += 1
+            try:
+                job = self._get_executor().submit(fn, *args, **kwargs)
+            except Exception as e:
+                self._running -= 1
+                future.set_exception(e)
+                continue
+            timer = None
+            if self.job_timeout is not None:
+                timer = threading.Timer(self.job_timeout, self._timed_out, (job, future))
+                timer.daemon = True
+                timer.start()
+            self._jobs[job] = timer
+            job.add_done_callback(lambda job, future=future: self._done(job, future))
+        scheduler_queued.set(self.name, len(self._queue))
+        scheduler_running.set(self.name, self._running)
+
+    def _done(self, job, future):
+        with self._lock:
+            if job not in self._jobs:
+                # Timed out before
+                return
+            timer = self._jobs.pop(job)
+            if timer is not None:
+                timer.cancel()
+            self._running -= 1
+            self._dispatch()
+        exception, traceback = job.exception_info()
+        if exception is not None:
+            future.set_exception_info(exception, traceback)
+        else:
+            future.set_result(job.result())
+
+    def _timed_out(self, job, future):
+        with self._lock:
+            if job not in self._jobs:
+                return
+            del self._jobs[job]
+            self.timed_out += 1
+            self._running -= 1
+            self._dispatch()
+        future.set_exception(JobTimeout('`%s` job still running after %ds' % (self.name, self.job_timeout)))
+
+    def stats(self):
+        with self._lock:
+            return {'queued': len(self._queue), 'running': self._running, 'rejected': self.rejected,
+                    'timed_out': self.timed_out, 'max_workers': self.max_workers, 'max_queue': self.max_queue}
+
+
+class WorkloadScheduler(object):
+
+    def __init__(self, queues):
+        """
+        :param queues: `WorkloadQueue` of each workload class
+        """
+        self.queues = dict((queue.name, queue) for queue in queues)
+
+    def submit(self, workload, fn, *args, **kwargs):
+        return self.queues[workload].submit(fn, *args, **kwargs)
+
+    def stats(self):
+        return dict((name, queue.stats()) for name, queue in self.queues.iteritems())
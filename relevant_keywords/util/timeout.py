@@ -1,25 +1,40 @@
-from functools import wraps
-import signal
+"""
+Cooperative deadlines of requests.
 
+A `Deadline` is created when a request starts and passed down to the crawl, tokenization and scoring. Work checks it
+at checkpoints and stops cleanly, or picks a cheaper engine when the remaining budget is too small, instead of being
+interrupted by a signal: it is safe in any thread, including the scoring threads of the tornado workers.
+"""
+import time
 
-class TimeoutError(Exception):
-    pass
 
+class Deadline(object):
 
-def timeout(seconds=10):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError('Function got timeout after running %s seconds' % seconds)
+    def __init__(self, seconds=None):
+        """
+        :param seconds: budget from now, `None` never expires
+        """
+        self.seconds = seconds
+        self.expires = None if seconds is None else time.time() + seconds
 
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+    def remaining(self):
+        if self.expires is None:
+            return float('inf')
+        return max(0.0, self.expires - time.time())
 
-        return wraps(func)(wrapper)
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
 
-    return decorator
\ No newline at end of file
+    def allows(self, seconds):
+        return self.remaining() >= seconds
+
+    def timeout(self, default, reserve=0):
+        """
+        Timeout of a blocking call bounded by the deadline
+        :param reserve: seconds kept for the work after the call, at most half of the remaining budget
+        """
+        if self.expires is None:
+            return default
+        remaining = self.remaining()
+        # Never `0`, which clients read as no timeout
+        return max(0.01, min(default, max(remaining - reserve, remaining / 2.0)))
@@ -8,5 +8,16 @@ export PYTHONPATH=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
 ENV=${PYTHONPATH}/env
 HOST=0.0.0.0
 
+# Metrics of all workers are summed from their files in METRICS_DIR, the values of a former run are dropped
+export METRICS_DIR=${METRICS_DIR:-${PYTHONPATH}/cache/metrics}
+rm -rf ${METRICS_DIR}
+
+# PRELOAD=1 loads the app and the metric libraries once in the master, workers are forked from it
+GUNICORN_OPTIONS=""
+if [ -n "${PRELOAD}" ]; then
+    export WARM_UP=1
+    GUNICORN_OPTIONS="--preload"
+fi
+
 # Start app
-${ENV}/bin/python ${ENV}/bin/gunicorn -k tornado -w 2 -b ${HOST}:${PORT} relevant_keywords.main:app --max-requests 10000 --timeout 240
+${ENV}/bin/python ${ENV}/bin/gunicorn -k tornado -w 2 -b ${HOST}:${PORT} relevant_keywords.main:async_app --max-requests 10000 --timeout 240 ${GUNICORN_OPTIONS}
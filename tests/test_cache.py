@@ -0,0 +1,74 @@
+import time
+
+import pytest
+from tornado import gen, ioloop
+
+from relevant_keywords.util.cache import CACHE_REFRESH, ResultCache
+from relevant_keywords.util.timeout import Deadline
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ResultCache(str(tmpdir.join('cache.sqlite')), poll_interval=0.01)
+
+
+def test_miss_then_hit(cache):
+    assert cache.get_or_compute('key', lambda: {'a': 1}) == ({'a': 1}, 'miss')
+    assert cache.get_or_compute('key', lambda: {'a': 2}) == ({'a': 1}, 'hit')
+    assert cache.get_or_compute('key', lambda: {'a': 3}, CACHE_REFRESH) == ({'a': 3}, 'refresh')
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['refreshes'], stats['entries']) == (1, 1, 1, 1)
+
+
+def test_value_stored_while_waiting_is_a_hit(cache):
+    # Another worker holds the lock, stores its result and releases it between two polls
+    assert cache._acquire('key') == (True, None)
+    assert cache._acquire('key') == (False, None)
+    cache._release('key', value={'a': 1})
+    assert cache.get_or_compute('key', lambda: {'a': 2}) == ({'a': 1}, 'hit')
+    assert cache.stats()['waits'] == 1
+
+
+def test_wait_stops_at_deadline(cache):
+    cache._acquire('key')
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('key', lambda: {'a': 1}, deadline=Deadline(0.1))
+    assert time.time() - start < 1
+
+
+def test_lock_expires_with_deadline(cache):
+    assert cache._acquire('key', deadline=Deadline(0.05)) == (True, None)
+    time.sleep(0.1)
+    assert cache.get_or_compute('key', lambda: {'a': 1}) == ({'a': 1}, 'miss')
+
+
+def test_failed_computation_releases_lock(cache):
+    def compute():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute('key', compute)
+    assert cache.get_or_compute('key', lambda: {'a': 1}) == ({'a': 1}, 'miss')
+
+
+def test_async(cache):
+    @gen.coroutine
+    def compute():
+        raise gen.Return({'a': 1})
+
+    @gen.coroutine
+    def run():
+        first = yield cache.get_or_compute_async('key', compute)
+        second = yield cache.get_or_compute_async('key', compute)
+        raise gen.Return((first, second))
+
+    assert ioloop.IOLoop.current().run_sync(run) == (({'a': 1}, 'miss'), ({'a': 1}, 'hit'))
+
+
+def test_file_created_on_first_use(tmpdir):
+    path = tmpdir.join('cache', 'cache.sqlite')
+    cache = ResultCache(str(path))
+    assert not tmpdir.join('cache').exists()
+    assert cache.get('key') is None
+    assert path.exists()
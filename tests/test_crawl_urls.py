@@ -0,0 +1,28 @@
+from relevant_keywords.crawl_urls import crawl_pages
+from relevant_keywords.page_store import PageStore
+
+
+class ContentGetter(object):
+    """
+    Stand-in for `parser.content_getter.ContentGetter`, records the urls it was asked to crawl
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def process(self, urls):
+        self.calls.append(set(urls))
+        return dict((url, {'content': None, 'error': 'Timeout'} if 'broken' in url else
+                     {'content': u'content of %s' % url, 'error': None}) for url in urls)
+
+
+def test_stored_pages_are_not_crawled_again(tmpdir):
+    page_store = PageStore(str(tmpdir))
+    content_getter = ContentGetter()
+    urls = {'http://a', 'http://b', 'http://broken'}
+    first = crawl_pages(urls, content_getter, page_store)
+    second = crawl_pages(urls, content_getter, page_store)
+    assert content_getter.calls == [urls, {'http://broken'}]
+    assert first == second
+    assert second['http://a'] == {'content': u'content of http://a', 'error': None}
+    assert second['http://broken'] == {'content': None, 'error': 'Timeout'}
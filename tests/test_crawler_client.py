@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import random
+import time
+import zlib
+from StringIO import StringIO
+
+import pytest
+from tornado import ioloop
+
+from relevant_keywords.benchmark.fake_crawler import start_fake_crawler
+from relevant_keywords.crawler_client import AsyncCrawlerClient, CrawlerClient, PagesParser
+
+PAGES = [
+    ['http://a', {'ok': True, 'content': u'plain text', 'code': 200}],
+    ['http://b?q="x"', {'ok': True, 'content': u'quotes \\" and \\\\ [brackets] {braces} ]]} "', 'code': 200}],
+    ['http://c', {'ok': True, 'content': u'unicode caf\xe9 ☃ \U0001f600', 'code': 200}],
+    ['http://d', {'ok': False, 'error': 'Timeout', 'code': None, 'nested': [[1, {'a': [2]}], {}]}],
+]
+BODY = json.dumps({'status': '"pages": [[', 'meta': {'pages': [1, 2]}, 'pages': PAGES, 'after': ['x']},
+                  ensure_ascii=False).encode('utf-8')
+
+
+def parse(chunks, max_page_bytes=None):
+    parser = PagesParser(max_page_bytes)
+    pages = []
+    for chunk in chunks:
+        pages.extend(parser.feed(chunk))
+    parser.close()
+    return pages
+
+
+def split(data, rng):
+    chunks = []
+    while data:
+        size = rng.randint(1, 16)
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
+
+
+def test_whole_body():
+    assert parse([BODY]) == json.loads(BODY)['pages']
+
+
+def test_split_chunks():
+    assert parse([BODY[i:i + 1] for i in range(len(BODY))]) == json.loads(BODY)['pages']
+    rng = random.Random(0)
+    for _ in range(200):
+        assert parse(split(BODY, rng)) == json.loads(BODY)['pages']
+
+
+def test_escape_at_chunk_end():
+    body = json.dumps({'pages': [['http://a', {'content': 'a\\"b'}]]})
+    backslash = body.index('\\')
+    assert parse([body[:backslash + 1], body[backslash + 1:]]) == [['http://a', {'content': 'a\\"b'}]]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100000])
+def test_oversized_page(chunk_size):
+    pages = [['http://small', {'ok': True, 'content': 'x' * 10}],
+             ['http://large', {'ok': True, 'content': '[' * 5000}],
+             ['http://after', {'ok': True, 'content': 'y' * 10}]]
+    body = json.dumps({'pages': pages})
+    parsed = parse([body[i:i + chunk_size] for i in range(0, len(body), chunk_size)], max_page_bytes=1000)
+    assert parsed[0] == pages[0] and parsed[2] == pages[2]
+    assert parsed[1] == ['http://large', {'ok': False, 'error': 'Page larger than 1000 bytes', 'code': None}]
+
+
+@pytest.mark.parametrize('body', ['<html>Bad gateway</html>', '', '{"pages": [["http://a", {}]', BODY[:len(BODY) // 2],
+                                  '{"other": [["http://a", {}]]}'])
+def test_invalid_body(body):
+    with pytest.raises(ValueError):
+        parse([body])
+
+
+def test_gzip_body():
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(BODY)
+    compressed = buf.getvalue()
+    # Decompressed chunk by chunk as the clients do
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = [decompressor.decompress(chunk) for chunk in split(compressed, random.Random(1))]
+    assert parse(chunks + [decompressor.flush()]) == json.loads(BODY)['pages']
+
+
+@pytest.fixture
+def fake_crawler():
+    servers = []
+
+    def start(**kwargs):
+        server, endpoint = start_fake_crawler(words_per_page=50, **kwargs)
+        servers.append(server)
+        return server, endpoint
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_failed_batch_retried(fake_crawler):
+    server, endpoint = fake_crawler(fail_first=1)
+    crawled = CrawlerClient(endpoint, backoff=0.01).crawl(['http://a', 'http://b'], 'goose')
+    assert server.calls == 2
+    assert [url for url, page in crawled['pages']] == ['http://a', 'http://b']
+    assert all(page['ok'] for url, page in crawled['pages'])
+    assert crawled['failed_batches'] == []
+
+
+def test_failed_batch_given_up_after_retries(fake_crawler):
+    server, endpoint = fake_crawler(fail_first=10)
+    crawled = CrawlerClient(endpoint, retries=2, backoff=0.01).crawl(['http://a'], 'goose')
+    assert server.calls == 3
+    assert crawled['pages'] == []
+    assert crawled['failed_batches'][0]['urls'] == ['http://a']
+    assert '503' in crawled['failed_batches'][0]['error']
+
+
+def test_partial_pages_at_deadline(fake_crawler):
+    # The batch of 2 urls takes 1s, the batch of 1 url 0.5s
+    server, endpoint = fake_crawler(delay=0.5)
+    client = CrawlerClient(endpoint, batch_size=2, concurrency=2, backoff=0.01)
+    start = time.time()
+    crawled = client.crawl(['http://a', 'http://b', 'http://c'], 'goose', timeout=0.8)
+    assert time.time() - start < 1.0
+    assert [url for url, page in crawled['pages']] == ['http://c']
+    assert crawled['failed_batches'][0]['urls'] == ['http://a', 'http://b']
+
+
+def test_batches_crawled_concurrently(fake_crawler):
+    server, endpoint = fake_crawler(delay=0.3)
+    client = CrawlerClient(endpoint, batch_size=1, concurrency=4)
+    start = time.time()
+    crawled = client.crawl(['http://%d' % i for i in range(4)], 'goose')
+    assert time.time() - start < 0.9
+    assert len(crawled['pages']) == 4 and server.calls == 4
+
+
+def test_async_failed_batch_retried(fake_crawler):
+    server, endpoint = fake_crawler(fail_first=1)
+    client = AsyncCrawlerClient(endpoint, backoff=0.01)
+    crawled = ioloop.IOLoop().run_sync(lambda: client.crawl(['http://a', 'http://b'], 'goose'))
+    assert server.calls == 2
+    assert [url for url, page in crawled['pages']] == ['http://a', 'http://b']
+    assert crawled['failed_batches'] == []
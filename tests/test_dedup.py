@@ -0,0 +1,37 @@
+from relevant_keywords.nlp.dedup import deduplicate, deduplicate_pages
+
+NAVIGATION = u'home gifts jewelry contact'
+
+
+def page(*lines):
+    return u'\n'.join(lines)
+
+
+def test_line_of_few_pages_is_kept():
+    contents = [page(NAVIGATION, u'engraved necklace for her birthday'),
+                page(u'personalized photo frame', u'engraved necklace for her birthday')]
+    assert deduplicate(contents) == (contents, {'input_pages': 2, 'duplicate_pages': 0, 'repeated_lines': 0,
+                                                'removed_bytes': 0})
+
+
+def test_line_of_many_pages_is_kept_once():
+    contents = [page(NAVIGATION, u'engraved necklace for her birthday'),
+                page(NAVIGATION, u'personalized photo frame with names'),
+                page(NAVIGATION, u'christmas ornament with the family')]
+    pages, stats = deduplicate_pages(contents)
+    assert pages == [contents[0], u'personalized photo frame with names', u'christmas ornament with the family']
+    assert stats['repeated_lines'] == 2
+
+
+BODIES = [u'engraved necklace for her birthday', u'personalized photo frame with names',
+          u'christmas ornament with the family', u'custom mugs for the office', u'wedding blanket monogram',
+          u'holiday cards printed with photos', u'jewelry box with engraved initials',
+          u'baby blanket embroidered name', u'leather wallet with custom message', u'garden stone with paw prints']
+
+
+def test_min_line_share():
+    contents = [page(NAVIGATION, body) for body in BODIES[:3]]
+    contents += [page(u'another site', body) for body in BODIES[3:]]
+    assert deduplicate(contents, min_line_share=0.5)[1]['repeated_lines'] == 6
+    assert deduplicate(contents, min_line_share=0.8)[0] == contents
+    assert deduplicate(contents, min_line_share=0.3)[1]['repeated_lines'] == 2 + 6
@@ -0,0 +1,28 @@
+import pytest
+
+from relevant_keywords.benchmark.corpus import generate_corpus
+from relevant_keywords.nlp.doc_term import DocTermMatrix
+from relevant_keywords.top_keyword import keyword_tokenizer
+
+
+@pytest.fixture(scope='module')
+def token_docs():
+    pages = generate_corpus(num_pages=40, words_per_page=400, vocab_size=300)
+    return keyword_tokenizer.tokenize_documents(pages, lowercase=True)
+
+
+def frequent_terms(doc_term, min_doc_count):
+    doc_term = doc_term.select(doc_term.document_frequency() >= min_doc_count)
+    return [doc_term.terms[i] for i in range(doc_term.num_terms)], doc_term.matrix
+
+
+@pytest.mark.parametrize('min_ngram,max_ngram', [(1, 2), (1, 4), (2, 3)])
+@pytest.mark.parametrize('min_doc_count', [2, 5, 12])
+def test_pruned_same_as_unpruned(token_docs, min_ngram, max_ngram, min_doc_count):
+    full = DocTermMatrix.from_token_documents(token_docs, min_ngram, max_ngram)
+    pruned = DocTermMatrix.from_token_documents(token_docs, min_ngram, max_ngram, min_doc_count)
+    assert pruned.num_terms < full.num_terms
+    expected_terms, expected_matrix = frequent_terms(full, min_doc_count)
+    actual_terms, actual_matrix = frequent_terms(pruned, min_doc_count)
+    assert actual_terms == expected_terms
+    assert (actual_matrix != expected_matrix).nnz == 0
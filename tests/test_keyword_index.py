@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from relevant_keywords.benchmark.tokenizer_benchmark import WORDS
+from relevant_keywords.keyword_index import KeywordIndex
+from relevant_keywords.top_keyword import TopKeywords
+
+
+def make_pages(num_pages=30, seed=0):
+    # Lines of a page: the navigation and footer blocks of its site, then paragraphs of its own
+    rnd = random.Random(seed)
+
+    def line():
+        return u' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 12)))
+
+    sites = [[line() for _ in range(3)] for _ in range(4)]
+    pages = []
+    for _ in range(num_pages):
+        blocks = rnd.choice(sites)
+        pages.append(u'\n'.join(blocks[:2] + [line() for _ in range(rnd.randint(2, 8))] + blocks[2:]))
+    # A page crawled from two urls and a near-duplicate page
+    pages.append(pages[0])
+    pages.append(pages[1] + u' gifts')
+    return pages
+
+
+@pytest.fixture
+def top_keywords(tmpdir):
+    return TopKeywords('http://localhost:8080', keyword_index=KeywordIndex(str(tmpdir.join('index.sqlite'))))
+
+
+def rank(top_keywords, pages, urls, index_key, dedup, max_ngram):
+    # No `max_voc` limit, the index and the matrix keep different terms among the ones tied in frequency at the limit
+    return top_keywords.rank(pages, ['tfidf', 'count'], top_n=30, min_df=0.05, max_df=0.95, max_voc=100000,
+                             max_ngram=max_ngram, dedup=dedup, index_key=index_key, urls=urls)
+
+
+@pytest.mark.parametrize('max_ngram', [1, 2])
+@pytest.mark.parametrize('dedup', [False, True])
+def test_index_same_as_matrix(top_keywords, dedup, max_ngram):
+    pages = make_pages()
+    urls = ['http://example.com/%d' % i for i in range(len(pages))]
+    expected = rank(top_keywords, pages, urls, None, dedup, max_ngram)['top_keywords']
+    for _ in range(2):
+        actual = rank(top_keywords, pages, urls, 'gifts', dedup, max_ngram)['top_keywords']
+        assert actual['count'] == expected['count']
+        assert [term for term, _ in actual['tfidf']] == [term for term, _ in expected['tfidf']]
+
+
+def test_reordered_pages_keep_index(top_keywords):
+    pages = make_pages()
+    urls = ['http://example.com/%d' % i for i in range(len(pages))]
+    rank(top_keywords, pages, urls, 'gifts', True, 1)
+
+    order = list(range(len(pages)))
+    random.Random(1).shuffle(order)
+    pages = [pages[i] for i in order]
+    urls = [urls[i] for i in order]
+    result = rank(top_keywords, pages, urls, 'gifts', True, 1)
+    assert result['index']['added'] == result['index']['removed'] == 0
+    assert result['top_keywords']['count'] == rank(top_keywords, pages, urls, None, True, 1)['top_keywords']['count']
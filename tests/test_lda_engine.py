@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from relevant_keywords.benchmark.corpus import generate_corpus
+from relevant_keywords.lda_engine import LdaEngine
+from relevant_keywords.top_keyword import build_doc_term
+
+
+@pytest.fixture(scope='module')
+def doc_term():
+    return build_doc_term(generate_corpus(num_pages=20, words_per_page=200, vocab_size=200), 1, 1)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_passes_without_time_budget(doc_term, workers):
+    stats = {}
+    topics = LdaEngine(workers=workers).get_topics(doc_term, 3, passes=3, stats=stats)
+    assert len(topics) == 3
+    assert stats == {'passes': 3, 'stopped': False}
+
+
+def test_time_budget_stops_training(doc_term):
+    stats = {}
+    LdaEngine().get_topics(doc_term, 3, passes=1000, time_budget=0.0, stats=stats)
+    assert stats == {'passes': 1, 'stopped': True}
+
+
+def test_model_saved_by_another_worker_is_kept(doc_term, tmpdir, monkeypatch):
+    engine = LdaEngine(model_dir=str(tmpdir))
+    engine.get_topics(doc_term, 3, key='gifts', passes=1)
+    saved = set(os.listdir(str(tmpdir)))
+
+    def rename(src, dst):
+        # The other worker renames its model into place right after this one removed the former model
+        raise OSError(39, 'Directory not empty')
+
+    monkeypatch.setattr(os, 'rename', rename)
+    LdaEngine(model_dir=str(tmpdir)).get_topics(doc_term, 3, key='gifts', passes=1, doc_ids=['other'])
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')]
+    assert set(os.listdir(str(tmpdir))) <= saved
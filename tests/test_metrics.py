@@ -0,0 +1,59 @@
+import multiprocessing
+
+import pytest
+
+from relevant_keywords.util import metrics
+
+
+@pytest.fixture
+def metrics_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(metrics, 'metrics_dir', str(tmpdir))
+    monkeypatch.setattr(metrics, '_values', None)
+    monkeypatch.setattr(metrics, '_values_pid', None)
+    return str(tmpdir)
+
+
+def record(queued):
+    metrics.stage_seconds.observe('crawl', 0.3)
+    metrics.requests_total.inc('ok')
+    metrics.scheduler_queued.set('cheap', queued)
+
+
+def run_in_process(queued):
+    process = multiprocessing.Process(target=record, args=(queued,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_series_summed_over_processes(metrics_dir):
+    run_in_process(5)
+    run_in_process(7)
+    record(2)
+    rendered = metrics.render_metrics()
+    assert 'worker' not in rendered
+    assert 'keyword_requests_total{status="ok"} 3\n' in rendered
+    assert 'keyword_stage_seconds_count{stage="crawl"} 3\n' in rendered
+    assert 'keyword_stage_seconds_bucket{stage="crawl",le="0.25"} 0\n' in rendered
+    assert 'keyword_stage_seconds_bucket{stage="crawl",le="0.5"} 3\n' in rendered
+    # Gauges of exited processes are dropped
+    assert 'keyword_scheduler_queued_jobs{workload="cheap"} 2.0\n' in rendered
+
+
+def test_values_file_grows(metrics_dir):
+    for i in range(3000):
+        metrics.requests_total.inc('status %d' % i, i)
+    rendered = metrics.render_metrics()
+    assert 'keyword_requests_total{status="status 2999"} 2999\n' in rendered
+    assert 'keyword_requests_total{status="status 0"} 0\n' in rendered
+
+
+def test_local_values(monkeypatch):
+    monkeypatch.setattr(metrics, 'metrics_dir', None)
+    monkeypatch.setattr(metrics, '_values', None)
+    monkeypatch.setattr(metrics, '_values_pid', None)
+    record(4)
+    record(3)
+    rendered = metrics.render_metrics()
+    assert 'keyword_requests_total{status="ok"} 2\n' in rendered
+    assert 'keyword_scheduler_queued_jobs{workload="cheap"} 3\n' in rendered
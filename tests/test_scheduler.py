@@ -0,0 +1,46 @@
+import os
+import signal
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from relevant_keywords.util.scheduler import JobTimeout, ProcessPool, SchedulerBusy, WorkloadQueue
+
+
+def die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def fail():
+    raise ValueError('Failed job')
+
+
+@pytest.fixture
+def queue():
+    queue = WorkloadQueue('expensive', ProcessPool, max_workers=1, max_queue=0, job_timeout=1)
+    yield queue
+    queue._get_executor().shutdown()
+
+
+def test_process_job_result(queue):
+    assert queue.submit(pow, 2, 10).result(timeout=10) == 1024
+    with pytest.raises(ValueError):
+        queue.submit(fail).result(timeout=10)
+    assert queue.stats()['running'] == 0
+
+
+def test_slot_of_killed_job_released(queue):
+    killed = queue.submit(die)
+    with pytest.raises(SchedulerBusy):
+        queue.submit(pow, 2, 10)
+    with pytest.raises(JobTimeout):
+        killed.result(timeout=10)
+    assert queue.stats()['running'] == 0 and queue.stats()['timed_out'] == 1
+    # The killed process is replaced
+    assert queue.submit(pow, 2, 10).result(timeout=10) == 1024
+
+
+def test_timer_cancelled_when_done():
+    queue = WorkloadQueue('cheap', ThreadPoolExecutor, max_workers=1, max_queue=0, job_timeout=0.5)
+    assert queue.submit(pow, 2, 3).result(timeout=10) == 8
+    assert queue._jobs == {} and queue.stats()['timed_out'] == 0
@@ -0,0 +1,20 @@
+# coding=utf-8
+import pytest
+
+from relevant_keywords.benchmark.tokenizer_benchmark import EDGE_CASES, generate_pages
+from relevant_keywords.nlp.token_filter import get_token_filter
+from relevant_keywords.top_keyword import keyword_tokenizer, tokenize
+
+PAGES = generate_pages(num_pages=5, words_per_page=2000)
+
+
+@pytest.mark.parametrize('text', EDGE_CASES + PAGES)
+def test_same_tokens_as_tokenize(text):
+    for variant in (text, text.lower(), text.encode('utf-8')):
+        assert keyword_tokenizer.tokenize(variant) == tokenize(variant)
+
+
+def test_default_filter_same_tokens_as_tokenize():
+    tokenizer = get_token_filter().tokenizer
+    assert tokenizer.tokenize_documents(EDGE_CASES + PAGES, lowercase=True) == \
+        [tokenize(text.lower()) for text in EDGE_CASES + PAGES]
@@ -0,0 +1,78 @@
+import random
+
+import numpy as np
+import pytest
+
+from relevant_keywords.benchmark.tokenizer_benchmark import NOISE, WORDS
+from relevant_keywords.nlp.token_filter import english_stop_words
+from relevant_keywords.top_keyword import TopKeywords, build_doc_term, tokenize
+
+
+def make_pages(num_pages=40, words_per_page=300, seed=0):
+    # Keywords mixed with sklearn's English stop words, which the former tokenizer kept, and markup noise
+    rnd = random.Random(seed)
+    vocabulary = WORDS + sorted(english_stop_words()) + NOISE
+    return [u' '.join(rnd.choice(vocabulary) for _ in range(words_per_page)) for _ in range(num_pages)]
+
+
+@pytest.fixture(scope='module')
+def top_keywords():
+    return TopKeywords('http://localhost:8080')
+
+
+@pytest.fixture(scope='module')
+def parallel_top_keywords():
+    top_keywords = TopKeywords('http://localhost:8080', preprocess_workers=2, parallel_min_docs=2)
+    yield top_keywords
+    if top_keywords._preprocess_pool is not None:
+        top_keywords._preprocess_pool.terminate()
+
+
+def assert_same_doc_term(actual, expected):
+    assert [actual.terms[i] for i in range(actual.num_terms)] == [expected.terms[i] for i in range(expected.num_terms)]
+    assert (actual.matrix != expected.matrix).nnz == 0
+
+
+@pytest.mark.parametrize('max_ngram', [2, 3])
+@pytest.mark.parametrize('metrics', [['tfidf'], ['tfidf', 'count']])
+def test_tfidf_ngrams_same_as_vectorizer(top_keywords, metrics, max_ngram):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    pages = make_pages()
+    vectorizer = TfidfVectorizer(tokenizer=tokenize, stop_words='english', ngram_range=(1, max_ngram), min_df=0.1,
+                                 max_df=0.9, max_features=200)
+    vectorizer.fit_transform(pages)
+    features = vectorizer.get_feature_names()
+    indices = np.argsort(vectorizer.idf_)[::-1]
+    expected = [(features[i], vectorizer.idf_[i]) for i in indices[:50]]
+
+    result = top_keywords.rank(pages, metrics, top_n=50, min_df=0.1, max_df=0.9, max_voc=200, max_ngram=max_ngram,
+                               dedup=False)
+    # A single metric is returned as the list of its keywords
+    top = result['top_keywords'] if len(metrics) == 1 else result['top_keywords']['tfidf']
+    assert [term for term, _ in top] == [term for term, _ in expected]
+    assert np.allclose([score for _, score in top], [score for _, score in expected])
+
+
+@pytest.mark.parametrize('tfidf', [False, True])
+@pytest.mark.parametrize('max_ngram', [1, 3])
+def test_parallel_doc_term_same_as_serial(parallel_top_keywords, max_ngram, tfidf):
+    pages = make_pages()
+    assert_same_doc_term(parallel_top_keywords._build_doc_term(pages, 1, max_ngram, tfidf=tfidf),
+                         build_doc_term(pages, 1, max_ngram, tfidf=tfidf))
+
+
+def test_parallel_rank_same_as_serial(top_keywords, parallel_top_keywords):
+    pages = make_pages()
+    options = dict(top_n=30, min_df=0.1, max_df=0.9, max_ngram=2)
+    assert parallel_top_keywords.rank(pages, ['tfidf', 'count'], **options) == \
+        top_keywords.rank(pages, ['tfidf', 'count'], **options)
+
+
+@pytest.mark.parametrize('tfidf_mode', ['idf', 'weight'])
+def test_pruned_tfidf_same_as_unpruned(top_keywords, tfidf_mode):
+    # Alone, `tfidf` reads a matrix without the ngrams below `min_df`, with `count` the full one
+    pages = make_pages()
+    options = dict(top_n=30, min_df=0.2, max_df=0.9, max_ngram=3, tfidf_mode=tfidf_mode, token_filter='english')
+    assert top_keywords._min_doc_count(['tfidf'], 0.2, 0.9, 1, 3, len(pages)) > 1
+    assert top_keywords.rank(pages, ['tfidf'], **options)['top_keywords'] == \
+        top_keywords.rank(pages, ['tfidf', 'count'], **options)['top_keywords']['tfidf']